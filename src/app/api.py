@@ -0,0 +1,69 @@
+from app.models import Paste
+from modules.api import ApiError, JsonApi, decode_cursor, encode_cursor
+from modules.common import Base
+from modules.orm import ModelCollection
+
+
+class PasteApi(Base):
+    """
+    Routes of the read-only paste API:
+        GET /pastes/latest
+        GET /pastes/by-author/<author>
+        GET /pastes?from=<date>&to=<date>   (from inclusive, to exclusive, both optional)
+        GET /pastes/<id>
+    Lists are ordered from the newest paste and hold up to limit pastes without their content,
+    along with the next cursor to pass as the cursor parameter for the following page, null on the last page.
+    """
+    LIST_FIELDS = ['author', 'title', 'date']
+    # the primary key follows the date in the same direction, so the date indexes serve the ordering without sorting
+    LIST_ORDERING = ['-date', '-{}'.format(Paste.ID_KEYWORD)]
+
+    def __init__(self, context):
+        super().__init__(context)
+        self.api = JsonApi(context, [(r'/pastes/latest', self.latest),
+                                     (r'/pastes/by-author/(?P<author>[^/]+)', self.by_author),
+                                     (r'/pastes/(?P<pk>\d+)', self.by_id),
+                                     (r'/pastes', self.by_date_range)])
+
+    def _get_limit(self, params):
+        try:
+            limit = int(params.get('limit', self.context.config.API_PAGE_SIZE))
+        except ValueError:
+            raise ApiError(400, "Invalid limit")
+        if not 1 <= limit <= self.context.config.API_MAX_PAGE_SIZE:
+            raise ApiError(400, "Limit must be between 1 and {}".format(self.context.config.API_MAX_PAGE_SIZE))
+        return limit
+
+    def _list(self, query, params):
+        query = query.order_by(*self.LIST_ORDERING).after(decode_cursor(params.get('cursor'), len(self.LIST_ORDERING)))
+        records, keyset = query.page(self._get_limit(params))
+        items = [dict([(Paste.ID_KEYWORD, getattr(record, Paste.ID_KEYWORD))] + [(field_name, getattr(record, field_name)) for field_name in self.LIST_FIELDS])
+                 for record in records]
+        return {'items': items, 'next': encode_cursor(keyset)}
+
+    def latest(self, match, params, connection):
+        return self._list(ModelCollection(self.context, model=Paste, connection=connection).query(), params)
+
+    def by_author(self, match, params, connection):
+        query = ModelCollection(self.context, model=Paste, connection=connection).query().filter(author=match.group('author'))
+        return self._list(query, params)
+
+    def by_date_range(self, match, params, connection):
+        query = ModelCollection(self.context, model=Paste, connection=connection).query()
+        if params.get('from'):
+            query = query.filter(date__gte=params['from'])
+        if params.get('to'):
+            query = query.filter(date__lt=params['to'])
+        return self._list(query, params)
+
+    def by_id(self, match, params, connection):
+        record = ModelCollection(self.context, model=Paste, connection=connection).query().filter(pk=int(match.group('pk'))).first()
+        if record is None:
+            raise ApiError(404, "No paste with id {}".format(match.group('pk')))
+        return dict([(Paste.ID_KEYWORD, getattr(record, Paste.ID_KEYWORD))] + [(field_name, getattr(record, field_name)) for field_name, _ in Paste.FIELDS])
+
+    def close(self):
+        self.api.close()
+
+    def serve_forever(self):
+        self.api.serve_forever()
@@ -0,0 +1,69 @@
+import datetime
+
+from app.models import BackfillPage, BackfillPageRecord, PasteRecord
+from app.runtime import Runner
+from modules.orm import ModelCollection
+
+
+class Backfiller(Runner):
+    """
+    Crawls the entire page range through the Runner pipeline, without stopping at the already stored pastes
+
+    Every page is checkpointed in the database right after its pastes, so a restarted backfill
+    skips the pages done before. New pastes only push the older ones to the next pages, so nothing is missed
+    when the site changes in between, the pastes seen twice are skipped by the unique fingerprint index.
+    That index also lets the backfill run along with the incremental scraper without duplicating rows.
+    The checkpoints are kept per page number, so only the [website] source is backfilled.
+    """
+    def __init__(self, context):
+        super().__init__(context)
+        self.checkpoints = ModelCollection(context, model=BackfillPage)
+
+    def _get_completed_pages(self, last_page_number):
+        return self.checkpoints.get_stored_values('page_number', range(1, last_page_number + 1))
+
+    def _store_checkpoint(self, page_number, pastes, stored_pastes):
+        completed_at = datetime.datetime.now(datetime.timezone.utc).strftime(self.context.config.DB_DT_DB_FORMAT)
+        self.checkpoints.store([BackfillPageRecord(page_number, pastes, stored_pastes, completed_at)])
+
+    def reset(self):
+        self.logger.info("Removing the backfill checkpoints")
+        self.checkpoints.connection.execute("DELETE FROM {}".format(BackfillPage.get_table_name()), commit=True)
+
+    def go(self):
+        """
+        :return: number of pages crawled, number of new pastes stored
+        """
+        self.web_request.start_crawl()
+        landing_page = self.web_request.get(self.navigator.source.main_url)
+        navigation = list(self.navigator.navigate(landing_page))
+        if not navigation:
+            self.logger.info("Landing page is empty: nothing to backfill")
+            return 0, 0
+        last_page_number = navigation[-1][1]
+        completed_pages = self._get_completed_pages(last_page_number)
+        pending = [navigation_item for navigation_item in navigation if navigation_item[1] not in completed_pages]
+        self.logger.info("Backfilling %s of %s pages, %s already done", len(pending), last_page_number, len(completed_pages))
+
+        crawled_pages, stored_pastes = 0, 0
+        pipeline = self._create_pipeline()
+        try:
+            for (_, page_number, _), (normalized_pastes, signatures) in pipeline.run(pending):
+                pastes = [PasteRecord(*values) for values in normalized_pastes]
+                for paste in pastes:
+                    paste.source = self.navigator.source.name
+                self.metrics.increment('pastes_extracted_total', len(pastes))
+                page_stored_pastes = self._store_extracted_pastes(pastes, signatures, page_number) if pastes else 0
+                # stored after the pastes, so a checkpoint is never committed without them
+                self._store_checkpoint(page_number, len(pastes), page_stored_pastes)
+                crawled_pages += 1
+                stored_pastes += page_stored_pastes
+                self.logger.info("Page %s (%s of %s): %s new of %s paste%s", page_number, crawled_pages, len(pending),
+                                 page_stored_pastes, len(pastes), 's' if len(pastes) != 1 else '')
+        finally:
+            pipeline.stop()
+            self.model_collection.connection.flush()
+        self._log_fetch_stats()
+        self.logger.info("Backfill done: %s page%s crawled, %s new paste%s stored", crawled_pages, 's' if crawled_pages != 1 else '',
+                         stored_pastes, 's' if stored_pastes != 1 else '')
+        return crawled_pages, stored_pastes
@@ -0,0 +1,14 @@
+from app.models import Paste
+
+
+def analyze(context, connection):
+    connection.execute("ANALYZE")
+
+
+def tag_pastes_with_source(context, connection):
+    # every paste stored before there were several sources came from the [website] one
+    connection.execute("UPDATE {} SET source = ? WHERE source IS NULL".format(Paste.get_table_name()), (context.config.WEB_SOURCE_NAME,))
+
+
+MIGRATIONS = [(1, "collect index statistics for the query planner", analyze),
+              (2, "tag the stored pastes with the [website] source", tag_pastes_with_source)]
@@ -1,59 +1,97 @@
 import datetime
+import functools
+import hashlib
 
 from modules.orm import Model
 
 
+@functools.lru_cache(maxsize=4096)
+def convert_date(date, input_format, output_format):
+    return datetime.datetime.strptime(date, input_format).strftime(output_format)
+
+
+@functools.lru_cache(maxsize=16)
+def parse_name_variations(name_variations):
+    return frozenset(name.strip().lower() for name in name_variations.split(','))
+
+
 class Paste(Model):
     FIELDS = [('author', 'string'),
               ('title', 'string'),
-              ('content', 'string'),
-              ('date', 'date')]
+              ('content', 'compressed_string'),
+              ('date', 'date'),
+              ('source', 'string'),
+              ('fingerprint', 'string')]
     ORDER_BY = 'date'
+    STR_FIELDS = ['author', 'title', 'date']
+    INDEXES = [(['date'], 'index'),
+               (['author', 'date'], 'index'),
+               (['fingerprint'], 'unique')]
+    FULL_TEXT_FIELDS = ['title', 'author', 'content']
+    # the source is left out, so the same paste seen on several mirrors is stored once
+    FINGERPRINT_FIELDS = ['author', 'title', 'date', 'content']
+    # near-duplicate pastes are looked up by their content, see app.similarity
+    MINHASH_FIELD = 'content'
 
-    def __normalize__date(self):
-        self.logger.debug("Normalizing date")
-        original_date = self.date
-        if original_date is None:
-            self.logger.debug("Date is missing: nothing to normalize")
+    def __normalize__date(self, record):
+        if record.date is None:
             return
+        record.date = convert_date(record.date, self.context.config.DB_DT_INPUT_FORMAT, self.context.config.DB_DT_DB_FORMAT)
 
-        date_object = datetime.datetime.strptime(original_date, self.context.config.DB_DT_INPUT_FORMAT)
-        self.date = date_object.strftime(self.context.config.DB_DT_DB_FORMAT)
-        self.logger.debug("Date %s normalized to %s", original_date, self.date)
+    def __normalize__author(self, record):
+        if record.author is None:
+            return
+        if record.author.strip().lower() in parse_name_variations(self.context.config.DB_UNKNOWN_AUTHOR_NAME_VARIATIONS):
+            record.author = self.context.config.DB_UNKNOWN_AUTHOR_DB_NAME
+        record.author = record.author.strip()
 
-    def __normalize__author(self):
-        self.logger.debug("Normalizing author name")
-        original_author = self.author
-        if original_author is None:
-            self.logger.debug("Author name is missing: nothing to normalize")
+    def __normalize__title(self, record):
+        if record.title is None:
             return
+        record.title = record.title.strip().replace('\n', ' ').replace('\r', '')
 
-        name_variations = set(name.strip().lower() for name in self.context.config.DB_UNKNOWN_AUTHOR_NAME_VARIATIONS.split(','))
-        self.logger.debug("Collected unknown author name variations: %s", name_variations)
-        if original_author.strip().lower() in name_variations:
-            self.author = self.context.config.DB_UNKNOWN_AUTHOR_DB_NAME
-        self.author = self.author.strip()
-        self.logger.debug("Author name %s normalized to %s", original_author, self.author)
-
-    def __normalize__title(self):
-        self.logger.debug("Normalizing title")
-        original_title = self.title
-        if original_title is None:
-            self.logger.debug("Title is missing: nothing to normalize")
+    def __normalize__content(self, record):
+        if record.content is None:
             return
+        record.content = record.content.strip()
 
-        self.title = original_title.strip().replace('\n', ' ').replace('\r', '')
-        self.logger.debug("Title %s normalized to %s", original_title, self.title)
+    def __normalize__fingerprint(self, record):
+        # runs after the rest of the fields are normalized, see FIELDS
+        values = ('' if getattr(record, field_name) is None else getattr(record, field_name) for field_name in self.FINGERPRINT_FIELDS)
+        record.fingerprint = hashlib.sha1('\0'.join(values).encode('utf-8')).hexdigest()
 
-    def __normalize__content(self):
-        self.logger.debug("Normalizing content")
-        original_content = self.content
-        if original_content is None:
-            self.logger.debug("Content is missing: nothing to normalize")
-            return
 
-        self.content = original_content.strip()
-        self.logger.debug("Title %s normalized to %s", original_content, self.content)
+PasteRecord = Paste.get_record_class()
+
+
+class BackfillPage(Model):
+    """
+    Checkpoint of a page the backfill module has stored the pastes of
+    """
+    FIELDS = [('page_number', 'integer'),
+              ('pastes', 'integer'),
+              ('stored_pastes', 'integer'),
+              ('completed_at', 'date')]
+    ORDER_BY = 'page_number'
+    INDEXES = [(['page_number'], 'unique')]
+
+
+BackfillPageRecord = BackfillPage.get_record_class()
+
+
+class WatchlistHit(Model):
+    """
+    Watchlist entry found in a stored paste, see app.watchlist
+    """
+    FIELDS = [('paste_id', 'integer'),
+              ('kind', 'string'),
+              ('entry', 'string'),
+              ('value', 'string'),
+              ('matched_at', 'date')]
+    ORDER_BY = 'matched_at'
+    STR_FIELDS = ['kind', 'entry', 'value']
+    INDEXES = [(['paste_id', 'entry', 'value'], 'unique'),
+               (['entry', 'value'], 'index')]
+
 
-    def __str__(self):
-        return ", ".join("{}: {}".format(column, getattr(self, column)) for column in ['author', 'title', 'date'])
+WatchlistHitRecord = WatchlistHit.get_record_class()
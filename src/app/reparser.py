@@ -0,0 +1,69 @@
+import os
+
+from app import workers
+from app.models import Paste, PasteRecord
+from app.similarity import SimilarityIndexer
+from modules.archive import PageArchive
+from modules.common import Base
+from modules.orm import ModelCollection
+from modules.pipeline import StagedPipeline
+from modules.scraper import get_url_source
+
+
+class Reparser(Base):
+    """
+    Extracts the pastes out of the archived pages again, storing the ones missing in the database:
+        parse, normalize: worker processes reading the pages straight from the archive, one per core by default
+        store: the reparser itself, handling the pages in the order those were first fetched
+    The pastes are tagged with the source the page URL belongs to, if it is still configured.
+    With the similarity index enabled the stored pastes are added to it.
+    """
+    def __init__(self, context, workers_count=None):
+        super().__init__(context)
+        self.workers_count = workers_count or os.cpu_count() or 1
+        self.page_archive = PageArchive(context)
+        self.model_collection = ModelCollection(context, model=Paste)
+        self.similarity_indexer = SimilarityIndexer(context) if context.config.SIMILARITY_ENABLED else None
+
+    def _create_pipeline(self):
+        stages = [('parse', workers.parse_archived_page, self.workers_count, 'process'),
+                  ('normalize', workers.normalize_pastes, self.workers_count, 'process')]
+        return StagedPipeline(self.context,
+                              stages,
+                              max_items_in_flight=max(self.context.config.PIPELINE_MAX_PAGES, self.workers_count * 2),
+                              process_workers=self.workers_count,
+                              process_initializer=workers.init,
+                              process_initargs=(self.context.config_filepath, self.context.tor_hostname))
+
+    def go(self, since=None):
+        """
+        :param since: unix time the pages fetched earlier are left out
+        :return: number of pages reparsed, number of pastes extracted, number of new pastes stored
+        """
+        archived_pages = self.page_archive.get_archived_pages(since)
+        self.logger.info("Reparsing %s archived page%s with %s worker%s", len(archived_pages), 's' if len(archived_pages) != 1 else '',
+                         self.workers_count, 's' if self.workers_count != 1 else '')
+        extracted_pastes, stored_pastes = 0, 0
+        page_sources = dict()
+        for url, _, digest in archived_pages:
+            source = get_url_source(self.context, url)
+            page_sources[digest] = source.name if source is not None else None
+        pipeline = self._create_pipeline()
+        try:
+            for digest, (normalized_pastes, signatures) in pipeline.run(digest for _, _, digest in archived_pages):
+                pastes = [PasteRecord(*values) for values in normalized_pastes]
+                for paste in pastes:
+                    paste.source = page_sources[digest]
+                extracted_pastes += len(pastes)
+                if pastes:
+                    last_pk = self.model_collection.get_last_primary_key()
+                    # pastes already in the database are skipped by the unique fingerprint index
+                    page_stored_pastes = self.model_collection.store(pastes)
+                    if self.similarity_indexer is not None and page_stored_pastes > 0:
+                        self.similarity_indexer.index_pastes(pastes, signatures, last_pk)
+                    stored_pastes += page_stored_pastes
+                self.logger.debug("Page %s: %s paste%s extracted", digest, len(pastes), 's' if len(pastes) != 1 else '')
+        finally:
+            pipeline.stop()
+            self.model_collection.connection.flush()
+        return len(archived_pages), extracted_pastes, stored_pastes
@@ -1,64 +1,253 @@
+import cProfile
+import io
+import pstats
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from app.models import Paste
+from app import workers
+from app.models import Paste, PasteRecord
+from app.similarity import SimilarityIndexer
+from app.watchlist import WatchlistMatcher
+from modules.archive import PageArchive
 from modules.common import Base
-from modules.scraper import Navigator, Parser
+from modules.metrics import Metrics, MetricsExporter
 from modules.orm import ModelCollection
+from modules.pipeline import StagedPipeline
+from modules.scheduler import AdaptiveScheduler
+from modules.scraper import Navigator
 from modules.tor import WebRequest
 
 
 class Runner(Base):
+    """
+    Crawls the pastes through a staged pipeline:
+        fetch: WEB_MAX_PAGES_IN_FLIGHT threads downloading the pages
+        parse, normalize: PARSER_WORKERS processes extracting and normalizing the pastes
+        store: the runner itself (or its writer thread), the only one writing to the database, handling the pages in order
+    Once a page with already stored pastes is reached the pipeline is stopped,
+    so the upstream stages drop the pages they have not started yet.
+
+    Every configured source (the [website] one and the [source:<name>] mirrors) is crawled in a thread of its own,
+    the source pipelines share the worker processes and a single writer thread stores the pastes of them all.
+    Each stored paste is tagged with its source, the same paste seen on several mirrors is stored once,
+    as the source is not part of the fingerprint. A source stops at the pastes stored by the previous crawls or by itself,
+    not at the ones another source has stored during the same crawl, see _select_new_pastes().
+
+    The crawl of a source is skipped altogether when its landing page has not changed since the previous one,
+    otherwise the downloaded landing page is reused as the first page.
+    The interval between the crawls is set by AdaptiveScheduler.
+    With the archive enabled every fetched page is kept in PageArchive for the reparse module.
+    With the similarity index enabled the stored pastes are added to it by SimilarityIndexer,
+    their signatures are computed by the normalize workers.
+    With a [watchlist] file set the stored pastes are matched against it by WatchlistMatcher.
+    The crawl and stage metrics are exposed by MetricsExporter as set in the [metrics] section.
+    """
     def __init__(self, context):
         super().__init__(context)
         self.web_request = WebRequest(context)
-        self.navigator = Navigator(context)
+        self.navigator = Navigator(context, web_request=self.web_request)
+        self.sources = context.config.WEB_SOURCES
+        self._writer = None
+        self._last_crawl_id = 0
+        self._source_outcomes = dict()
         self.model_collection = ModelCollection(context, model=Paste)
+        self.scheduler = AdaptiveScheduler(context)
+        self.page_archive = PageArchive(context) if context.config.ARCHIVE_ENABLED else None
+        self.similarity_indexer = SimilarityIndexer(context) if context.config.SIMILARITY_ENABLED else None
+        self.watchlist_matcher = WatchlistMatcher(context) if context.config.WATCHLIST_FILEPATH else None
+        self.metrics = Metrics.get(context)
+
+    def _fetch_page(self, navigation_item):
+        url, page_number, page = navigation_item
+        if page is None:
+            page = self.web_request.get(url)
+        if self.page_archive is not None:
+            self.page_archive.store(url, page_number, page)
+        return page
+
+    def _create_pipeline(self, process_pool=None):
+        stages = [('fetch', self._fetch_page, self.context.config.WEB_MAX_PAGES_IN_FLIGHT, 'thread'),
+                  ('parse', workers.parse_page, self.context.config.PARSER_WORKERS, 'process'),
+                  ('normalize', workers.normalize_pastes, self.context.config.PARSER_WORKERS, 'process')]
+        return StagedPipeline(self.context,
+                              stages,
+                              max_items_in_flight=self.context.config.PIPELINE_MAX_PAGES,
+                              process_workers=self.context.config.PARSER_WORKERS,
+                              process_initializer=workers.init,
+                              process_initargs=(self.context.config_filepath, self.context.tor_hostname),
+                              process_pool=process_pool)
 
-    def _is_the_paste_new(self, paste, latest_paste):
-        if paste.date < latest_paste.date:
-            return False
-        if paste == latest_paste:
-            return False
-        return True
-
-    def _extract_page_pastes(self, url, latest_paste=None):
-        """
-        :param url: page url to extract pastes from
-        :param latest_paste: latest stored paste object to compare extracted pastes against
-        :return: list (of extracted pastes), boolean (whether the entire page was extracted)
-        """
-        page = self.web_request.get(url)
-        parser = Parser(self.context, page)
-        pastes = list()
-        for paste in parser.extract_new_paste():
-            if latest_paste and not self._is_the_paste_new(paste, latest_paste):
-                return pastes, False
+    def _select_new_pastes(self, pastes, source):
+        """
+        A page holding pastes of the previous crawls or pastes the source has stored itself has been crawled before,
+        the pastes another source has just stored do not stop the crawl, the source may be lagging behind it
+        :param pastes: list of normalized paste records extracted from a page
+        :return: list (of the pastes not stored yet), boolean (whether none of the page pastes was crawled before)
+        """
+        stored_fingerprints = self.model_collection.get_stored_values('fingerprint', (paste.fingerprint for paste in pastes))
+        crawled_before = bool(stored_fingerprints) and bool(self.model_collection.get_stored_values('fingerprint', stored_fingerprints, pk__lte=self._last_crawl_id) or
+                                                             self.model_collection.get_stored_values('fingerprint', stored_fingerprints, source=source.name))
+        new_pastes = list()
+        extracted_fingerprints = set()
+        for paste in pastes:
+            if paste.fingerprint in stored_fingerprints or paste.fingerprint in extracted_fingerprints:
+                continue
             self.logger.debug("Extracted Paste: %s", paste)
-            pastes.append(paste)
-        return pastes, True
+            extracted_fingerprints.add(paste.fingerprint)
+            new_pastes.append(paste)
+        return new_pastes, not crawled_before
 
-    def _store_extracted_pastes(self, pastes, page_number):
+    def _store_extracted_pastes(self, pastes, signatures, page_number):
+        """
+        :param signatures: dict of the paste fingerprints to their MinHash signatures, see workers.normalize_pastes()
+        """
         self.logger.info("Storing pastes extracted from page %s", page_number)
-        self.model_collection.store(pastes)
+        last_pk = self.model_collection.get_last_primary_key() if self.similarity_indexer is not None else None
+        stored_pastes = self.model_collection.store(pastes)
+        if self.similarity_indexer is not None and stored_pastes > 0:
+            self.similarity_indexer.index_pastes(pastes, signatures, last_pk)
+        if self.watchlist_matcher is not None:
+            self.watchlist_matcher.match_pastes(pastes)
+        return stored_pastes
+
+    def _store_page(self, pastes, signatures, page_number, source):
+        """
+        Runs in the writer thread when the sources are crawled concurrently
+        :return: number of stored new pastes, boolean (whether none of the page pastes was crawled before)
+        """
+        page_pastes, continue_to_the_next_page = self._select_new_pastes(pastes, source)
+        if not page_pastes:
+            return 0, continue_to_the_next_page
+        for paste in page_pastes:
+            paste.source = source.name
+        return self._store_extracted_pastes(page_pastes, signatures, page_number), continue_to_the_next_page
+
+    def _write(self, function, *args):
+        """
+        Calls the function in the writer thread if there is one, so a single thread ever uses the database connection
+        """
+        if self._writer is None:
+            return function(*args)
+        return self._writer.submit(function, *args).result()
 
-    def _crawl(self):
+    def _record_source_outcome(self, source, outcome):
+        self._source_outcomes[source.name] = outcome
+        self.metrics.increment('source_crawls_total', source=source.name, outcome=outcome)
+
+    def _crawl_source(self, source, inline=False, process_pool=None):
+        """
+        :param inline: run the pipeline stages in the calling thread
+        :param process_pool: worker processes shared with the pipelines of the other sources
+        :return: number of stored new pastes
+        """
+        landing_page = self.web_request.get_if_changed(source.main_url)
+        if landing_page is None:
+            self.logger.info("Landing page of %s has not changed since the previous crawl: skipping", source.name)
+            self._record_source_outcome(source, 'unchanged')
+            return 0
+
+        stored_pastes = 0
+        pipeline = self._create_pipeline(process_pool)
+        run = pipeline.run_inline if inline else pipeline.run
+        try:
+            for (_, page_number, _), (normalized_pastes, signatures) in run(Navigator(self.context, web_request=self.web_request, source=source).navigate(landing_page)):
+                pastes = [PasteRecord(*values) for values in normalized_pastes]
+                self.metrics.increment('pastes_extracted_total', len(pastes))
+                page_stored_pastes, continue_to_the_next_page = self._write(self._store_page, pastes, signatures, page_number, source)
+                stored_pastes += page_stored_pastes
+                if not continue_to_the_next_page:
+                    self.logger.info("Reached the pastes crawled before on page %s of %s: finishing", page_number, source.name)
+                    break
+        except Exception:
+            # the pages left unvisited have to be crawled next time even if the landing page stays the same
+            self.web_request.forget_validators(source.main_url)
+            self._record_source_outcome(source, 'failed')
+            raise
+        finally:
+            pipeline.stop()
+        self._record_source_outcome(source, 'done')
+        self.logger.info("%s: %s new paste%s stored", source.name, stored_pastes, 's' if stored_pastes != 1 else '')
+        return stored_pastes
+
+    def _crawl_sources_concurrently(self):
+        """
+        Crawls every source in a thread of its own. The sources share the web request sessions and the worker processes,
+        the pastes of them all are stored by a single writer thread.
+        :return: number of stored new pastes
+        """
+        process_pool = StagedPipeline.create_process_pool(self.context.config.PARSER_WORKERS,
+                                                          initializer=workers.init,
+                                                          initargs=(self.context.config_filepath, self.context.tor_hostname))
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Writer')
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix='Source') as executor:
+                futures = [executor.submit(self._crawl_source, source, process_pool=process_pool) for source in self.sources]
+            # every source is done by now, the first failure is raised once the rest have stored their pastes
+            return sum(future.result() for future in futures)
+        finally:
+            self._writer.shutdown()
+            self._writer = None
+            process_pool.shutdown()
+
+    def _crawl(self, inline=False):
+        """
+        :param inline: run the pipeline stages in the calling thread, crawling one source after another
+        :return: number of stored new pastes
+        """
         self.logger.info("Pastes scraper started")
-        latest_paste = self.model_collection.get_the_most_recent()
-        for url, page_number in self.navigator.navigate():
-            page_pastes, continue_to_the_next_page = list(self._extract_page_pastes(url, latest_paste))
-            if page_pastes:
-                self._store_extracted_pastes(page_pastes, page_number)
-            elif not continue_to_the_next_page:
-                self.logger.info("No new pastes found on page %s: finishing", page_number)
-                break
-            if not continue_to_the_next_page:
-                self.logger.info("Reached old pastes on page %s: finishing", page_number)
-                break
-        self.logger.info("Done")
+        started = time.perf_counter()
+        self.web_request.start_crawl()
+        self._last_crawl_id = self.model_collection.get_last_primary_key()
+        self._source_outcomes = dict()
+        outcome = 'failed'
+        try:
+            if inline or len(self.sources) == 1:
+                stored_pastes = sum(self._crawl_source(source, inline=inline) for source in self.sources)
+            else:
+                stored_pastes = self._crawl_sources_concurrently()
+            outcome = 'unchanged' if all(source_outcome == 'unchanged' for source_outcome in self._source_outcomes.values()) else 'done'
+        finally:
+            self.model_collection.connection.flush()
+            self.metrics.observe('crawl_seconds', time.perf_counter() - started)
+            self.metrics.increment('crawls_total', outcome=outcome)
+        connections, requests_count, reused = self.web_request.get_connection_reuse_stats()
+        self.logger.info("Sent %s request%s over %s connection%s (%s reused)", requests_count, 's' if requests_count != 1 else '', connections, 's' if connections != 1 else '', reused)
+        self._log_fetch_stats()
+        self.logger.info("Done: %s new paste%s stored", stored_pastes, 's' if stored_pastes != 1 else '')
+        return stored_pastes
+
+    def _log_fetch_stats(self):
+        pages, p50, p99, hedged, retried = self.web_request.get_crawl_stats()
+        if pages:
+            self.logger.info("Fetched %s page%s: p50 %.3f s, p99 %.3f s, %s hedged request%s, %s retr%s", pages, 's' if pages != 1 else '', p50, p99,
+                             hedged, 's' if hedged != 1 else '', retried, 'ies' if retried != 1 else 'y')
+
+    def profile(self, filepath, limit=30):
+        """
+        Runs a single crawl under cProfile with the stages inline, so the parse and normalize work is profiled too
+        :param filepath: file the profile is written to, readable with pstats or snakeviz
+        :param limit: number of the most expensive functions logged
+        """
+        profiler = cProfile.Profile()
+        stored_pastes = profiler.runcall(self._crawl, inline=True)
+        profiler.dump_stats(filepath)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        self.logger.info("Profile of the crawl written to %s, the most expensive functions:\n%s", filepath, summary.getvalue())
+        return stored_pastes
 
     def go(self):
         self.logger.info("Launching the runtime")
+        exporter = MetricsExporter(self.context).start()
+        previous_crawl_started = None
         while True:
-            self._crawl()
-            self.logger.info("Sleeping for the next %s hour%s", self.context.config.RUNTIME_WINDOW_IN_HOURS, 's' if self.context.config.RUNTIME_WINDOW_IN_HOURS > 1 else '')
-            time.sleep(self.context.config.RUNTIME_WINDOW_IN_HOURS * 3600)
+            crawl_started = time.monotonic()
+            try:
+                stored_pastes = self._crawl()
+            finally:
+                exporter.write_stats_file()
+            elapsed_hours = None if previous_crawl_started is None else (crawl_started - previous_crawl_started) / 3600
+            previous_crawl_started = crawl_started
+            interval = self.scheduler.record_cycle(stored_pastes, elapsed_hours)
+            self.logger.info("Sleeping for the next %.0f minute%s", interval / 60, 's' if round(interval / 60) != 1 else '')
+            time.sleep(interval)
@@ -0,0 +1,77 @@
+import os
+
+from app import workers
+from app.models import Paste
+from modules.common import Base
+from modules.metrics import Metrics
+from modules.orm import ModelCollection
+from modules.pipeline import StagedPipeline
+from modules.similarity import SimilarityIndex
+
+
+class SimilarityIndexer(Base):
+    """
+    Keeps the similarity index of the paste content, creating its tables on the first use.
+    The crawl adds the pastes it stores with the signatures computed by the normalize workers, see index_pastes().
+
+    go() adds the stored pastes missing from the index, e.g. the ones stored before it existed:
+        signatures: worker processes computing the MinHash signatures of a chunk of pastes, one per core by default
+        index: the indexer itself, the only one writing to the database, adding the chunks in the id order
+    """
+    def __init__(self, context, workers_count=None):
+        super().__init__(context)
+        self.workers_count = workers_count or os.cpu_count() or 1
+        self.model_collection = ModelCollection(context, model=Paste)
+        self.similarity_index = SimilarityIndex(context, Paste, Paste.MINHASH_FIELD, self.model_collection.connection)
+        self.similarity_index.create_tables_if_necessary()
+        self.metrics = Metrics.get(context)
+
+    def index_pastes(self, pastes, signatures, after_pk):
+        """
+        Looks the pastes up by their fingerprints, so it has to run after they are stored
+        :param pastes: list of paste records
+        :param signatures: dict of the paste fingerprints to their MinHash signatures, see workers.normalize_pastes()
+        :param after_pk: primary key of the last paste stored before, the pastes stored earlier are indexed already
+        :return: number of pastes indexed
+        """
+        paste_pks = self.model_collection.get_primary_keys('fingerprint', (paste.fingerprint for paste in pastes))
+        stored_signatures = {paste_pks[fingerprint]: signature for fingerprint, signature in signatures.items() if paste_pks.get(fingerprint, 0) > after_pk}
+        with self.metrics.timer('similarity_index_seconds', table=Paste.get_table_name()):
+            indexed_pastes = self.similarity_index.add(sorted(stored_signatures.items()))
+        self.model_collection.connection.request_commit()
+        return indexed_pastes
+
+    def _create_pipeline(self):
+        stages = [('signatures', workers.compute_signatures, self.workers_count, 'process')]
+        return StagedPipeline(self.context,
+                              stages,
+                              max_items_in_flight=max(self.context.config.PIPELINE_MAX_PAGES, self.workers_count * 2),
+                              process_workers=self.workers_count,
+                              process_initializer=workers.init,
+                              process_initargs=(self.context.config_filepath, self.context.tor_hostname))
+
+    def go(self):
+        """
+        :return: number of pastes indexed
+        """
+        self.logger.info("Indexing the pastes missing from the similarity index with %s worker%s", self.workers_count,
+                         's' if self.workers_count != 1 else '')
+        indexed_pastes = 0
+        pipeline = self._create_pipeline()
+        try:
+            for _, signatures in pipeline.run(self.similarity_index.iterate_missing(self.context.config.SIMILARITY_CHUNK_SIZE)):
+                indexed_pastes += self.similarity_index.add(signatures)
+                self.model_collection.connection.request_commit()
+                self.logger.info("Indexed %s paste%s", indexed_pastes, 's' if indexed_pastes != 1 else '')
+        finally:
+            pipeline.stop()
+            self.model_collection.connection.flush()
+        return indexed_pastes
+
+    def lookup(self, pk):
+        """
+        :return: cluster id (None if the paste is not indexed), list of (similar paste record, estimated similarity)
+        """
+        cluster_id, candidates = self.similarity_index.lookup(pk)
+        records = {record.pk: record for record in self.model_collection.query().filter(pk__in=[candidate[0] for candidate in candidates])} if candidates else dict()
+        return cluster_id, [(records[candidate_pk], similarity) for candidate_pk, _, similarity in candidates if candidate_pk in records]
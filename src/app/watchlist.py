@@ -0,0 +1,136 @@
+import collections
+import datetime
+import functools
+import os
+
+from app import workers
+from app.models import Paste, WatchlistHit, WatchlistHitRecord
+from modules.common import Base
+from modules.metrics import Metrics
+from modules.orm import ModelCollection
+from modules.pipeline import StagedPipeline
+from modules.watchlist import WatchlistFile
+
+
+def get_paste_text(title, content):
+    """
+    :return: text of the paste fields the watchlist is matched against
+    """
+    return '\n'.join(value for value in (title, content) if value)
+
+
+class WatchlistMatcher(Base):
+    """
+    Matches the watchlist file against the pastes and stores the hits in the WatchlistHit table,
+    a paste holding the same value of an entry several times gets a single hit.
+    The file is loaded again once it changes, an invalid edit is logged and the previous watchlist is kept.
+    """
+    def __init__(self, context, filepath=None):
+        """
+        :param filepath: watchlist file to use instead of the [watchlist] one
+        """
+        super().__init__(context)
+        self.watchlist_file = WatchlistFile(filepath or context.config.WATCHLIST_FILEPATH)
+        self.pastes = ModelCollection(context, model=Paste)
+        self.hits = ModelCollection(context, model=WatchlistHit)
+        self.metrics = Metrics.get(context)
+        WatchlistHit.create_table_if_necessary(context)
+        self.watchlist = self._load()
+
+    def _load(self):
+        watchlist = self.watchlist_file.load()
+        self.logger.info("Loaded %s watchlist entr%s from %s", len(watchlist), 'ies' if len(watchlist) != 1 else 'y', self.watchlist_file.filepath)
+        return watchlist
+
+    def get_watchlist(self):
+        """
+        :return: the watchlist, loaded again if the file has changed
+        """
+        try:
+            if self.watchlist_file.is_changed():
+                self.watchlist = self._load()
+        except (OSError, ValueError) as e:
+            self.logger.error("Error when loading the watchlist %s, keeping the previous one: %s", self.watchlist_file.filepath, e)
+        return self.watchlist
+
+    def store_hits(self, hits):
+        """
+        :param hits: iterable of (paste id, kind, watchlist entry, matched value)
+        :return: number of new hits stored
+        """
+        matched_at = datetime.datetime.now(datetime.timezone.utc).strftime(self.context.config.DB_DT_DB_FORMAT)
+        records = [WatchlistHitRecord(paste_id, kind, entry, value, matched_at) for paste_id, kind, entry, value in hits]
+        if not records:
+            return 0
+        for kind, count in collections.Counter(record.kind for record in records).items():
+            self.metrics.increment('watchlist_hits_total', count, kind=kind)
+        return self.hits.store(records)
+
+    def match_pastes(self, pastes):
+        """
+        Looks the stored pastes up by their fingerprints, so it has to run after they are stored
+        :param pastes: list of paste records
+        :return: number of new hits stored
+        """
+        watchlist = self.get_watchlist()
+        if not watchlist:
+            return 0
+        paste_ids = self.pastes.get_primary_keys('fingerprint', (paste.fingerprint for paste in pastes))
+        with self.metrics.timer('watchlist_seconds'):
+            hits = watchlist.match_rows((paste_ids[paste.fingerprint], get_paste_text(paste.title, paste.content))
+                                        for paste in pastes if paste.fingerprint in paste_ids)
+        if hits:
+            matched_pastes = len(set(hit[0] for hit in hits))
+            self.logger.info("Watchlist: %s hit%s in %s paste%s", len(hits), 's' if len(hits) != 1 else '',
+                             matched_pastes, 's' if matched_pastes != 1 else '')
+        return self.store_hits(hits)
+
+
+class Rescanner(Base):
+    """
+    Matches a watchlist against the stored pastes, e.g. after new entries were added to it:
+        match: worker processes matching a chunk of pastes each, one per core by default
+        store: the rescanner itself, the only one writing to the database
+    The hits found before are kept, the unique index of the WatchlistHit table skips the ones found again.
+    """
+    def __init__(self, context, workers_count=None, filepath=None):
+        """
+        :param filepath: watchlist file to use instead of the [watchlist] one
+        """
+        super().__init__(context)
+        self.workers_count = workers_count or os.cpu_count() or 1
+        self.matcher = WatchlistMatcher(context, filepath)
+
+    def _create_pipeline(self):
+        # the workers load the file themselves, the path is all they need
+        stages = [('match', functools.partial(workers.match_watchlist, os.path.abspath(self.matcher.watchlist_file.filepath)), self.workers_count, 'process')]
+        return StagedPipeline(self.context,
+                              stages,
+                              max_items_in_flight=max(self.context.config.PIPELINE_MAX_PAGES, self.workers_count * 2),
+                              process_workers=self.workers_count,
+                              process_initializer=workers.init,
+                              process_initargs=(self.context.config_filepath, self.context.tor_hostname))
+
+    def _iterate_rows(self, after_pk):
+        for chunk in self.matcher.pastes.iterate_chunks(after_pk=after_pk, chunk_size=self.context.config.WATCHLIST_CHUNK_SIZE):
+            yield [(paste.pk, get_paste_text(paste.title, paste.content)) for paste in chunk]
+
+    def go(self, after_pk=None):
+        """
+        :param after_pk: only the pastes with a greater id
+        :return: number of pastes scanned, number of new hits stored
+        """
+        self.logger.info("Rescanning the stored pastes for %s watchlist entr%s with %s worker%s", len(self.matcher.watchlist),
+                         'ies' if len(self.matcher.watchlist) != 1 else 'y', self.workers_count, 's' if self.workers_count != 1 else '')
+        scanned_pastes, stored_hits = 0, 0
+        pipeline = self._create_pipeline()
+        try:
+            for rows, hits in pipeline.run(self._iterate_rows(after_pk)):
+                scanned_pastes += len(rows)
+                stored_hits += self.matcher.store_hits(hits)
+                self.logger.info("Scanned %s paste%s, %s new hit%s", scanned_pastes, 's' if scanned_pastes != 1 else '',
+                                 stored_hits, 's' if stored_hits != 1 else '')
+        finally:
+            pipeline.stop()
+            self.matcher.hits.connection.flush()
+        return scanned_pastes, stored_hits
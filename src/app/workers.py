@@ -0,0 +1,73 @@
+"""
+Functions run by the worker processes of the crawl, reparse, similarity indexing and watchlist rescan pipelines,
+see Runner, Reparser, SimilarityIndexer and Rescanner
+"""
+from app.models import Paste, PasteRecord
+from modules.archive import PageArchive
+from modules.common import Context
+from modules.orm import ModelCollection
+from modules.scraper import Parser
+from modules.similarity import MinHasher
+from modules.watchlist import WatchlistFile
+
+context = None
+model_collection = None
+page_archive = None
+min_hasher = None
+watchlist_files = dict()
+
+
+def init(config_filepath, tor_hostname):
+    global context, model_collection, page_archive, min_hasher
+    context = Context(config_filepath, tor_hostname)
+    # the collection only normalizes here, it never connects to the database, neither does the archive
+    model_collection = ModelCollection(context, model=Paste)
+    page_archive = PageArchive(context)
+    min_hasher = MinHasher(context.config.SIMILARITY_PERMUTATIONS, context.config.SIMILARITY_SHINGLE_SIZE)
+
+
+def parse_page(page):
+    """
+    :return: list of raw paste field value tuples
+    """
+    return [tuple(paste) for paste in Parser(context, page).extract_new_paste()]
+
+
+def parse_archived_page(digest):
+    """
+    Reads the page in the worker process, so only the digest and the pastes travel between the processes
+    :return: list of raw paste field value tuples
+    """
+    return parse_page(page_archive.load(digest))
+
+
+def compute_signatures(rows):
+    """
+    :param rows: list of (row id, text)
+    :return: list of (row id, MinHash signature)
+    """
+    return [(row_id, min_hasher.get_signature(text)) for row_id, text in rows]
+
+
+def match_watchlist(filepath, rows):
+    """
+    :param filepath: watchlist file, loaded once per process
+    :param rows: list of (paste id, text)
+    :return: list of (paste id, kind, watchlist entry, matched value)
+    """
+    if filepath not in watchlist_files:
+        watchlist_files[filepath] = WatchlistFile(filepath)
+    return watchlist_files[filepath].get().match_rows(rows)
+
+
+def normalize_pastes(raw_pastes):
+    """
+    Computes the MinHash signatures of the pastes as well, so the writer only has to add them to the similarity index
+    :return: list of normalized paste field value tuples,
+             dict of the paste fingerprints to their MinHash signatures, empty if the similarity index is disabled
+    """
+    pastes = model_collection.normalize(PasteRecord(*values) for values in raw_pastes)
+    signatures = dict()
+    if context.config.SIMILARITY_ENABLED:
+        signatures = {paste.fingerprint: min_hasher.get_signature(getattr(paste, Paste.MINHASH_FIELD)) for paste in pastes}
+    return [tuple(paste) for paste in pastes], signatures
@@ -0,0 +1,174 @@
+import base64
+import binascii
+import collections
+import hashlib
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from modules.common import Base
+from modules.metrics import Metrics
+from modules.orm import ConnectionPool, ReadOnlySharedConnection
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def encode_cursor(keyset):
+    """
+    :return: opaque URL-safe token of the Query keyset, None if there is no keyset
+    """
+    if keyset is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(keyset)).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, keys_count):
+    """
+    :param keys_count: number of the ordering keys of the query the cursor continues, the primary key included
+    :return: Query keyset the cursor holds, None if there is no cursor
+    """
+    if not cursor:
+        return None
+    try:
+        keyset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise ApiError(400, "Invalid cursor")
+    if (not isinstance(keyset, list) or len(keyset) != keys_count
+            or any(isinstance(value, bool) or not isinstance(value, (str, int, float, type(None))) for value in keyset)):
+        raise ApiError(400, "Invalid cursor")
+    return tuple(keyset)
+
+
+class ResponseCache:
+    """
+    LRU cache of the rendered responses, emptied at once when the database data version changes
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._data_version = None
+        self._lock = threading.Lock()
+
+    def _validate(self, data_version):
+        if data_version != self._data_version:
+            self._entries.clear()
+            self._data_version = data_version
+
+    def get(self, key, data_version):
+        with self._lock:
+            self._validate(data_version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, data_version, entry):
+        with self._lock:
+            self._validate(data_version)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, body, etag = self.server.api.handle(self.path)
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.api.logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ApiHttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        super().__init__(address, ApiRequestHandler)
+        self.api = api
+
+
+class JsonApi(Base):
+    """
+    Read-only HTTP/JSON API over the database
+
+    Routes are (path regular expression, handler) tuples, the handler gets the path match,
+    the query string parameters (a dict of single values) and a pooled read-only SQLiteConnection,
+    and returns the JSON serializable response.
+    Successful responses are cached until another connection commits to the database, and carry an ETag
+    the clients can revalidate them with (If-None-Match).
+    """
+    def __init__(self, context, routes):
+        super().__init__(context)
+        self.routes = [(re.compile(pattern), handler) for pattern, handler in routes]
+        self.connection_pool = ConnectionPool(context, self.context.config.API_CONNECTIONS)
+        self.cache = ResponseCache(self.context.config.API_CACHE_SIZE)
+        self.metrics = Metrics.get(context)
+        # a connection of its own: data_version only changes for the commits of the other connections
+        self._version_connection = ReadOnlySharedConnection(context)
+
+    def _render(self, path, params):
+        for pattern, handler in self.routes:
+            match = pattern.fullmatch(path)
+            if match:
+                with self.connection_pool.acquire() as connection:
+                    return handler(match, params, connection)
+        raise ApiError(404, "Not found")
+
+    def handle(self, url):
+        """
+        :return: status, body bytes, ETag or None
+        """
+        started = time.perf_counter()
+        data_version = self._version_connection.get_data_version()
+        entry = self.cache.get(url, data_version)
+        if entry is not None:
+            self.metrics.increment('api_cache_hits_total')
+        else:
+            split_url = urllib.parse.urlsplit(url)
+            params = dict(urllib.parse.parse_qsl(split_url.query))
+            try:
+                body = json.dumps(self._render(urllib.parse.unquote(split_url.path), params), ensure_ascii=False).encode('utf-8')
+                entry = (200, body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+                self.cache.put(url, data_version, entry)
+            except ApiError as e:
+                entry = (e.status, json.dumps({'error': str(e)}).encode('utf-8'), None)
+        self.metrics.increment('api_requests_total', status=entry[0])
+        self.metrics.observe('api_request_seconds', time.perf_counter() - started)
+        return entry
+
+    def close(self):
+        self.connection_pool.close()
+        self._version_connection.close()
+
+    def serve_forever(self):
+        server = ApiHttpServer((self.context.config.API_HOST, self.context.config.API_PORT), self)
+        self.logger.info("Serving the API at http://%s:%s", self.context.config.API_HOST, self.context.config.API_PORT)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.close()
@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from modules.common import Base
+
+
+class PageArchive(Base):
+    """
+    Keeps the fetched pages on disk, so the pastes can be extracted again without crawling the website
+
+    Pages are content-addressed: a page is stored once as <directory>/<digest[:2]>/<digest>.gz however many times it was fetched.
+    The index, an SQLite database in the archive directory, maps every fetch (url, page number, fetch time) to the page digest.
+    """
+    INDEX_FILENAME = 'index.sqlite'
+    TABLE_NAME = 'tbl_archived_pages'
+    PAGE_FILE_EXTENSION = '.gz'
+
+    def __init__(self, context):
+        super().__init__(context)
+        self.directory = self.context.config.ARCHIVE_DIRECTORY
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.directory, self.INDEX_FILENAME), check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode = wal").fetchall()
+            self._connection.execute("CREATE TABLE IF NOT EXISTS {} (_id integer primary key, url text, page_number integer, "
+                                     "fetched_at real, digest text, size integer)".format(self.TABLE_NAME))
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_{0}_url_fetched_at ON {0} (url, fetched_at)".format(self.TABLE_NAME))
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_{0}_fetched_at ON {0} (fetched_at)".format(self.TABLE_NAME))
+            self._connection.commit()
+        return self._connection
+
+    def get_page_filepath(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + self.PAGE_FILE_EXTENSION)
+
+    def store(self, url, page_number, page):
+        """
+        :return: page digest
+        """
+        data = page.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        filepath = self.get_page_filepath(digest)
+        if not os.path.exists(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # written aside and renamed, so a crash never leaves a truncated page behind
+            temporary_filepath = '{}.{}.{}'.format(filepath, os.getpid(), threading.get_ident())
+            with open(temporary_filepath, 'wb') as page_file:
+                page_file.write(gzip.compress(data, compresslevel=self.context.config.ARCHIVE_COMPRESSION_LEVEL, mtime=0))
+            os.replace(temporary_filepath, filepath)
+        with self._lock:
+            self.connection.execute("INSERT INTO {} (url, page_number, fetched_at, digest, size) VALUES (?, ?, ?, ?, ?)".format(self.TABLE_NAME),
+                                    (url, page_number, time.time(), digest, len(data)))
+            self.connection.commit()
+        self.logger.debug("Archived page %s as %s", url, digest)
+        return digest
+
+    def load(self, digest):
+        """
+        :return: page content
+        """
+        with open(self.get_page_filepath(digest), 'rb') as page_file:
+            return gzip.decompress(page_file.read()).decode('utf-8')
+
+    def get_archived_pages(self, since=None):
+        """
+        :param since: unix time the pages fetched earlier are left out
+        :return: list of url, page number, digest of every distinct page in the order those were first fetched
+        """
+        with self._lock:
+            # the bare columns come from the row holding the MIN() value
+            rows = self.connection.execute("SELECT url, page_number, digest, MIN(fetched_at) AS first_fetched_at FROM {} WHERE fetched_at >= ? "
+                                           "GROUP BY digest ORDER BY first_fetched_at".format(self.TABLE_NAME),
+                                           (since or 0,)).fetchall()
+        return [(url, page_number, digest) for url, page_number, digest, _ in rows]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
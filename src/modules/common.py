@@ -1,27 +1,46 @@
+import collections
 import configparser
 import logging
 import sys
 
 
+Source = collections.namedtuple('Source', ['name', 'main_url', 'page_url_prefix'])
+
+
 class Config:
     """
     Stores configuration values read from the passed ini file
+
+    The sections and options added since the first release fall back to their defaults,
+    so the configuration files written for the earlier releases keep working
     """
+    OPTIONAL_SECTIONS = ['scheduler', 'archive', 'metrics', 'api', 'similarity', 'watchlist']
+
     def __init__(self, config_filepath, **kwargs):
         self.config = configparser.ConfigParser(interpolation=None)
         self.config.read(config_filepath)
+        for section in self.OPTIONAL_SECTIONS:
+            if not self.config.has_section(section):
+                self.config.add_section(section)
         self._init_general_section()
         self._init_logging_section()
         self._init_database_section()
         self._init_tor_section()
         self._init_website_section()
+        self._init_source_sections()
         self._init_parser_section()
+        self._init_scheduler_section()
+        self._init_archive_section()
+        self._init_metrics_section()
+        self._init_api_section()
+        self._init_similarity_section()
+        self._init_watchlist_section()
         self._init_extra_parameters(kwargs)
 
     def _init_general_section(self):
         section = 'general'
         self.DEBUG = self.config[section].getboolean('debug')
-        self.RUNTIME_WINDOW_IN_HOURS = self.config[section].getint('runtime_window_in_hours')
+        self.PIPELINE_MAX_PAGES = self.config[section].getint('pipeline_max_pages', fallback=8)
 
     def _init_logging_section(self):
         section = 'logging'
@@ -36,23 +55,109 @@ class Config:
         self.DB_DT_DB_FORMAT = self.config[section].get('date_db_format')
         self.DB_UNKNOWN_AUTHOR_NAME_VARIATIONS = self.config[section].get('unknown_author_name_variations')
         self.DB_UNKNOWN_AUTHOR_DB_NAME = self.config[section].get('unknown_author_db_name')
+        self.DB_JOURNAL_MODE = self.config[section].get('journal_mode', fallback='wal')
+        self.DB_SYNCHRONOUS = self.config[section].get('synchronous', fallback='normal')
+        self.DB_CACHE_SIZE = self.config[section].getint('cache_size', fallback=-16000)
+        self.DB_MMAP_SIZE = self.config[section].getint('mmap_size', fallback=268435456)
+        self.DB_TEMP_STORE = self.config[section].get('temp_store', fallback='memory')
+        self.DB_BUSY_TIMEOUT = self.config[section].getint('busy_timeout', fallback=60000)
+        self.DB_GROUP_COMMIT_SIZE = self.config[section].getint('group_commit_size', fallback=5)
+        self.DB_GROUP_COMMIT_MAX_LATENCY = self.config[section].getint('group_commit_max_latency', fallback=30)
+        self.DB_COMPRESSION_LEVEL = self.config[section].getint('compression_level', fallback=6)
+        self.DB_COMPRESSION_DICTIONARY_SIZE = self.config[section].getint('compression_dictionary_size', fallback=32768)
+        self.DB_COMPRESSION_DICTIONARY_SAMPLES = self.config[section].getint('compression_dictionary_samples', fallback=2000)
 
     def _init_tor_section(self):
         section = 'tor'
         self.TOR_HTTP_PROXY_PORT = self.config[section].get('http_proxy_port')
         self.TOR_HTTPS_PROXY_PORT = self.config[section].get('https_proxy_port')
+        self.TOR_ENDPOINTS = [endpoint.strip() for endpoint in self.config[section].get('endpoints', fallback='').split(',') if endpoint.strip()]
+        self.TOR_MAX_CONSECUTIVE_FAILURES = self.config[section].getint('max_consecutive_failures', fallback=3)
+        self.TOR_MAX_ERROR_RATE = self.config[section].getfloat('max_error_rate', fallback=0.5)
+        self.TOR_EJECTION_TIMEOUT = self.config[section].getfloat('ejection_timeout', fallback=30)
 
     def _init_website_section(self):
         section = 'website'
+        self.WEB_SOURCE_NAME = self.config[section].get('source', fallback='stronghold')
         self.WEB_MAIN_URL = self.config[section].get('main_url')
         self.WEB_PAGE_URL_PREFIX = self.config[section].get('page_url_prefix')
         self.WEB_REQUEST_TIMEOUT = self.config[section].getint('request_timeout')
         self.WEB_MAX_RETRIES = self.config[section].getint('max_retries')
-        self.WEB_RETRY_TIMEOUT = self.config[section].getint('retry_timeout')
+        self.WEB_RETRY_TIMEOUT = self.config[section].getfloat('retry_timeout')
+        self.WEB_RETRY_MAX_TIMEOUT = self.config[section].getfloat('retry_max_timeout', fallback=30)
+        self.WEB_RETRY_BUDGET_RATIO = self.config[section].getfloat('retry_budget_ratio', fallback=0.2)
+        self.WEB_RETRY_BUDGET_MIN = self.config[section].getint('retry_budget_min', fallback=10)
+        self.WEB_HEDGE_PERCENTILE = self.config[section].getfloat('hedge_percentile', fallback=95)
+        self.WEB_HEDGE_MIN_DELAY = self.config[section].getfloat('hedge_min_delay', fallback=1)
+        self.WEB_MAX_PAGES_IN_FLIGHT = self.config[section].getint('max_pages_in_flight', fallback=4)
+        self.WEB_POOL_CONNECTIONS = self.config[section].getint('pool_connections', fallback=2)
+        self.WEB_POOL_MAXSIZE = self.config[section].getint('pool_maxsize', fallback=4)
+        self.WEB_SESSION_IDLE_TIMEOUT = self.config[section].getint('session_idle_timeout', fallback=300)
+
+    def _init_source_sections(self):
+        """
+        The [website] source comes first, followed by a source per [source:<name>] section, e.g. the mirrors
+        """
+        self.WEB_SOURCES = [Source(self.WEB_SOURCE_NAME, self.WEB_MAIN_URL, self.WEB_PAGE_URL_PREFIX)]
+        for section in self.config.sections():
+            if section.startswith('source:'):
+                source = Source(section[len('source:'):], self.config[section].get('main_url'), self.config[section].get('page_url_prefix'))
+                if not source.name or not source.main_url or not source.page_url_prefix:
+                    raise ValueError("Section [{}] needs a source name and both the main_url and page_url_prefix options".format(section))
+                if source.name in (known_source.name for known_source in self.WEB_SOURCES):
+                    raise ValueError("Section [{}] repeats the name of another source".format(section))
+                self.WEB_SOURCES.append(source)
 
     def _init_parser_section(self):
         section = 'parser'
         self.PARSER_ENGINE = self.config[section].get('engine')
+        self.PARSER_WORKERS = self.config[section].getint('workers', fallback=2)
+
+    def _init_scheduler_section(self):
+        section = 'scheduler'
+        # the fixed [general] runtime_window_in_hours of the first releases stands for both interval limits
+        window_in_hours = self.config['general'].getint('runtime_window_in_hours')
+        self.SCHEDULER_MIN_INTERVAL_MINUTES = self.config[section].getint('min_interval_minutes', fallback=window_in_hours * 60 if window_in_hours else 15)
+        self.SCHEDULER_MAX_INTERVAL_MINUTES = self.config[section].getint('max_interval_minutes', fallback=window_in_hours * 60 if window_in_hours else 240)
+        self.SCHEDULER_TARGET_NEW_PASTES = self.config[section].getint('target_new_pastes', fallback=25)
+        self.SCHEDULER_RATE_SMOOTHING = self.config[section].getfloat('rate_smoothing', fallback=0.5)
+
+    def _init_archive_section(self):
+        section = 'archive'
+        self.ARCHIVE_ENABLED = self.config[section].getboolean('enabled', fallback=False)
+        self.ARCHIVE_DIRECTORY = self.config[section].get('directory', fallback='../data/archive')
+        self.ARCHIVE_COMPRESSION_LEVEL = self.config[section].getint('compression_level', fallback=6)
+
+    def _init_metrics_section(self):
+        section = 'metrics'
+        self.METRICS_HTTP_HOST = self.config[section].get('http_host', fallback='127.0.0.1')
+        self.METRICS_HTTP_PORT = self.config[section].getint('http_port', fallback=0)
+        self.METRICS_STATS_FILEPATH = self.config[section].get('stats_filepath', fallback='')
+        self.METRICS_STATS_INTERVAL = self.config[section].getint('stats_interval', fallback=60)
+
+    def _init_api_section(self):
+        section = 'api'
+        self.API_HOST = self.config[section].get('host', fallback='127.0.0.1')
+        self.API_PORT = self.config[section].getint('port', fallback=8081)
+        self.API_CONNECTIONS = self.config[section].getint('connections', fallback=4)
+        self.API_CACHE_SIZE = self.config[section].getint('cache_size', fallback=256)
+        self.API_PAGE_SIZE = self.config[section].getint('page_size', fallback=50)
+        self.API_MAX_PAGE_SIZE = self.config[section].getint('max_page_size', fallback=500)
+
+    def _init_similarity_section(self):
+        section = 'similarity'
+        self.SIMILARITY_ENABLED = self.config[section].getboolean('enabled', fallback=False)
+        self.SIMILARITY_PERMUTATIONS = self.config[section].getint('permutations', fallback=128)
+        self.SIMILARITY_BANDS = self.config[section].getint('bands', fallback=16)
+        self.SIMILARITY_SHINGLE_SIZE = self.config[section].getint('shingle_size', fallback=3)
+        self.SIMILARITY_THRESHOLD = self.config[section].getfloat('threshold', fallback=0.8)
+        self.SIMILARITY_MAX_CANDIDATES = self.config[section].getint('max_candidates', fallback=100)
+        self.SIMILARITY_CHUNK_SIZE = self.config[section].getint('chunk_size', fallback=500)
+
+    def _init_watchlist_section(self):
+        section = 'watchlist'
+        self.WATCHLIST_FILEPATH = self.config[section].get('filepath', fallback='')
+        self.WATCHLIST_CHUNK_SIZE = self.config[section].getint('chunk_size', fallback=500)
 
     def _init_extra_parameters(self, kwargs):
         for param_name, param_value in kwargs.items():
@@ -80,6 +185,8 @@ class Context:
     Context to store common properties and methods
     """
     def __init__(self, config_filepath, tor_hostname):
+        self.config_filepath = config_filepath
+        self.tor_hostname = tor_hostname
         self.config = Config(config_filepath,
                              TOR_HOSTNAME=tor_hostname)
         self._logger_instance = Logger(format=self.config.LOGGING_OUTPUT_FORMAT,
@@ -0,0 +1,122 @@
+import collections
+import sqlite3
+import struct
+import zlib
+
+from modules.common import Base
+
+
+class Compressor(Base):
+    """
+    Compresses field values with zlib, using a preset dictionary trained on the stored data when there is one
+
+    Compressed values are stored as blobs starting with a marker byte:
+        RAW_MARKER, zlib stream
+        DICTIONARY_MARKER, 4-byte dictionary id, zlib stream compressed with that dictionary
+    Values which are not bytes (text stored before compression was enabled, None) are passed through as they are
+    """
+    TABLE_NAME = 'tbl_compression_dictionaries'
+    RAW_MARKER = b'\x00'
+    DICTIONARY_MARKER = b'\x01'
+    DICTIONARY_ID_FORMAT = '>I'
+    MIN_DICTIONARY_LINE_LENGTH = 8
+
+    def __init__(self, context, shared_connection):
+        """
+        :param shared_connection: SharedConnection of the database the dictionaries are stored in
+        """
+        super().__init__(context)
+        self.shared_connection = shared_connection
+        self._dictionaries = None
+        self._current_dictionary_id = None
+
+    def _load_dictionaries(self):
+        self._dictionaries = dict()
+        self._current_dictionary_id = None
+        try:
+            with self.shared_connection.lock:
+                rows = self.shared_connection.connection.execute("SELECT {id_field}, dictionary "
+                                                                 "FROM {table} "
+                                                                 "ORDER BY {id_field}".format(id_field=self.context.config.DB_ID_FIELD,
+                                                                                              table=self.TABLE_NAME)).fetchall()
+        except sqlite3.OperationalError:
+            # the dictionaries table is created along with the first trained dictionary
+            return
+        for dictionary_id, dictionary in rows:
+            self._dictionaries[dictionary_id] = bytes(dictionary)
+            self._current_dictionary_id = dictionary_id
+
+    @property
+    def dictionaries(self):
+        if self._dictionaries is None:
+            self._load_dictionaries()
+        return self._dictionaries
+
+    @property
+    def current_dictionary_id(self):
+        if self._dictionaries is None:
+            self._load_dictionaries()
+        return self._current_dictionary_id
+
+    def compress(self, value):
+        if value is None:
+            return None
+        data = value.encode('utf-8')
+        dictionary_id = self.current_dictionary_id
+        if dictionary_id is None:
+            compressor = zlib.compressobj(self.context.config.DB_COMPRESSION_LEVEL)
+            header = self.RAW_MARKER
+        else:
+            compressor = zlib.compressobj(self.context.config.DB_COMPRESSION_LEVEL, zdict=self.dictionaries[dictionary_id])
+            header = self.DICTIONARY_MARKER + struct.pack(self.DICTIONARY_ID_FORMAT, dictionary_id)
+        return header + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, value):
+        if not isinstance(value, bytes):
+            return value
+        marker = value[:1]
+        if marker == self.RAW_MARKER:
+            return zlib.decompress(value[1:]).decode('utf-8')
+        if marker != self.DICTIONARY_MARKER:
+            raise ValueError("Unknown compressed value marker: {!r}".format(marker))
+
+        dictionary_id, = struct.unpack(self.DICTIONARY_ID_FORMAT, value[1:5])
+        if dictionary_id not in self.dictionaries:
+            self._load_dictionaries()
+        decompressor = zlib.decompressobj(zdict=self.dictionaries[dictionary_id])
+        return (decompressor.decompress(value[5:]) + decompressor.flush()).decode('utf-8')
+
+    def train_dictionary(self, samples):
+        """
+        Builds a preset dictionary out of the lines shared by several samples,
+        the most valuable ones placed at the end where zlib finds them at the shortest distance
+        :param samples: iterable of text values
+        :return: dictionary bytes, empty if the samples have nothing in common
+        """
+        line_counts = collections.Counter()
+        for sample in samples:
+            line_counts.update(set(line.strip() for line in sample.splitlines() if len(line.strip()) >= self.MIN_DICTIONARY_LINE_LENGTH))
+        common_lines = sorted((count * len(line), line) for line, count in line_counts.items() if count > 1)
+
+        dictionary_parts = list()
+        dictionary_size = 0
+        for _, line in reversed(common_lines):
+            line_bytes = line.encode('utf-8') + b'\n'
+            if dictionary_size + len(line_bytes) > self.context.config.DB_COMPRESSION_DICTIONARY_SIZE:
+                continue
+            dictionary_parts.append(line_bytes)
+            dictionary_size += len(line_bytes)
+        return b''.join(reversed(dictionary_parts))
+
+    def store_dictionary(self, dictionary):
+        """
+        Stores the dictionary as the one used for compressing the new values
+        :return: dictionary id
+        """
+        with self.shared_connection.lock:
+            connection = self.shared_connection.connection
+            connection.execute("CREATE TABLE IF NOT EXISTS {} ({} integer primary key, dictionary blob)".format(self.TABLE_NAME, self.context.config.DB_ID_FIELD))
+            cursor = connection.execute("INSERT INTO {} (dictionary) VALUES (?)".format(self.TABLE_NAME), (dictionary,))
+            self.shared_connection.commit()
+            self._load_dictionaries()
+        return cursor.lastrowid
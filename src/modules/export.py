@@ -0,0 +1,165 @@
+import csv
+import datetime
+import json
+import os
+import sys
+
+from modules.common import Base
+
+
+class ExportWriter:
+    """
+    Writes the exported rows chunk by chunk, keeping no more than a single chunk in memory
+    """
+    FORMAT = None
+
+    def __init__(self, filepath, fields, date_format=None):
+        """
+        :param fields: list of (column name, model field type) tuples
+        :param date_format: format the date field values are stored in
+        """
+        self.filepath = filepath
+        self.fields = fields
+        self.columns = [column for column, _ in fields]
+        self.date_format = date_format
+
+    def write_chunk(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TextExportWriter(ExportWriter):
+    """
+    Writes to the file or to the standard output if the filepath is -
+    """
+    def __init__(self, filepath, fields, date_format=None):
+        super().__init__(filepath, fields, date_format)
+        self.file = sys.stdout if filepath == '-' else open(filepath, 'w', newline='', encoding='utf-8')
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class JsonLinesExportWriter(TextExportWriter):
+    FORMAT = 'jsonl'
+
+    def write_chunk(self, rows):
+        self.file.write(''.join(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n' for row in rows))
+
+
+class CsvExportWriter(TextExportWriter):
+    FORMAT = 'csv'
+
+    def __init__(self, filepath, fields, date_format=None):
+        super().__init__(filepath, fields, date_format)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write_chunk(self, rows):
+        self.writer.writerows(rows)
+
+
+class ArrowExportWriter(ExportWriter):
+    """
+    Writes every chunk as an Arrow record batch, pyarrow is an optional dependency needed by the columnar formats only.
+    The columns are typed after the model fields, the dates become timestamps.
+    """
+    FORMAT = 'arrow'
+
+    def __init__(self, filepath, fields, date_format=None):
+        super().__init__(filepath, fields, date_format)
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("pyarrow is required for the {} format: pip install pyarrow".format(self.FORMAT))
+        self.pyarrow = pyarrow
+        arrow_types = {'integer': pyarrow.int64(),
+                       'string': pyarrow.string(),
+                       'compressed_string': pyarrow.string(),
+                       'date': pyarrow.timestamp('s')}
+        self.schema = pyarrow.schema([(column, arrow_types[field_type]) for column, field_type in fields])
+        self.writer = self._create_writer()
+
+    def _create_writer(self):
+        return self.pyarrow.ipc.new_file(self.filepath, self.schema)
+
+    def _convert(self, value, field_type):
+        if field_type == 'date' and value is not None:
+            return datetime.datetime.strptime(value, self.date_format)
+        return value
+
+    def write_chunk(self, rows):
+        arrays = [self.pyarrow.array([self._convert(row[position], field_type) for row in rows], type=field.type)
+                  for position, (field, (_, field_type)) in enumerate(zip(self.schema, self.fields))]
+        self.writer.write_batch(self.pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetExportWriter(ArrowExportWriter):
+    FORMAT = 'parquet'
+
+    def _create_writer(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(self.filepath, self.schema, compression='zstd')
+
+
+class Exporter(Base):
+    """
+    Streams the rows of a model table into a file in one of the FORMATS
+
+    Rows are exported in the primary key order, so the greatest exported primary key is a watermark
+    an incremental export can continue from. The watermark file keeps it between the runs.
+    """
+    FORMATS = {writer_class.FORMAT: writer_class for writer_class in [JsonLinesExportWriter, CsvExportWriter, ArrowExportWriter, ParquetExportWriter]}
+
+    def __init__(self, context, model_collection):
+        super().__init__(context)
+        self.model_collection = model_collection
+
+    @staticmethod
+    def read_watermark(filepath):
+        """
+        :return: primary key stored in the watermark file, None if there is no file yet
+        """
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath) as watermark_file:
+            content = watermark_file.read().strip()
+        return int(content) if content else None
+
+    @staticmethod
+    def write_watermark(filepath, pk):
+        temporary_filepath = '{}.{}'.format(filepath, os.getpid())
+        with open(temporary_filepath, 'w') as watermark_file:
+            watermark_file.write('{}\n'.format(pk))
+        os.replace(temporary_filepath, filepath)
+
+    def export(self, filepath, export_format, after_pk=None, since=None, chunk_size=None):
+        """
+        :param filepath: output filepath, - for the standard output (text formats only)
+        :param export_format: one of the FORMATS keys
+        :param after_pk: export only the rows with a greater primary key
+        :param since: export only the rows with the model ORDER_BY value greater than or equal to it
+        :return: number of exported rows, greatest exported primary key (after_pk if nothing was exported)
+        """
+        model = self.model_collection.model
+        fields = [(model.ID_KEYWORD, 'integer')] + list(model.FIELDS)
+        writer = self.FORMATS[export_format](filepath, fields, date_format=self.context.config.DB_DT_DB_FORMAT)
+        exported_rows, last_pk = 0, after_pk
+        try:
+            for chunk in self.model_collection.iterate_chunks(after_pk=after_pk, since=since, chunk_size=chunk_size):
+                writer.write_chunk([(getattr(record, model.ID_KEYWORD),) + tuple(record) for record in chunk])
+                exported_rows += len(chunk)
+                last_pk = getattr(chunk[-1], model.ID_KEYWORD)
+                self.logger.debug("Exported %s rows", exported_rows)
+        finally:
+            writer.close()
+        self.logger.info("Exported %s row%s of %s to %s", exported_rows, 's' if exported_rows != 1 else '', model.get_table_name(), filepath)
+        return exported_rows, last_pk
@@ -0,0 +1,204 @@
+import contextlib
+import http.server
+import os
+import socketserver
+import threading
+import time
+
+from modules.common import Base
+
+
+class Metrics(Base):
+    """
+    Counters and latency histograms of a single process, rendered in the Prometheus text exposition format
+
+    Metrics are identified by a name and a set of labels, e.g. increment('requests_total', status=200).
+    The instrumented modules get the process-wide instance with Metrics.get(context).
+    """
+    PREFIX = 'scraper_'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    DESCRIPTIONS = {'requests_total': "HTTP requests sent, by response status",
+                    'request_seconds': "HTTP request latency",
+                    'request_retries_total': "HTTP requests retried after an error",
+                    'request_hedges_total': "Hedged HTTP requests sent after a slow response",
+                    'page_seconds': "Page download latency, hedged requests and retries included",
+                    'endpoint_request_seconds': "HTTP request latency, by SOCKS endpoint",
+                    'endpoint_ejections_total': "SOCKS endpoints taken out of rotation, by endpoint",
+                    'fetched_bytes_total': "Response body bytes received",
+                    'stage_seconds': "Pipeline stage latency per page",
+                    'stage_items_total': "Pages handled by a pipeline stage",
+                    'stage_failures_total': "Pages a pipeline stage failed on",
+                    'pastes_extracted_total': "Pastes extracted from the crawled pages",
+                    'store_seconds': "Latency of a single store() call",
+                    'stored_rows_total': "Rows inserted by store()",
+                    'commit_seconds': "SQLite commit latency",
+                    'similarity_index_seconds': "Time spent adding the stored pastes of a page to the similarity index",
+                    'watchlist_seconds': "Time spent matching the watchlist against the stored pastes of a page",
+                    'watchlist_hits_total': "Watchlist entries found in the stored pastes, by kind",
+                    'crawl_seconds': "Duration of a whole crawl",
+                    'crawls_total': "Crawls run, by outcome",
+                    'source_crawls_total': "Crawls of a single source, by source and outcome",
+                    'api_requests_total': "API requests served, by response status",
+                    'api_request_seconds': "API request latency",
+                    'api_cache_hits_total': "API responses served from the cache"}
+    _instances = dict()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, context):
+        super().__init__(context)
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+
+    @classmethod
+    def get(cls, context):
+        pid = os.getpid()
+        with cls._instances_lock:
+            if pid not in cls._instances:
+                cls._instances[pid] = cls(context)
+            return cls._instances[pid]
+
+    @staticmethod
+    def _get_key(name, labels):
+        # label values are rendered as strings anyway, and mixed types would not sort, e.g. status=200 and status='error'
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._get_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a value to the histogram, the buckets are kept cumulative like Prometheus expects
+        """
+        key = self._get_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(labels, extra_labels=()):
+        labels = list(labels) + list(extra_labels)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels) + '}'
+
+    def _describe(self, lines, name, metric_type):
+        lines.append('# HELP {}{} {}'.format(self.PREFIX, name, self.DESCRIPTIONS.get(name, name)))
+        lines.append('# TYPE {}{} {}'.format(self.PREFIX, name, metric_type))
+
+    def render(self):
+        """
+        :return: metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in self._histograms.items())
+        lines = list()
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                self._describe(lines, name, 'counter')
+                described.add(name)
+            lines.append('{}{}{} {}'.format(self.PREFIX, name, self._format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in described:
+                self._describe(lines, name, 'histogram')
+                described.add(name)
+            for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                lines.append('{}{}_bucket{} {}'.format(self.PREFIX, name, self._format_labels(labels, [('le', bound)]), count))
+            lines.append('{}{}_bucket{} {}'.format(self.PREFIX, name, self._format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{}{}_sum{} {:.6f}'.format(self.PREFIX, name, self._format_labels(labels), histogram['sum']))
+            lines.append('{}{}_count{} {}'.format(self.PREFIX, name, self._format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        super().__init__(address, MetricsRequestHandler)
+        self.metrics = metrics
+
+
+class MetricsExporter(Base):
+    """
+    Exposes the process metrics as configured in the [metrics] section:
+        http_port: serves them at http://<http_host>:<http_port>/metrics, 0 disables the endpoint
+        stats_filepath: rewrites the file every stats_interval seconds (a node_exporter textfile collector can pick it up),
+                        empty disables the file
+    """
+    def __init__(self, context):
+        super().__init__(context)
+        self.metrics = Metrics.get(context)
+        self._server = None
+        self._stop_event = threading.Event()
+        self._writer_thread = None
+
+    def start(self):
+        config = self.context.config
+        if config.METRICS_HTTP_PORT:
+            self._server = MetricsServer((config.METRICS_HTTP_HOST, config.METRICS_HTTP_PORT), self.metrics)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            self.logger.info("Serving metrics at http://%s:%s/metrics", config.METRICS_HTTP_HOST, config.METRICS_HTTP_PORT)
+        if config.METRICS_STATS_FILEPATH:
+            self._writer_thread = threading.Thread(target=self._write_periodically, daemon=True)
+            self._writer_thread.start()
+            self.logger.info("Writing metrics to %s every %s seconds", config.METRICS_STATS_FILEPATH, config.METRICS_STATS_INTERVAL)
+        return self
+
+    def _write_periodically(self):
+        while not self._stop_event.wait(self.context.config.METRICS_STATS_INTERVAL):
+            self.write_stats_file()
+
+    def write_stats_file(self):
+        filepath = self.context.config.METRICS_STATS_FILEPATH
+        if not filepath:
+            return
+        # replaced at once, so the readers never see a partially written file
+        temporary_filepath = '{}.{}'.format(filepath, os.getpid())
+        try:
+            with open(temporary_filepath, 'w') as stats_file:
+                stats_file.write(self.metrics.render())
+            os.replace(temporary_filepath, filepath)
+        except OSError as e:
+            self.logger.error("Error when writing the metrics to %s: %s", filepath, e)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.write_stats_file()
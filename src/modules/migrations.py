@@ -0,0 +1,41 @@
+from modules.common import Base
+from modules.orm import SQLiteConnection
+
+
+class MigrationRunner(Base):
+    """
+    Brings an existing or a new database up to date in place
+
+    First creates the missing model tables and adds the missing columns and indexes declared by the models,
+    then runs the versioned migrations newer than the database version kept in the user_version pragma.
+    Migrations are (version, description, function) tuples, the function being called with the context
+    and the database connection.
+    """
+    def __init__(self, context, models, migrations):
+        super().__init__(context)
+        self.models = models
+        self.migrations = sorted(migrations, key=lambda migration: migration[0])
+        self.connection = SQLiteConnection(context)
+
+    def get_database_version(self):
+        return self.connection.execute_fetch_single_value("PRAGMA user_version")
+
+    def _set_database_version(self, version):
+        self.connection.execute("PRAGMA user_version = {:d}".format(version), commit=True)
+
+    def run(self):
+        for model in self.models:
+            self.logger.info("Creating or upgrading table for %s", model.__name__)
+            model.create_table_if_necessary(self.context)
+
+        database_version = self.get_database_version()
+        self.logger.info("Database version: %s", database_version)
+        for version, description, migration in self.migrations:
+            if version <= database_version:
+                continue
+            self.logger.info("Applying migration #%s: %s", version, description)
+            migration(self.context, self.connection)
+            self.connection.shared_connection.commit()
+            self._set_database_version(version)
+        self.logger.info("Database is up to date at version %s", self.get_database_version())
+        self.connection.close()
@@ -1,23 +1,198 @@
+import atexit
+import contextlib
+import os
+import queue
 import sqlite3
+import threading
+import time
 
 from modules.common import Base
+from modules.compression import Compressor
+from modules.metrics import Metrics
+
+
+class SharedConnection(Base):
+    """
+    A single SQLite connection per database file and process, set up with the [database] performance profile
+
+    Supports group commit: commits requested through request_commit() are deferred until
+    DB_GROUP_COMMIT_SIZE of them are pending or DB_GROUP_COMMIT_MAX_LATENCY seconds passed since the first one
+
+    Registers the decompress() SQL function decoding the compressed_string field values
+    """
+    _instances = dict()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, context):
+        super().__init__(context)
+        self.lock = threading.RLock()
+        self.connection = self._connect()
+        self._pending_commits = 0
+        self._flush_timer = None
+        self.compressor = Compressor(context, self)
+        self.metrics = Metrics.get(context)
+        self.connection.create_function('decompress', 1, self.compressor.decompress, deterministic=True)
+        self._apply_profile()
+
+    @classmethod
+    def get(cls, context):
+        key = (os.getpid(), context.config.DB_FILEPATH)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(context)
+            return cls._instances[key]
+
+    @classmethod
+    def close_all(cls):
+        with cls._instances_lock:
+            for key, instance in list(cls._instances.items()):
+                if key[0] == os.getpid():
+                    instance.close()
+                del cls._instances[key]
+
+    def _connect(self):
+        return sqlite3.connect(self.context.config.DB_FILEPATH, check_same_thread=False)
+
+    def _get_profile(self):
+        config = self.context.config
+        return [('journal_mode', config.DB_JOURNAL_MODE),
+                ('synchronous', config.DB_SYNCHRONOUS),
+                ('cache_size', config.DB_CACHE_SIZE),
+                ('mmap_size', config.DB_MMAP_SIZE),
+                ('temp_store', config.DB_TEMP_STORE),
+                ('busy_timeout', config.DB_BUSY_TIMEOUT)]
+
+    def _apply_profile(self):
+        pragmas = self._get_profile()
+        for pragma, value in pragmas:
+            if value is None:
+                continue
+            self.connection.execute("PRAGMA {} = {}".format(pragma, value)).fetchall()
+        self.logger.debug("Connected to %s with %s", self.context.config.DB_FILEPATH,
+                          ', '.join('{}={}'.format(pragma, value) for pragma, value in pragmas if value is not None))
+
+    def commit(self):
+        with self.lock:
+            self._cancel_flush_timer()
+            self._pending_commits = 0
+            with self.metrics.timer('commit_seconds'):
+                self.connection.commit()
+
+    def request_commit(self):
+        """
+        Commits now or later depending on the group commit settings
+        """
+        with self.lock:
+            self._pending_commits += 1
+            if self._pending_commits >= self.context.config.DB_GROUP_COMMIT_SIZE:
+                self.logger.debug("Committing %s grouped transaction%s", self._pending_commits, 's' if self._pending_commits > 1 else '')
+                self.commit()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.context.config.DB_GROUP_COMMIT_MAX_LATENCY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        """
+        Commits the pending grouped transactions if there are any
+        """
+        with self.lock:
+            if self._pending_commits:
+                self.logger.debug("Flushing %s grouped transaction%s", self._pending_commits, 's' if self._pending_commits > 1 else '')
+                self.commit()
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.connection.close()
+
+
+atexit.register(SharedConnection.close_all)
+
+
+class ReadOnlySharedConnection(SharedConnection):
+    """
+    A read-only connection of its own, never taking the write lock, so the readers do not block the writer process.
+    In the WAL journal mode the readers see the last committed snapshot while the writer goes on.
+    """
+    def _connect(self):
+        return sqlite3.connect('file:{}?mode=ro'.format(self.context.config.DB_FILEPATH), uri=True, check_same_thread=False)
+
+    def _get_profile(self):
+        config = self.context.config
+        # the journal mode is the database property the writer has set
+        return [('query_only', 1),
+                ('cache_size', config.DB_CACHE_SIZE),
+                ('mmap_size', config.DB_MMAP_SIZE),
+                ('temp_store', config.DB_TEMP_STORE),
+                ('busy_timeout', config.DB_BUSY_TIMEOUT)]
+
+    def get_data_version(self):
+        """
+        :return: number changing whenever another connection commits to the database
+        """
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+
+class ConnectionPool(Base):
+    """
+    A fixed number of ReadOnlySharedConnection instances handed out to one thread at a time:
+        with pool.acquire() as connection:
+            ModelCollection(context, model, connection=connection).query()...
+    """
+    def __init__(self, context, size):
+        super().__init__(context)
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(ReadOnlySharedConnection(context))
+
+    @contextlib.contextmanager
+    def acquire(self):
+        shared_connection = self._connections.get()
+        try:
+            yield SQLiteConnection(self.context, shared_connection=shared_connection)
+        finally:
+            self._connections.put(shared_connection)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get().connection.close()
 
 
 class SQLiteConnection(Base):
     """
     General class to connect to and query an SQLite database
+
+    All the instances within a process share a single connection,
+    closing an instance releases its reference only
     """
-    def __init__(self, context):
+    PLACEHOLDER = '?'
+
+    def __init__(self, context, shared_connection=None):
+        """
+        :param shared_connection: connection to use instead of the process-wide one, e.g. a pooled read-only one
+        """
         super().__init__(context)
-        self._connection = None
+        self._shared_connection = shared_connection
+
+    @property
+    def shared_connection(self):
+        if self._shared_connection is None:
+            self._shared_connection = SharedConnection.get(self.context)
+        return self._shared_connection
 
     @property
     def connection(self):
-        if self._connection is None:
-            self._connection = sqlite3.connect(self.context.config.DB_FILEPATH)
-        return self._connection
+        return self.shared_connection.connection
 
-    def execute(self, query, params=None, many=False, commit=False, close=False):
+    def _execute(self, query, params, many):
+        # the caller holds the shared connection lock
         cursor = self.connection.cursor()
         execute_function = cursor.executemany if many else cursor.execute
 
@@ -27,34 +202,90 @@ class SQLiteConnection(Base):
         else:
             params = tuple()
         execute_function(query, params)
+        return cursor
 
-        if commit:
-            self.connection.commit()
+    def execute(self, query, params=None, many=False, commit=False, close=False):
+        """
+        Meant for the statements changing the database, the returned cursor holds their rowcount and lastrowid.
+        Rows are read with the execute_fetch_* methods: the connection is shared between the threads,
+        so they have to be fetched before the lock is released.
+        """
+        with self.shared_connection.lock:
+            cursor = self._execute(query, params, many)
+            if commit:
+                self.shared_connection.commit()
         if close:
             self.close()
 
         return cursor
 
+    def execute_fetch_all(self, query, params=None):
+        with self.shared_connection.lock:
+            cursor = self._execute(query, params, many=False)
+            result = cursor.fetchall()
+            cursor.close()
+        return result
+
     def execute_fetch_one_record(self, query, params=None):
-        cursor = self.execute(query, params)
-        result = cursor.fetchone()
-        cursor.close()
+        with self.shared_connection.lock:
+            cursor = self._execute(query, params, many=False)
+            result = cursor.fetchone()
+            cursor.close()
         return result
 
     def execute_fetch_single_value(self, query, params=None):
-        cursor = self.execute(query, params)
-        result = cursor.fetchone()
-        cursor.close()
+        result = self.execute_fetch_one_record(query, params)
         return None if not result else result[0]
 
+    def request_commit(self):
+        self.shared_connection.request_commit()
+
+    def flush(self):
+        self.shared_connection.flush()
+
+    @property
+    def compressor(self):
+        return self.shared_connection.compressor
+
     @property
     def placeholder(self):
-        return '?'
+        return self.PLACEHOLDER
 
     def close(self):
-        if self._connection:
-            self._connection.close()
-            self._connection = None
+        self._shared_connection = None
+
+
+class Record:
+    """
+    Lightweight container of a single table row in transit between the parser and the storage.
+
+    Model.get_record_class() creates a slotted subclass holding the fields of the model,
+    so no database connection, logger or normalization machinery is set up per row.
+    Records read from the database also hold the primary key, it is not one of the FIELD_NAMES
+    the record is iterated and compared over.
+    """
+    __slots__ = ()
+    FIELD_NAMES = ()
+    MODEL = None
+
+    def __init__(self, *args, **kwargs):
+        for field_name, field_value in zip(self.FIELD_NAMES, args):
+            setattr(self, field_name, field_value)
+        for field_name in self.FIELD_NAMES[len(args):]:
+            setattr(self, field_name, kwargs.get(field_name))
+        setattr(self, self.MODEL.ID_KEYWORD, kwargs.get(self.MODEL.ID_KEYWORD))
+
+    def __iter__(self):
+        return (getattr(self, field_name) for field_name in self.FIELD_NAMES)
+
+    def __eq__(self, other):
+        for field_name in self.FIELD_NAMES:
+            if getattr(self, field_name) != getattr(other, field_name):
+                return False
+        return True
+
+    def __str__(self):
+        return ", ".join("{}: {}".format(column, getattr(self, column)) for column in self.MODEL.STR_FIELDS or self.FIELD_NAMES)
 
 
 class Model(Base):
@@ -66,13 +297,45 @@ class Model(Base):
     starting with __property__ and __method__ respectively.
 
     Every method with its name prefixed with __normalize__ will be run
-    each time save() is called.
+    for each newly created model instance and for each record passed to normalize_records().
+    Normalization methods receive the model instance or the record to normalize as their only argument
+    and run in the FIELDS order of their name suffixes.
+
+    INDEXES lists the table indexes as (list of field names, index type) tuples,
+    where the index type is either 'index' or 'unique'.
+    If the model declares a unique index, ModelCollection.store() silently skips
+    the rows duplicating an already stored value.
+
+    FULL_TEXT_FIELDS lists the fields indexed by an FTS5 table kept in sync by triggers,
+    or by the ORM writes if any of the fields is compressed, see ModelCollection.search().
+
+    SQL statements are built once per model class by get_statement() and take every value,
+    the primary key included, as a parameter, so sqlite3 reuses its prepared statements.
+
+    Field types:
+        string: text
+        integer: integer
+        date: date
+        compressed_string: text stored compressed (see modules.compression),
+                           decompressed transparently whenever the ORM reads it
 
     Stored names for public access:
         create_table_if_necessary
         delete
+        from_database_values
+        get_compressed_fields
+        get_full_text_index_statement
+        get_full_text_table_name
+        get_index_name
+        get_normalization_pipeline
+        get_record_class
+        get_statement
         get_table_name
+        has_unique_index
+        normalize_records
+        rebuild_full_text_index
         save
+        to_database_values
 
     Other stored names:
         pk: for primary key
@@ -80,6 +343,21 @@ class Model(Base):
     NORMALIZATION_PREFIX = '__normalize__'
     ID_KEYWORD = 'pk'
     ORDER_BY = None
+    STR_FIELDS = None
+    INDEXES = []
+    INDEX_TYPES = {'index': ('idx', 'INDEX'),
+                   'unique': ('uidx', 'UNIQUE INDEX')}
+    FULL_TEXT_FIELDS = []
+    RECORD_CLASS = None
+    NORMALIZATION_PIPELINE = None
+    STATEMENTS = None
+    STATEMENT_TEMPLATES = {'insert': "INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                           'insert_or_ignore': "INSERT OR IGNORE INTO {table} ({columns}) VALUES ({placeholders})",
+                           'upsert': "INSERT INTO {table} ({columns}) VALUES ({placeholders}) "
+                                     "ON CONFLICT ({conflict_columns}) DO UPDATE SET {excluded_assignments}",
+                           'select': "SELECT {columns} FROM {table} WHERE {id_field}={placeholder}",
+                           'update': "UPDATE {table} SET {assignments} WHERE {id_field}={placeholder}",
+                           'delete': "DELETE FROM {table} WHERE {id_field}={placeholder}"}
 
     def __init__(self, context, **kwargs):
         super().__init__(context)
@@ -99,7 +377,7 @@ class Model(Base):
         return True
 
     def __str__(self):
-        return ", ".join("{}: {}".format(column, getattr(self, column)) for column in self.__property__columns)
+        return ", ".join("{}: {}".format(column, getattr(self, column)) for column in self.STR_FIELDS or self.__property__columns)
 
     def __del__(self):
         self.connection.close()
@@ -109,11 +387,147 @@ class Model(Base):
         model_name = cls.__name__.lower()
         return 'tbl_{}{}'.format(model_name, '' if model_name.endswith('s') else 's')
 
+    @classmethod
+    def get_record_class(cls):
+        if 'RECORD_CLASS' not in cls.__dict__:
+            field_names = tuple(field_name for field_name, _ in cls.FIELDS)
+            cls.RECORD_CLASS = type('{}Record'.format(cls.__name__),
+                                    (Record,),
+                                    {'__slots__': field_names + (cls.ID_KEYWORD,),
+                                     'FIELD_NAMES': field_names,
+                                     '__module__': cls.__module__,
+                                     'MODEL': cls})
+        return cls.RECORD_CLASS
+
+    @classmethod
+    def get_normalization_pipeline(cls):
+        """
+        :return: names of the normalization methods in their running order, collected once per model class
+        """
+        if 'NORMALIZATION_PIPELINE' not in cls.__dict__:
+            field_positions = {field_name: position for position, (field_name, _) in enumerate(cls.FIELDS)}
+            normalizations = [(getattr(cls, name).__name__[len(cls.NORMALIZATION_PREFIX):], name)
+                              for name
+                              in dir(cls)
+                              if callable(getattr(cls, name))
+                              and getattr(getattr(cls, name), '__name__', '').startswith(cls.NORMALIZATION_PREFIX)]
+            normalizations.sort(key=lambda normalization: (field_positions.get(normalization[0], len(field_positions)), normalization[0]))
+            cls.NORMALIZATION_PIPELINE = tuple(name for _, name in normalizations)
+        return cls.NORMALIZATION_PIPELINE
+
+    @classmethod
+    def get_index_name(cls, field_names, index_type):
+        return '{}_{}_{}'.format(cls.INDEX_TYPES[index_type][0], cls.get_table_name(), '_'.join(field_names))
+
+    @classmethod
+    def get_compressed_fields(cls):
+        return [field_name for field_name, field_type in cls.FIELDS if field_type == 'compressed_string']
+
+    @classmethod
+    def to_database_values(cls, connection, values, field_names=None):
+        """
+        :param connection: SQLiteConnection providing the compressor
+        :param values: field values in the FIELDS order or in the field_names order if those are passed
+        :return: tuple of the values as they are stored in the database
+        """
+        compressed_fields = cls.get_compressed_fields()
+        if not compressed_fields:
+            return tuple(values)
+        field_names = field_names or [field_name for field_name, _ in cls.FIELDS]
+        return tuple(connection.compressor.compress(value) if field_name in compressed_fields else value
+                     for field_name, value in zip(field_names, values))
+
+    @classmethod
+    def get_statement(cls, context, statement, field_names=None, conflict_field_names=None):
+        """
+        :param statement: one of the STATEMENT_TEMPLATES keys
+        :param field_names: fields the statement reads or writes, all the FIELDS by default
+        :param conflict_field_names: fields of the unique index an upsert conflicts on
+        :return: SQL statement built on the first call only
+        """
+        if 'STATEMENTS' not in cls.__dict__:
+            cls.STATEMENTS = dict()
+        field_names = tuple(field_names or (field_name for field_name, _ in cls.FIELDS))
+        key = (statement, context.config.DB_ID_FIELD, field_names, tuple(conflict_field_names or ()))
+        if key not in cls.STATEMENTS:
+            placeholder = SQLiteConnection.PLACEHOLDER
+            cls.STATEMENTS[key] = cls.STATEMENT_TEMPLATES[statement].format(
+                table=cls.get_table_name(),
+                id_field=context.config.DB_ID_FIELD,
+                columns=', '.join(field_names),
+                placeholder=placeholder,
+                placeholders=', '.join([placeholder] * len(field_names)),
+                assignments=', '.join('{}={}'.format(field_name, placeholder) for field_name in field_names),
+                conflict_columns=', '.join(conflict_field_names or ()),
+                excluded_assignments=', '.join('{0}=excluded.{0}'.format(field_name) for field_name in field_names
+                                               if field_name not in (conflict_field_names or ())))
+        return cls.STATEMENTS[key]
+
+    @classmethod
+    def get_unique_index_fields(cls):
+        """
+        :return: field names of the first unique index, None if the model declares none
+        """
+        return next((field_names for field_names, index_type in cls.INDEXES if index_type == 'unique'), None)
+
+    @classmethod
+    def from_database_values(cls, connection, row):
+        """
+        :param connection: SQLiteConnection providing the compressor
+        :param row: field values in the FIELDS order as they are stored in the database
+        :return: tuple of the decoded values
+        """
+        compressed_fields = cls.get_compressed_fields()
+        if not compressed_fields:
+            return tuple(row)
+        return tuple(connection.compressor.decompress(value) if field_name in compressed_fields else value
+                     for (field_name, _), value in zip(cls.FIELDS, row))
+
+    @classmethod
+    def get_full_text_table_name(cls):
+        return 'fts_{}'.format(cls.get_table_name())
+
+    @classmethod
+    def get_full_text_index_statement(cls, context, condition):
+        """
+        :param condition: SQL condition selecting the rows of the model table to index, its parameters are the statement ones
+        :return: statement (re)indexing the rows in the full-text table, None if the triggers keep the table in sync on their own,
+                 i.e. none of the FULL_TEXT_FIELDS is compressed
+        """
+        compressed_fields = cls.get_compressed_fields()
+        if not any(field_name in compressed_fields for field_name in cls.FULL_TEXT_FIELDS):
+            return None
+        values = ('decompress({})'.format(field_name) if field_name in compressed_fields else field_name for field_name in cls.FULL_TEXT_FIELDS)
+        return ("INSERT OR REPLACE INTO {fts} (rowid, {fields}) "
+                "SELECT {id_field}, {values} "
+                "FROM {table} "
+                "WHERE {condition}".format(fts=cls.get_full_text_table_name(),
+                                           fields=', '.join(cls.FULL_TEXT_FIELDS),
+                                           id_field=context.config.DB_ID_FIELD,
+                                           values=', '.join(values),
+                                           table=cls.get_table_name(),
+                                           condition=condition))
+
+    @classmethod
+    def has_unique_index(cls):
+        return any(index_type == 'unique' for _, index_type in cls.INDEXES)
+
     @classmethod
     def create_table_if_necessary(cls, context):
+        """
+        Creates the model table, or brings an existing one in line with FIELDS and INDEXES
+        """
         instance = cls(context)
         instance.__method__create_table_if_necessary()
 
+    @classmethod
+    def rebuild_full_text_index(cls, context):
+        """
+        Reindexes the whole table content in the full-text table
+        """
+        instance = cls(context)
+        instance.__method__rebuild_full_text_index()
+
     @property
     def __property__columns(self):
         if not self.__columns:
@@ -132,18 +546,16 @@ class Model(Base):
             raise NotImplementedError("Inheriting class must provide the FIELDS structure!")
 
     def __method__collect_normalization_methods(self):
-        self.logger.debug("Collecting normalization methods")
-        self.__normalizations = [getattr(self, method)
-                                 for method
-                                 in dir(self)
-                                 if callable(getattr(self, method))
-                                 and getattr(self, method).__name__.startswith(self.NORMALIZATION_PREFIX)]
-        self.logger.debug("Collected: %s", self.__normalizations)
+        self.__normalizations = [getattr(self, method) for method in self.get_normalization_pipeline()]
 
     def __method__get_database_field_type(self, field_type):
         database_field_type = 'text'
         if field_type == 'date':
             database_field_type = 'date'
+        elif field_type == 'integer':
+            database_field_type = 'integer'
+        elif field_type == 'compressed_string':
+            database_field_type = 'blob'
         elif field_type != 'string':
             raise AttributeError("Invalid field type: {}".format(field_type))
         return database_field_type
@@ -158,6 +570,171 @@ class Model(Base):
         query_parts.append(", ".join(columns))
         query_parts.append(")")
         self.connection.execute(query="".join(query_parts), commit=True)
+        self.__method__create_missing_indexes(table_name)
+        self.__method__create_full_text_index_if_necessary(table_name)
+
+    def __method__create_full_text_index_if_necessary(self, table_name):
+        """
+        Creates the full-text table along with its triggers, recreating them if FULL_TEXT_FIELDS or their types changed.
+        The triggers run on any connection to the database, so they never call the SQL functions the ORM registers:
+        with compressed fields the full-text table holds a copy of the decompressed text written by the ORM,
+        see get_full_text_index_statement(), and the triggers only drop the deleted or updated rows from it.
+        :return: whether the full-text table was (re)created
+        """
+        if not self.FULL_TEXT_FIELDS:
+            return False
+        full_text_table_name = self.get_full_text_table_name()
+        # the view decompressing the content of the earlier releases, dropped once the table is recreated
+        view_name = 'vw_{}'.format(full_text_table_name)
+        if self.get_full_text_index_statement(self.context, '1') is not None:
+            queries = ["CREATE VIRTUAL TABLE {fts} USING fts5({fields})",
+                       "CREATE TRIGGER trg_{fts}_delete AFTER DELETE ON {table} BEGIN "
+                       "DELETE FROM {fts} WHERE rowid = old.{id_field}; "
+                       "END",
+                       "CREATE TRIGGER trg_{fts}_update AFTER UPDATE OF {fields} ON {table} BEGIN "
+                       "DELETE FROM {fts} WHERE rowid = old.{id_field}; "
+                       "END"]
+        else:
+            queries = ["CREATE VIRTUAL TABLE {fts} USING fts5({fields}, content={table}, content_rowid={id_field})",
+                       "CREATE TRIGGER trg_{fts}_insert AFTER INSERT ON {table} BEGIN "
+                       "INSERT INTO {fts} (rowid, {fields}) VALUES (new.{id_field}, {new_values}); "
+                       "END",
+                       "CREATE TRIGGER trg_{fts}_delete AFTER DELETE ON {table} BEGIN "
+                       "INSERT INTO {fts} ({fts}, rowid, {fields}) VALUES ('delete', old.{id_field}, {old_values}); "
+                       "END",
+                       "CREATE TRIGGER trg_{fts}_update AFTER UPDATE ON {table} BEGIN "
+                       "INSERT INTO {fts} ({fts}, rowid, {fields}) VALUES ('delete', old.{id_field}, {old_values}); "
+                       "INSERT INTO {fts} (rowid, {fields}) VALUES (new.{id_field}, {new_values}); "
+                       "END"]
+        queries = [query.format(fts=full_text_table_name,
+                                table=table_name,
+                                fields=', '.join(self.FULL_TEXT_FIELDS),
+                                id_field=self.context.config.DB_ID_FIELD,
+                                new_values=', '.join('new.{}'.format(field_name) for field_name in self.FULL_TEXT_FIELDS),
+                                old_values=', '.join('old.{}'.format(field_name) for field_name in self.FULL_TEXT_FIELDS))
+                   for query in queries]
+
+        existing_objects = dict(self.connection.execute_fetch_all("SELECT name, sql "
+                                                                  "FROM sqlite_master "
+                                                                  "WHERE name IN ({placeholder}, {placeholder}) "
+                                                                  "OR (type={placeholder} AND tbl_name={placeholder} AND name LIKE {placeholder})".format(placeholder=self.connection.placeholder),
+                                                                  (full_text_table_name, view_name, 'trigger', table_name, 'trg_{}_%'.format(full_text_table_name))))
+        if sorted(existing_objects.values()) == sorted(queries):
+            return False
+        if existing_objects:
+            self.logger.info("Full-text table %s definition changed: recreating", full_text_table_name)
+            for name in existing_objects:
+                object_type = 'TABLE' if name == full_text_table_name else 'VIEW' if name == view_name else 'TRIGGER'
+                self.connection.execute("DROP {} IF EXISTS {}".format(object_type, name))
+
+        self.logger.info("Creating full-text table %s", full_text_table_name)
+        for query in queries:
+            self.connection.execute(query)
+        self.connection.shared_connection.commit()
+        self.__method__rebuild_full_text_index()
+        return True
+
+    def __method__rebuild_full_text_index(self):
+        full_text_table_name = self.get_full_text_table_name()
+        self.logger.info("Rebuilding full-text table %s", full_text_table_name)
+        index_statement = self.get_full_text_index_statement(self.context, '1')
+        if index_statement is None:
+            self.connection.execute("INSERT INTO {fts} ({fts}) VALUES ('rebuild')".format(fts=full_text_table_name), commit=True)
+            return
+        with self.connection.shared_connection.lock:
+            self.connection.execute("DELETE FROM {}".format(full_text_table_name))
+            self.connection.execute(index_statement, commit=True)
+
+    def __method__create_missing_indexes(self, table_name):
+        existing_indexes = set(row[0] for row in self.connection.execute_fetch_all("SELECT name "
+                                                                                   "FROM sqlite_master "
+                                                                                   "WHERE type={placeholder} "
+                                                                                   "AND tbl_name={placeholder}".format(placeholder=self.connection.placeholder),
+                                                                                   ('index', table_name)))
+        for field_names, index_type in self.INDEXES:
+            index_name = self.get_index_name(field_names, index_type)
+            if index_name in existing_indexes:
+                continue
+            if index_type == 'unique':
+                self.__method__delete_duplicates(table_name, field_names)
+            self.logger.info("Creating index %s", index_name)
+            self.connection.execute("CREATE {} {} "
+                                    "ON {} ({})".format(self.INDEX_TYPES[index_type][1], index_name, table_name, ', '.join(field_names)),
+                                    commit=True)
+
+    def __method__delete_duplicates(self, table_name, field_names):
+        """
+        Drops the rows duplicating the values of the passed fields, keeping the earliest stored ones.
+        The rows holding a NULL in any of the fields are kept, a unique index allows those to repeat.
+        """
+        condition = ' AND '.join('{} IS NOT NULL'.format(field_name) for field_name in field_names)
+        duplicates = ("FROM {table} "
+                      "WHERE {condition} "
+                      "AND {id_field} NOT IN (SELECT MIN({id_field}) "
+                      "FROM {table} "
+                      "WHERE {condition} "
+                      "GROUP BY {fields})".format(table=table_name,
+                                                  condition=condition,
+                                                  fields=', '.join(field_names),
+                                                  id_field=self.context.config.DB_ID_FIELD))
+        duplicate_rows = self.connection.execute_fetch_single_value("SELECT COUNT(*) {}".format(duplicates))
+        if not duplicate_rows:
+            return
+        self.logger.warning("Dropping %s row%s duplicating %s values of table %s", duplicate_rows, 's' if duplicate_rows > 1 else '',
+                            ', '.join(field_names), table_name)
+        self.connection.execute("DELETE {}".format(duplicates), commit=True)
+
+    def __method__upgrade_table(self, table_name):
+        """
+        Adds the columns missing from an existing table, fills them in using the normalization methods
+        and creates the missing indexes
+        """
+        existing_columns = set(row[1] for row in self.connection.execute_fetch_all("PRAGMA table_info({})".format(table_name)))
+        filled_full_text_fields = False
+        for field_name, field_type in self.FIELDS:
+            if field_name in existing_columns:
+                continue
+            self.logger.info("Adding column %s to table %s", field_name, table_name)
+            self.connection.execute("ALTER TABLE {} "
+                                    "ADD COLUMN {} {}".format(table_name, field_name, self.__method__get_database_field_type(field_type)),
+                                    commit=True)
+            if self.__method__fill_in_column(table_name, field_name) and field_name in self.FULL_TEXT_FIELDS:
+                filled_full_text_fields = True
+
+        self.__method__create_missing_indexes(table_name)
+        if not self.__method__create_full_text_index_if_necessary(table_name) and filled_full_text_fields:
+            # the update triggers may have dropped the filled in rows from the full-text table
+            self.__method__rebuild_full_text_index()
+
+    def __method__fill_in_column(self, table_name, field_name):
+        normalization_methods = [getattr(self, method) for method in self.get_normalization_pipeline()
+                                 if getattr(self, method).__name__ == self.NORMALIZATION_PREFIX + field_name]
+        if not normalization_methods:
+            return False
+
+        self.logger.info("Filling in column %s of table %s", field_name, table_name)
+        rows = self.connection.execute_fetch_all("SELECT {}, {} "
+                                                 "FROM {}".format(self.context.config.DB_ID_FIELD,
+                                                                  ', '.join(self.__property__columns),
+                                                                  table_name))
+        record_class = self.get_record_class()
+        updates = list()
+        for row in rows:
+            record = record_class(*self.from_database_values(self.connection, row[1:]))
+            for normalization_method in normalization_methods:
+                normalization_method(record)
+            updates.append((getattr(record, field_name), row[0]))
+        self.connection.execute("UPDATE {} "
+                                "SET {}={} "
+                                "WHERE {}={}".format(table_name,
+                                                     field_name,
+                                                     self.connection.placeholder,
+                                                     self.context.config.DB_ID_FIELD,
+                                                     self.connection.placeholder),
+                                updates,
+                                many=True,
+                                commit=True)
+        return True
 
     def __method__create_table_if_necessary(self):
         self.logger.debug("Checking whether table %s has to be created", self.get_table_name())
@@ -167,6 +744,7 @@ class Model(Base):
                                                       "AND name={placeholder}".format(placeholder=self.connection.placeholder),
                                                       ('table', self.get_table_name())):
             self.logger.debug("Table %s already exists", self.get_table_name())
+            self.__method__upgrade_table(self.get_table_name())
         else:
             self.__method__create_table(self.get_table_name())
 
@@ -179,15 +757,10 @@ class Model(Base):
 
         # retrieving the record otherwise
         if self.ID_KEYWORD in kwargs:
-            record = self.connection.execute_fetch_one_record("SELECT {} "
-                                                              "FROM {} "
-                                                              "WHERE {}={}".format(', '.join(self.__property__columns),
-                                                                                   self.get_table_name(),
-                                                                                   self.context.config.DB_ID_FIELD,
-                                                                                   kwargs[self.ID_KEYWORD]))
+            record = self.connection.execute_fetch_one_record(self.get_statement(self.context, 'select'), (kwargs[self.ID_KEYWORD],))
             if not record:
                 raise ValueError("No {} record found with {} = {}".format(type(self).__name__, self.context.config.DB_ID_FIELD, kwargs[self.ID_KEYWORD]))
-            record_dict = dict(zip(self.__property__columns, record))
+            record_dict = dict(zip(self.__property__columns, self.from_database_values(self.connection, record)))
             self.__id = kwargs[self.ID_KEYWORD]
             for field_name, field_value in record_dict.items():
                 setattr(self, field_name, field_value)
@@ -199,23 +772,32 @@ class Model(Base):
             self.logger.debug("Normalization not needed")
             return
 
+        self.normalize_records([self])
+
+    def normalize_records(self, records):
+        """
+        Runs every normalization method over the whole batch of model instances or records before the next one
+        """
         for normalization_method in self.__normalizations:
-            try:
-                normalization_method()
-            except Exception as e:
-                self.logger.error("%s failed: %s", normalization_method.__name__, e)
+            self.logger.debug("Running %s over %s record%s", normalization_method.__name__, len(records), 's' if len(records) != 1 else '')
+            for record in records:
+                try:
+                    normalization_method(record)
+                except Exception as e:
+                    self.logger.error("%s failed: %s", normalization_method.__name__, e)
+
+    def __method__index_full_text(self):
+        index_statement = self.get_full_text_index_statement(self.context, '{}={}'.format(self.context.config.DB_ID_FIELD, self.connection.placeholder))
+        if index_statement is not None:
+            self.connection.execute(index_statement, (self.__id,))
 
     def __method__update(self):
         self.logger.debug("Updating a %s record", type(self).__name__)
-        value_placeholders = ', '.join("{}={}".format(field_name, self.connection.placeholder) for field_name in self.__property__columns)
-        self.connection.execute("UPDATE {} "
-                                "SET {} "
-                                "WHERE {}={}".format(self.get_table_name(),
-                                                     value_placeholders,
-                                                     self.context.config.DB_ID_FIELD,
-                                                     self.__id),
-                                tuple(self.__property__values),
-                                commit=True)
+        with self.connection.shared_connection.lock:
+            self.connection.execute(self.get_statement(self.context, 'update'),
+                                    self.to_database_values(self.connection, self.__property__values) + (self.__id,))
+            self.__method__index_full_text()
+            self.connection.shared_connection.commit()
 
     def save(self):
         """
@@ -226,54 +808,594 @@ class Model(Base):
             return
 
         self.logger.debug("Storing a %s record", type(self).__name__)
-        placeholders = ('{}, '.format(self.connection.placeholder) * len(self.FIELDS)).strip(', ')
-        self.connection.execute("INSERT INTO {} ({}) VALUES ({})".format(self.get_table_name(),
-                                                                         ', '.join(self.__property__columns),
-                                                                         placeholders),
-                                tuple(self.__property__values),
-                                commit=True)
-        self.__id = self.connection.execute_fetch_single_value("SELECT last_insert_rowid()")
+        with self.connection.shared_connection.lock:
+            cursor = self.connection.execute(self.get_statement(self.context, 'insert'),
+                                             self.to_database_values(self.connection, self.__property__values))
+            self.__id = cursor.lastrowid
+            self.__method__index_full_text()
+            self.connection.shared_connection.commit()
 
     def delete(self):
         self.logger.debug("Deleting a %s record", type(self).__name__)
-        self.connection.execute("DELETE FROM {} "
-                                "WHERE {}={}".format(self.get_table_name(),
-                                                     self.context.config.DB_ID_FIELD,
-                                                     self.__id),
-                                commit=True)
+        self.connection.execute(self.get_statement(self.context, 'delete'), (self.__id,), commit=True)
+
+
+class Query(Base):
+    """
+    Lazy query over a model table, nothing is read from the database until it is iterated:
+        collection.query().filter(author='Unidentified', date__gte='2017-10-01').order_by('-date').limit(100)
+
+    Each method returns a new query, so a query can be refined without changing the original one.
+    Filters are field=value or field__<lookup>=value, see LOOKUPS, all of them combined with AND.
+    The primary key is available as the pk field, compressed fields are filtered by their decompressed values.
+
+    Iterating reads chunk_size rows at a time with keyset pagination: every chunk continues after the ordering values
+    of the last row of the previous one (the primary key being the last ordering field), so no cursor stays open
+    between the chunks and the chunks cost the same however deep the iteration goes.
+    Rows are returned as the model records with the primary key set, no model instance is created per row.
+    """
+    LOOKUPS = {'eq': '{} = {}',
+               'ne': '{} != {}',
+               'lt': '{} < {}',
+               'lte': '{} <= {}',
+               'gt': '{} > {}',
+               'gte': '{} >= {}',
+               'like': '{} LIKE {}',
+               'in': '{} IN ({})'}
+    LOOKUP_SEPARATOR = '__'
+    DEFAULT_CHUNK_SIZE = 1000
+
+    def __init__(self, context, model, connection):
+        super().__init__(context)
+        self.model = model
+        self.connection = connection
+        self._filters = list()
+        self._ordering = list()
+        self._limit = None
+        self._after = None
+        self._chunk_size = self.DEFAULT_CHUNK_SIZE
+
+    def _clone(self, **attributes):
+        query = type(self)(self.context, self.model, self.connection)
+        query._filters = list(self._filters)
+        query._ordering = list(self._ordering)
+        query._limit = self._limit
+        query._after = self._after
+        query._chunk_size = self._chunk_size
+        for name, value in attributes.items():
+            setattr(query, name, value)
+        return query
+
+    def _get_column(self, field_name, for_ordering=False):
+        if field_name == self.model.ID_KEYWORD:
+            return self.context.config.DB_ID_FIELD
+        if field_name not in [name for name, _ in self.model.FIELDS]:
+            raise AttributeError("Unknown {} field: {}".format(self.model.__name__, field_name))
+        if field_name in self.model.get_compressed_fields():
+            if for_ordering:
+                raise AttributeError("Compressed field {} cannot be ordered by".format(field_name))
+            return 'decompress({})'.format(field_name)
+        return field_name
+
+    def filter(self, **lookups):
+        filters = list(self._filters)
+        for lookup, value in lookups.items():
+            field_name, _, operator = lookup.partition(self.LOOKUP_SEPARATOR)
+            column = self._get_column(field_name)
+            operator = operator or 'eq'
+            if operator == 'isnull':
+                filters.append(('{} IS {}NULL'.format(column, '' if value else 'NOT '), ()))
+            elif operator == 'in':
+                values = tuple(value)
+                placeholders = ', '.join([self.connection.placeholder] * len(values))
+                filters.append((self.LOOKUPS[operator].format(column, placeholders) if values else '0', values))
+            elif operator in self.LOOKUPS:
+                filters.append((self.LOOKUPS[operator].format(column, self.connection.placeholder), (value,)))
+            else:
+                raise AttributeError("Unknown lookup: {}".format(lookup))
+        return self._clone(_filters=filters)
+
+    def order_by(self, *field_names):
+        """
+        :param field_names: field names, prefixed with - for the descending order
+        """
+        ordering = list()
+        for field_name in field_names:
+            descending = field_name.startswith('-')
+            ordering.append((self._get_column(field_name.lstrip('-'), for_ordering=True), descending))
+        return self._clone(_ordering=ordering)
+
+    def limit(self, limit):
+        return self._clone(_limit=limit)
+
+    def chunk_size(self, chunk_size):
+        return self._clone(_chunk_size=chunk_size)
+
+    def after(self, keyset):
+        """
+        :param keyset: get_keyset() of the last row seen, the query continues right after it
+        """
+        return self._clone(_after=tuple(keyset) if keyset is not None else None)
+
+    @property
+    def _full_ordering(self):
+        ordering = [(column, descending) for column, descending in self._ordering if column != self.context.config.DB_ID_FIELD]
+        primary_key_descending = next((descending for column, descending in self._ordering if column == self.context.config.DB_ID_FIELD), False)
+        return ordering + [(self.context.config.DB_ID_FIELD, primary_key_descending)]
+
+    def get_keyset(self, record):
+        """
+        :return: ordering values of the record, to be passed to after()
+        """
+        id_field = self.context.config.DB_ID_FIELD
+        return tuple(getattr(record, self.model.ID_KEYWORD if column == id_field else column) for column, _ in self._full_ordering)
+
+    def _get_keyset_condition(self, keyset):
+        """
+        Expands (a, b, pk) > (x, y, z) in the query ordering, NULL values being sorted before the rest like SQLite does
+        :return: condition, params
+        """
+        if len(keyset) != len(self._full_ordering):
+            raise ValueError("Keyset {} does not match the query ordering".format(keyset))
+        placeholder = self.connection.placeholder
+        alternatives, params = list(), list()
+        for position, ((column, descending), value) in enumerate(zip(self._full_ordering, keyset)):
+            parts, part_params = list(), list()
+            for (previous_column, _), previous_value in zip(self._full_ordering[:position], keyset):
+                if previous_value is None:
+                    parts.append('{} IS NULL'.format(previous_column))
+                else:
+                    parts.append('{} = {}'.format(previous_column, placeholder))
+                    part_params.append(previous_value)
+            if value is None:
+                following = '{} IS NOT NULL'.format(column) if not descending else None
+            elif descending:
+                following = '({0} < {1} OR {0} IS NULL)'.format(column, placeholder)
+                part_params.append(value)
+            else:
+                following = '{} > {}'.format(column, placeholder)
+                part_params.append(value)
+            if following is None:
+                continue
+            alternatives.append('({})'.format(' AND '.join(parts + [following])))
+            params.extend(part_params)
+        return '({})'.format(' OR '.join(alternatives) or '0'), params
+
+    def _build_select(self, columns, keyset=None, limit=None, ordered=True):
+        conditions = [condition for condition, _ in self._filters]
+        params = [param for _, filter_params in self._filters for param in filter_params]
+        if keyset is not None:
+            keyset_condition, keyset_params = self._get_keyset_condition(keyset)
+            conditions.append(keyset_condition)
+            params.extend(keyset_params)
+        query = "SELECT {} FROM {}".format(columns, self.model.get_table_name())
+        if conditions:
+            query += " WHERE {}".format(' AND '.join(conditions))
+        if ordered:
+            query += " ORDER BY {}".format(', '.join('{} {}'.format(column, 'DESC' if descending else 'ASC') for column, descending in self._full_ordering))
+        if limit is not None:
+            query += " LIMIT {}".format(self.connection.placeholder)
+            params.append(limit)
+        return query, tuple(params)
+
+    def _fetch_chunk(self, keyset, size):
+        field_names = [field_name for field_name, _ in self.model.FIELDS]
+        query, params = self._build_select(', '.join([self.context.config.DB_ID_FIELD] + field_names), keyset, size)
+        rows = self.connection.execute_fetch_all(query, params)
+        record_class = self.model.get_record_class()
+        return [record_class(*self.model.from_database_values(self.connection, row[1:]), **{self.model.ID_KEYWORD: row[0]}) for row in rows]
+
+    def chunks(self):
+        """
+        :return: generator of lists of up to chunk_size records
+        """
+        keyset = self._after
+        remaining = self._limit
+        while remaining is None or remaining > 0:
+            size = self._chunk_size if remaining is None else min(self._chunk_size, remaining)
+            records = self._fetch_chunk(keyset, size)
+            if not records:
+                return
+            yield records
+            if len(records) < size:
+                return
+            keyset = self.get_keyset(records[-1])
+            if remaining is not None:
+                remaining -= len(records)
+
+    def __iter__(self):
+        for records in self.chunks():
+            yield from records
+
+    def page(self, page_size):
+        """
+        :return: list of up to page_size records, keyset to continue the next page from or None if this is the last page
+        """
+        records = self._fetch_chunk(self._after, page_size + 1)
+        if len(records) <= page_size:
+            return records, None
+        records = records[:page_size]
+        return records, self.get_keyset(records[-1])
+
+    def first(self):
+        records = self._fetch_chunk(self._after, 1)
+        return records[0] if records else None
+
+    def delete(self):
+        """
+        Deletes the rows the query filters match, ignoring the ordering, the keyset and the limit
+        :return: number of deleted rows
+        """
+        conditions = [condition for condition, _ in self._filters]
+        params = tuple(param for _, filter_params in self._filters for param in filter_params)
+        statement = "DELETE FROM {}".format(self.model.get_table_name())
+        if conditions:
+            statement += " WHERE {}".format(' AND '.join(conditions))
+        with self.connection.shared_connection.lock:
+            cursor = self.connection.execute(statement, params)
+            self.connection.shared_connection.commit()
+        return cursor.rowcount
+
+    def values(self, field_name):
+        """
+        :return: list of the field values of the matching rows, unordered and all fetched at once
+        """
+        query, params = self._build_select(self._get_column(field_name), self._after, self._limit, ordered=False)
+        return [row[0] for row in self.connection.execute_fetch_all(query, params)]
+
+    def count(self):
+        query, params = self._build_select('COUNT(*)', self._after, ordered=False)
+        if self._limit is None:
+            return self.connection.execute_fetch_single_value(query, params)
+        return min(self.connection.execute_fetch_single_value(query, params), self._limit)
 
 
 class ModelCollection(Base):
     """
     A collection class providing tools to work with multiple model instances
     """
-    def __init__(self, context, model):
+    LOOKUP_CHUNK_SIZE = 500
+    SNIPPET_TOKENS = 16
+    SAVEPOINT_NAME = 'execute_many'
+
+    def __init__(self, context, model, connection=None):
+        """
+        :param connection: SQLiteConnection to use instead of a new one on the process-wide connection
+        """
         super().__init__(context)
         self.model = model
-        self.connection = SQLiteConnection(self.context)
+        self.connection = connection or SQLiteConnection(self.context)
+        self._normalizer = None
+
+    @property
+    def normalizer(self):
+        """
+        A single model instance running the normalization methods over the collection records
+        """
+        if self._normalizer is None:
+            self._normalizer = self.model(self.context)
+        return self._normalizer
+
+    def create_record(self, **kwargs):
+        """
+        :return: normalized record of the collection model
+        """
+        record = self.model.get_record_class()(**kwargs)
+        self.normalizer.normalize_records([record])
+        return record
+
+    def normalize(self, records):
+        """
+        :param records: iterable of raw records
+        :return: list of the normalized records
+        """
+        records = list(records)
+        self.logger.debug("Normalizing %s record%s", len(records), 's' if len(records) != 1 else '')
+        self.normalizer.normalize_records(records)
+        return records
 
     def get_the_most_recent(self):
-        self.logger.debug("Retrieving the most recent model instance")
-        latest_id = self.connection.execute_fetch_single_value("SELECT {} "
-                                                               "FROM {} "
-                                                               "ORDER BY {} DESC "
-                                                               "LIMIT 1".format(self.context.config.DB_ID_FIELD,
-                                                                                self.model.get_table_name(),
-                                                                                self.model.ORDER_BY))
-        if not latest_id:
+        """
+        :return: record of the most recent row or None if the table is empty
+        """
+        self.logger.debug("Retrieving the most recent record")
+        columns = [field_name for field_name, _ in self.model.FIELDS]
+        row = self.connection.execute_fetch_one_record("SELECT {} "
+                                                       "FROM {} "
+                                                       "ORDER BY {} DESC "
+                                                       "LIMIT 1".format(', '.join(columns),
+                                                                        self.model.get_table_name(),
+                                                                        self.model.ORDER_BY))
+        if not row:
             return None
+        return self.model.get_record_class()(*self.model.from_database_values(self.connection, row))
 
-        model_object = self.model(self.context, pk=latest_id)
-        return model_object
+    def get_stored_values(self, field_name, values, **lookups):
+        """
+        :param field_name: name of the (preferably indexed) field to look the values up in
+        :param values: iterable of values to look up
+        :param lookups: Query.filter() lookups the rows have to match as well, e.g. source='mirror'
+        :return: set of the passed values already stored in the table
+        """
+        values = list(set(values))
+        stored_values = set()
+        for chunk_start in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+            chunk = values[chunk_start:chunk_start + self.LOOKUP_CHUNK_SIZE]
+            stored_values.update(self.query().filter(**{field_name + Query.LOOKUP_SEPARATOR + 'in': chunk}, **lookups).values(field_name))
+        return stored_values
+
+    def get_primary_keys(self, field_name, values):
+        """
+        :param field_name: name of the (preferably unique) field to look the values up in
+        :param values: iterable of values to look up
+        :return: dict of the passed values already stored in the table to the primary keys of their rows
+        """
+        values = list(set(values))
+        primary_keys = dict()
+        for chunk_start in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+            chunk = values[chunk_start:chunk_start + self.LOOKUP_CHUNK_SIZE]
+            placeholders = ('{}, '.format(self.connection.placeholder) * len(chunk)).strip(', ')
+            rows = self.connection.execute_fetch_all("SELECT {field}, {id_field} "
+                                                     "FROM {table} "
+                                                     "WHERE {field} IN ({placeholders})".format(field=field_name,
+                                                                                               id_field=self.context.config.DB_ID_FIELD,
+                                                                                               table=self.model.get_table_name(),
+                                                                                               placeholders=placeholders),
+                                                     tuple(chunk))
+            primary_keys.update(rows)
+        return primary_keys
+
+    def get_last_primary_key(self):
+        """
+        :return: primary key of the last inserted row, 0 if the table is empty
+        """
+        return self.connection.execute_fetch_single_value("SELECT MAX({}) FROM {}".format(self.context.config.DB_ID_FIELD, self.model.get_table_name())) or 0
+
+    def query(self):
+        """
+        :return: Query over all the rows of the collection model table
+        """
+        return Query(self.context, self.model, self.connection)
+
+    def iterate_chunks(self, after_pk=None, since=None, chunk_size=None):
+        """
+        Streams the rows in the primary key order, reading chunk_size rows at once,
+        so the memory use does not depend on the table size
+        :param after_pk: only the rows with a greater primary key
+        :param since: only the rows with the ORDER_BY field value greater than or equal to it
+        :return: generator of lists of records
+        """
+        query = self.query().order_by(self.model.ID_KEYWORD).chunk_size(chunk_size or Query.DEFAULT_CHUNK_SIZE)
+        if after_pk is not None:
+            query = query.filter(**{'{}__gt'.format(self.model.ID_KEYWORD): after_pk})
+        if since is not None:
+            query = query.filter(**{'{}__gte'.format(self.model.ORDER_BY): since})
+        return query.chunks()
+
+    def search(self, query, page=1, page_size=20):
+        """
+        Runs a full-text query over the FULL_TEXT_FIELDS of the model
+        :param query: FTS5 query string
+        :param page: 1-based results page number
+        :param page_size: number of results per page
+        :return: total number of matching rows, list of result dicts ordered by relevance,
+                 each holding the primary key, the rank, the best matching snippet and the STR_FIELDS values
+        """
+        full_text_table_name = self.model.get_full_text_table_name()
+        total = self.connection.execute_fetch_single_value("SELECT COUNT(*) "
+                                                           "FROM {fts} "
+                                                           "WHERE {fts} MATCH {placeholder}".format(fts=full_text_table_name,
+                                                                                                   placeholder=self.connection.placeholder),
+                                                           (query,))
+        columns = self.model.STR_FIELDS or [field_name for field_name, _ in self.model.FIELDS]
+        rows = self.connection.execute_fetch_all("SELECT {table}.{id_field}, {fts}.rank, "
+                                                 "snippet({fts}, -1, '[', ']', '...', {snippet_tokens}), {columns} "
+                                                 "FROM {fts} "
+                                                 "JOIN {table} ON {table}.{id_field} = {fts}.rowid "
+                                                 "WHERE {fts} MATCH {placeholder} "
+                                                 "ORDER BY {fts}.rank "
+                                                 "LIMIT {placeholder} OFFSET {placeholder}".format(fts=full_text_table_name,
+                                                                                                   table=self.model.get_table_name(),
+                                                                                                   id_field=self.context.config.DB_ID_FIELD,
+                                                                                                   snippet_tokens=self.SNIPPET_TOKENS,
+                                                                                                   columns=', '.join('{}.{}'.format(self.model.get_table_name(), column) for column in columns),
+                                                                                                   placeholder=self.connection.placeholder),
+                                                 (query, page_size, (page - 1) * page_size))
+        results = [dict(zip([self.model.ID_KEYWORD, 'rank', 'snippet'] + columns, row)) for row in rows]
+        return total, results
+
+    def train_compression_dictionary(self):
+        """
+        Trains a new compression dictionary on a random sample of the stored compressed field values
+        :return: dictionary id, None if the sample has nothing to build a dictionary from
+        """
+        compressed_fields = self.model.get_compressed_fields()
+        samples = list()
+        for field_name in compressed_fields:
+            rows = self.connection.execute_fetch_all("SELECT {} "
+                                                     "FROM {} "
+                                                     "WHERE {} IS NOT NULL "
+                                                     "ORDER BY RANDOM() "
+                                                     "LIMIT {}".format(field_name,
+                                                                       self.model.get_table_name(),
+                                                                       field_name,
+                                                                       self.context.config.DB_COMPRESSION_DICTIONARY_SAMPLES // len(compressed_fields)))
+            samples.extend(self.connection.compressor.decompress(row[0]) for row in rows)
+        dictionary = self.connection.compressor.train_dictionary(samples)
+        if not dictionary:
+            return None
+        self.logger.info("Trained a %s byte compression dictionary on %s sample%s", len(dictionary), len(samples), 's' if len(samples) != 1 else '')
+        return self.connection.compressor.store_dictionary(dictionary)
+
+    def compress_stored_values(self, chunk_size=1000):
+        """
+        Compresses in place the compressed field values stored uncompressed
+        :return: dict with the number of compressed values, their size before and after compression
+                 and the CPU time the compression took
+        """
+        stats = {'values': 0, 'raw_bytes': 0, 'compressed_bytes': 0, 'cpu_seconds': 0.0}
+        id_field = self.context.config.DB_ID_FIELD
+        for field_name in self.model.get_compressed_fields():
+            last_id = 0
+            while True:
+                rows = self.connection.execute_fetch_all("SELECT {id_field}, {field} "
+                                                         "FROM {table} "
+                                                         "WHERE {id_field} > {placeholder} "
+                                                         "AND typeof({field}) = 'text' "
+                                                         "ORDER BY {id_field} "
+                                                         "LIMIT {placeholder}".format(id_field=id_field,
+                                                                                      field=field_name,
+                                                                                      table=self.model.get_table_name(),
+                                                                                      placeholder=self.connection.placeholder),
+                                                         (last_id, chunk_size))
+                if not rows:
+                    break
+                started = time.process_time()
+                updates = [(self.connection.compressor.compress(value), row_id) for row_id, value in rows]
+                stats['cpu_seconds'] += time.process_time() - started
+                stats['values'] += len(rows)
+                stats['raw_bytes'] += sum(len(value.encode('utf-8')) for _, value in rows)
+                stats['compressed_bytes'] += sum(len(value) for value, _ in updates)
+                with self.connection.shared_connection.lock:
+                    self.connection.execute("UPDATE {} "
+                                            "SET {}={} "
+                                            "WHERE {}={}".format(self.model.get_table_name(),
+                                                                 field_name,
+                                                                 self.connection.placeholder,
+                                                                 id_field,
+                                                                 self.connection.placeholder),
+                                            updates,
+                                            many=True)
+                    if field_name in self.model.FULL_TEXT_FIELDS:
+                        self._index_full_text(id_field, (row_id for row_id, _ in rows))
+                    self.connection.shared_connection.commit()
+                last_id = rows[-1][0]
+                self.logger.info("Compressed %s %s value%s", stats['values'], field_name, 's' if stats['values'] != 1 else '')
+        return stats
+
+    def measure_decompression(self, sample_size=1000):
+        """
+        :return: number of decompressed values, their decompressed size and the CPU time the decompression took
+        """
+        values = list()
+        for field_name in self.model.get_compressed_fields():
+            rows = self.connection.execute_fetch_all("SELECT {field} "
+                                                     "FROM {table} "
+                                                     "WHERE typeof({field}) = 'blob' "
+                                                     "LIMIT {limit}".format(field=field_name, table=self.model.get_table_name(), limit=sample_size))
+            values.extend(row[0] for row in rows)
+        started = time.process_time()
+        decompressed = [self.connection.compressor.decompress(value) for value in values]
+        cpu_seconds = time.process_time() - started
+        return len(values), sum(len(value.encode('utf-8')) for value in decompressed), cpu_seconds
+
+    def _get_database_values(self, model_list, field_names=None, with_primary_key=False):
+        field_names = field_names or [field_name for field_name, _ in self.model.FIELDS]
+        values = list()
+        for model_instance in model_list:
+            row = self.model.to_database_values(self.connection, [getattr(model_instance, field_name) for field_name in field_names], field_names)
+            if with_primary_key:
+                primary_key = getattr(model_instance, self.model.ID_KEYWORD, None)
+                if primary_key is None:
+                    raise ValueError("{} record has no primary key to update by: {}".format(self.model.__name__, model_instance))
+                row += (primary_key,)
+            values.append(row)
+        return values
+
+    def _index_full_text(self, field_name, values):
+        """
+        Indexes the rows holding the values of the field in the full-text table, if the ORM keeps it in sync
+        instead of the triggers, see Model.get_full_text_index_statement()
+        """
+        values = list(set(values))
+        for chunk_start in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+            chunk = values[chunk_start:chunk_start + self.LOOKUP_CHUNK_SIZE]
+            index_statement = self.model.get_full_text_index_statement(self.context, '{} IN ({})'.format(field_name, ', '.join([self.connection.placeholder] * len(chunk))))
+            if index_statement is None:
+                return
+            self.connection.execute(index_statement, tuple(chunk))
+
+    def _execute_in_transaction(self, statement, values, indexed_field_name=None):
+        """
+        Runs the statement for every set of values and commits them at once, along with any pending grouped transaction
+        :param indexed_field_name: field whose value is the last one of every set of values,
+                                   the rows holding the values are indexed in the full-text table again
+        :return: number of changed rows
+        """
+        if not values:
+            return 0
+        with self.connection.shared_connection.lock:
+            # a failure rolls back to the savepoint only, keeping the rows store() left for the group commit
+            self.connection.execute("SAVEPOINT {}".format(self.SAVEPOINT_NAME))
+            try:
+                cursor = self.connection.execute(statement, values, many=True)
+                if indexed_field_name is not None:
+                    self._index_full_text(indexed_field_name, (row[-1] for row in values))
+            except Exception:
+                self.connection.execute("ROLLBACK TO {}".format(self.SAVEPOINT_NAME))
+                self.connection.execute("RELEASE {}".format(self.SAVEPOINT_NAME))
+                raise
+            self.connection.execute("RELEASE {}".format(self.SAVEPOINT_NAME))
+            self.connection.shared_connection.commit()
+        return cursor.rowcount
+
+    def upsert_many(self, model_list, conflict_field_names=None):
+        """
+        Inserts the rows, updating the already stored ones instead, in a single transaction
+        :param model_list: iterable of model instances or records
+        :param conflict_field_names: fields of the unique index identifying a stored row, the first unique index by default
+        :return: number of inserted or updated rows
+        """
+        conflict_field_names = conflict_field_names or self.model.get_unique_index_fields()
+        if not conflict_field_names:
+            raise ValueError("{} declares no unique index to upsert on".format(self.model.__name__))
+        self.logger.debug("Upserting the list of model instances")
+        # the rows are indexed in the full-text table again by the last conflict field, which goes last in the values
+        field_names = [field_name for field_name, _ in self.model.FIELDS if field_name != conflict_field_names[-1]] + [conflict_field_names[-1]]
+        statement = self.model.get_statement(self.context, 'upsert', field_names=field_names, conflict_field_names=conflict_field_names)
+        return self._execute_in_transaction(statement, self._get_database_values(model_list, field_names), indexed_field_name=conflict_field_names[-1])
+
+    def update_many(self, model_list, field_names=None):
+        """
+        Updates the stored rows by their primary keys in a single transaction
+        :param model_list: iterable of model instances or records holding the primary key, e.g. the ones query() returns
+        :param field_names: fields to update, all the FIELDS by default
+        :return: number of updated rows
+        """
+        self.logger.debug("Updating the list of model instances")
+        statement = self.model.get_statement(self.context, 'update', field_names=field_names)
+        return self._execute_in_transaction(statement, self._get_database_values(model_list, field_names, with_primary_key=True),
+                                            indexed_field_name=self.context.config.DB_ID_FIELD)
+
+    def delete_where(self, **lookups):
+        """
+        Deletes the rows matching the Query filter lookups in a single statement
+        :return: number of deleted rows
+        """
+        if not lookups:
+            raise ValueError("No lookups passed, use an explicit condition to delete all the rows")
+        return self.query().filter(**lookups).delete()
 
     def store(self, model_list):
+        """
+        Inserts the rows in a single statement, committing them along with the group commit settings
+        :param model_list: iterable of model instances or records
+        :return: number of stored rows
+        """
         self.logger.debug("Storing the list of model instances")
-        placeholders = ('{}, '.format(self.connection.placeholder) * len(self.model.FIELDS)).strip(', ')
-        columns = [field_name for field_name, _ in self.model.FIELDS]
-        values = [tuple(getattr(model_instance, column) for column in columns) for model_instance in model_list]
-        self.connection.execute("INSERT INTO {} ({}) VALUES ({})".format(self.model.get_table_name(),
-                                                                         ', '.join(columns),
-                                                                         placeholders),
-                                values,
-                                many=True,
-                                commit=True)
+        metrics = Metrics.get(self.context)
+        started = time.perf_counter()
+        values = self._get_database_values(model_list)
+        index_statement = self.model.get_full_text_index_statement(self.context, '{}>{}'.format(self.context.config.DB_ID_FIELD, self.connection.placeholder))
+        with self.connection.shared_connection.lock:
+            last_primary_key = self.get_last_primary_key() if index_statement is not None else None
+            cursor = self.connection.execute(self.model.get_statement(self.context, 'insert_or_ignore' if self.model.has_unique_index() else 'insert'),
+                                             values,
+                                             many=True)
+            if index_statement is not None and cursor.rowcount > 0:
+                # the inserted rows get the primary keys after the last stored one
+                self.connection.execute(index_statement, (last_primary_key,))
+        self.connection.request_commit()
+        metrics.observe('store_seconds', time.perf_counter() - started, table=self.model.get_table_name())
+        metrics.increment('stored_rows_total', max(cursor.rowcount, 0), table=self.model.get_table_name())
+        return cursor.rowcount
@@ -0,0 +1,210 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from modules.common import Base
+from modules.metrics import Metrics
+
+
+def call_timed(function, payload):
+    """
+    Runs in the pool processes, so the stage latency does not include the time spent waiting for a free process
+    :return: elapsed seconds, function result
+    """
+    started = time.perf_counter()
+    result = function(payload)
+    return time.perf_counter() - started, result
+
+
+class StageFailure:
+    """
+    Carries an exception raised by a stage down to the pipeline consumer
+    """
+    def __init__(self, stage_name, exception):
+        self.stage_name = stage_name
+        self.exception = exception
+
+
+class StagedPipeline(Base):
+    """
+    Runs items through a chain of stages connected by bounded queues
+
+    Stages are (name, function, number of workers, pool type) tuples:
+        'thread' stages run the function in the stage worker threads (I/O bound work),
+        'process' stages have their worker threads hand the function over to a shared process pool (CPU bound work),
+        the function must then be picklable, see app.workers.
+    Each function gets the output of the previous stage, the first one gets the input item.
+
+    run() yields the input items along with the output of the last stage in the input order,
+    so the consumer can act as the single writer. No more than max_items_in_flight items are
+    inside the pipeline at once, which keeps the memory use flat however slow the consumer is.
+    stop() makes the stages drop the items they have not started yet and the feeder stop reading the input.
+    run_inline() runs the stages one after another in the calling thread instead, e.g. for profiling.
+    Pipelines running side by side can share a process_pool, it is left running when the pipeline is done.
+
+    The stage latencies and the handled and failed item counts go to the process Metrics.
+    """
+    SENTINEL = object()
+
+    def __init__(self, context, stages, max_items_in_flight, process_workers=0, process_initializer=None, process_initargs=(), process_pool=None):
+        super().__init__(context)
+        self.stages = stages
+        self.max_items_in_flight = max_items_in_flight
+        self.process_workers = process_workers
+        self.process_initializer = process_initializer
+        self.process_initargs = process_initargs
+        self._stop_event = threading.Event()
+        self._slots = None
+        self._threads = list()
+        self._process_pool = None
+        self._shared_process_pool = process_pool
+        self.metrics = Metrics.get(context)
+
+    @staticmethod
+    def create_process_pool(workers, initializer=None, initargs=()):
+        """
+        The pools are started from processes already running threads, a forked child would inherit
+        the locks those threads held at the time, so the processes are forked off a clean forkserver instead
+        """
+        return ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=multiprocessing.get_context('forkserver'),
+                                   initializer=initializer,
+                                   initargs=initargs)
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _feed(self, items, output_queue):
+        index = 0
+        try:
+            for item in items:
+                while not self._slots.acquire(timeout=0.1):
+                    if self.stopped:
+                        return
+                if self.stopped:
+                    return
+                output_queue.put((index, item, item))
+                index += 1
+        except Exception as e:
+            output_queue.put((index, None, StageFailure('feed', e)))
+        finally:
+            output_queue.put(self.SENTINEL)
+
+    def _work(self, stage, input_queue, output_queue, finished_workers):
+        name, function, workers, pool_type = stage
+        while True:
+            entry = input_queue.get()
+            if entry is self.SENTINEL:
+                with finished_workers['lock']:
+                    finished_workers['count'] += 1
+                    if finished_workers['count'] == workers:
+                        output_queue.put(self.SENTINEL)
+                    else:
+                        input_queue.put(self.SENTINEL)
+                return
+
+            index, item, payload = entry
+            if not isinstance(payload, StageFailure) and not self.stopped:
+                payload = self._call_stage(name, function, pool_type, payload)
+            output_queue.put((index, item, payload))
+
+    def _call_stage(self, name, function, pool_type, payload):
+        """
+        :return: stage function result, StageFailure if it raised an exception
+        """
+        try:
+            if pool_type == 'process':
+                elapsed, result = self._process_pool.submit(call_timed, function, payload).result()
+            else:
+                elapsed, result = call_timed(function, payload)
+        except Exception as e:
+            self.metrics.increment('stage_failures_total', stage=name)
+            return StageFailure(name, e)
+        self.metrics.observe('stage_seconds', elapsed, stage=name)
+        self.metrics.increment('stage_items_total', stage=name)
+        return result
+
+    def run(self, items):
+        """
+        :param items: iterable of input items
+        :return: generator of input item, last stage output in the input order
+        """
+        self._stop_event.clear()
+        self._slots = threading.Semaphore(self.max_items_in_flight)
+        if self._shared_process_pool is not None:
+            self._process_pool = self._shared_process_pool
+        elif any(pool_type == 'process' for _, _, _, pool_type in self.stages):
+            self._process_pool = self.create_process_pool(self.process_workers, self.process_initializer, self.process_initargs)
+        # the in-flight limit keeps the queues from ever filling up, the extra slot is for the sentinel
+        queues = [queue.Queue(maxsize=self.max_items_in_flight + 1) for _ in range(len(self.stages) + 1)]
+        self._start_thread(self._feed, items, queues[0])
+        for position, stage in enumerate(self.stages):
+            finished_workers = {'lock': threading.Lock(), 'count': 0}
+            for _ in range(stage[2]):
+                self._start_thread(self._work, stage, queues[position], queues[position + 1], finished_workers)
+
+        pending = dict()
+        next_index = 0
+        try:
+            while True:
+                entry = queues[-1].get()
+                if entry is self.SENTINEL:
+                    break
+                index, item, payload = entry
+                pending[index] = (item, payload)
+                while next_index in pending:
+                    item, payload = pending.pop(next_index)
+                    next_index += 1
+                    self._slots.release()
+                    if isinstance(payload, StageFailure):
+                        self.logger.error("Stage %s failed: %s", payload.stage_name, payload.exception)
+                        raise payload.exception
+                    yield item, payload
+        finally:
+            self.stop()
+            self._shutdown(queues[-1])
+
+    def run_inline(self, items):
+        """
+        :param items: iterable of input items
+        :return: generator of input item, last stage output
+        """
+        self._stop_event.clear()
+        if self.process_initializer is not None and any(pool_type == 'process' for _, _, _, pool_type in self.stages):
+            # the process stage functions expect the state the pool processes are initialized with
+            self.process_initializer(*self.process_initargs)
+        for item in items:
+            if self.stopped:
+                return
+            payload = item
+            for name, function, _, _ in self.stages:
+                payload = self._call_stage(name, function, 'thread', payload)
+                if isinstance(payload, StageFailure):
+                    self.logger.error("Stage %s failed: %s", payload.stage_name, payload.exception)
+                    raise payload.exception
+            yield item, payload
+
+    def _shutdown(self, output_queue):
+        if any(thread.is_alive() for thread in self._threads):
+            self.logger.debug("Waiting for the pipeline stages to finish the items in progress")
+        # draining the output keeps the stages from blocking until they have all seen the sentinel
+        while any(thread.is_alive() for thread in self._threads):
+            try:
+                output_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._threads = list()
+        if self._process_pool is not None and self._process_pool is not self._shared_process_pool:
+            self._process_pool.shutdown()
+        self._process_pool = None
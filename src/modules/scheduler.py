@@ -0,0 +1,39 @@
+from modules.common import Base
+
+
+class AdaptiveScheduler(Base):
+    """
+    Adapts the interval between the crawls to the observed rate of new pastes
+
+    Keeps an exponentially smoothed rate of new pastes per hour and schedules the next crawl
+    when about SCHEDULER_TARGET_NEW_PASTES new pastes are expected to be waiting,
+    within the SCHEDULER_MIN_INTERVAL_MINUTES and SCHEDULER_MAX_INTERVAL_MINUTES limits
+    """
+    def __init__(self, context):
+        super().__init__(context)
+        self.rate_per_hour = None
+
+    def record_cycle(self, new_pastes, elapsed_hours):
+        """
+        :param new_pastes: number of new pastes the crawl found
+        :param elapsed_hours: time passed since the previous crawl
+        :return: number of seconds to wait before the next crawl
+        """
+        config = self.context.config
+        if elapsed_hours is not None and elapsed_hours > 0:
+            rate = new_pastes / elapsed_hours
+            if self.rate_per_hour is None:
+                self.rate_per_hour = rate
+            else:
+                self.rate_per_hour = config.SCHEDULER_RATE_SMOOTHING * rate + (1 - config.SCHEDULER_RATE_SMOOTHING) * self.rate_per_hour
+            self.logger.debug("Observed %.2f new pastes per hour, smoothed rate: %.2f", rate, self.rate_per_hour)
+
+        if self.rate_per_hour is None:
+            # nothing observed yet, the next crawl measures the rate
+            interval_minutes = config.SCHEDULER_MIN_INTERVAL_MINUTES
+        elif not self.rate_per_hour:
+            interval_minutes = config.SCHEDULER_MAX_INTERVAL_MINUTES
+        else:
+            interval_minutes = 60 * config.SCHEDULER_TARGET_NEW_PASTES / self.rate_per_hour
+        interval_minutes = min(max(interval_minutes, config.SCHEDULER_MIN_INTERVAL_MINUTES), config.SCHEDULER_MAX_INTERVAL_MINUTES)
+        return interval_minutes * 60
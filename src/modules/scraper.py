@@ -1,54 +1,245 @@
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 
-from app.models import Paste
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+from app.models import PasteRecord
 from modules.common import Base
 from modules.tor import WebRequest
 
 
+class PageTokenizer(HTMLParser):
+    """
+    Extracts the pagination numbers and the raw paste fields from a single pass over the page markup
+    without building any document tree
+
+    Follows the structure the Parser queries look for: every div.col-sm-12 element is a paste canvas,
+    its first div.pre-header holds the title in the first h4 element, the first ol element holds the content,
+    and the first div.col-sm-6 of the first div.pre-footer holds the author and the date
+
+    The text is collected the way BeautifulSoup get_text() does it: the character references are resolved
+    by the same bs4 helpers, CDATA sections are kept, while the text inside the HIDDEN_TEXT_ELEMENTS,
+    comments, declarations and processing instructions is left out
+    """
+    VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                               'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+    HIDDEN_TEXT_ELEMENTS = frozenset(['script', 'style', 'template', 'rt', 'rp'])
+    CDATA_PREFIX = 'CDATA['
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.navigation_texts = list()
+        self.pastes = list()
+        self._stack = list()
+        self._captures = list()
+        self._in_pagination = 0
+        self._in_hidden_text = 0
+
+    def _capture(self, canvas, field, entry):
+        buffer = list()
+        canvas[field] = buffer
+        entry['captures'].append(buffer)
+        self._captures.append(buffer)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_ELEMENTS:
+            return
+        classes = set()
+        for name, value in attrs:
+            if name == 'class' and value:
+                classes.update(value.split())
+        entry = {'tag': tag, 'captures': [], 'canvas': None, 'roles': [], 'pagination': False, 'hidden_text': tag in self.HIDDEN_TEXT_ELEMENTS}
+        if entry['hidden_text']:
+            self._in_hidden_text += 1
+
+        for parent in self._stack:
+            canvas = parent['canvas']
+            if canvas is None:
+                continue
+            if tag == 'ol' and 'content' not in canvas:
+                self._capture(canvas, 'content', entry)
+            elif tag == 'div' and 'pre-header' in classes and 'header' not in canvas:
+                canvas['header'] = True
+                entry['roles'].append(('header', canvas))
+            elif tag == 'div' and 'pre-footer' in classes and 'footer_found' not in canvas:
+                canvas['footer_found'] = True
+                entry['roles'].append(('footer', canvas))
+        for parent in self._stack:
+            for role, canvas in parent['roles']:
+                if role == 'header' and tag == 'h4' and 'title' not in canvas:
+                    self._capture(canvas, 'title', entry)
+                elif role == 'footer' and tag == 'div' and 'col-sm-6' in classes and 'footer' not in canvas:
+                    self._capture(canvas, 'footer', entry)
+
+        if tag == 'div' and 'col-sm-12' in classes:
+            entry['canvas'] = dict()
+            self.pastes.append(entry['canvas'])
+        if tag == 'ul' and 'pagination' in classes and not self.navigation_texts and not self._in_pagination:
+            entry['pagination'] = True
+            self._in_pagination += 1
+        if tag == 'a' and self._in_pagination:
+            self._capture(dict(), 'anchor', entry)
+            self.navigation_texts.append(entry['captures'][-1])
+        self._stack.append(entry)
+
+    def handle_endtag(self, tag):
+        for position in range(len(self._stack) - 1, -1, -1):
+            if self._stack[position]['tag'] == tag:
+                break
+        else:
+            return
+        while len(self._stack) > position:
+            entry = self._stack.pop()
+            for buffer in entry['captures']:
+                self._captures.remove(buffer)
+            if entry['pagination']:
+                self._in_pagination -= 1
+            if entry['hidden_text']:
+                self._in_hidden_text -= 1
+
+    def handle_data(self, data):
+        if self._in_hidden_text:
+            return
+        for buffer in self._captures:
+            buffer.append(data)
+
+    def handle_entityref(self, name):
+        # an unknown entity is literal text
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else '&{}'.format(name))
+
+    def handle_charref(self, name):
+        number = int(name[1:], 16) if name[:1] in ('x', 'X') else int(name)
+        self.handle_data(UnicodeDammit.numeric_character_reference(number)[0])
+
+    def unknown_decl(self, data):
+        if data.upper().startswith(self.CDATA_PREFIX):
+            self.handle_data(data[len(self.CDATA_PREFIX):])
+
+    def get_navigation_texts(self):
+        return [''.join(buffer) for buffer in self.navigation_texts]
+
+    def get_pastes(self):
+        """
+        :return: list of title, content, footer tuples of the canvases containing a pre-header
+        """
+        return [(''.join(canvas.get('title', [])), ''.join(canvas.get('content', [])), ''.join(canvas.get('footer', [])))
+                for canvas in self.pastes if canvas.get('header')]
+
+
 class Parser(Base):
     """
     Parses a Stronghold Paste web page
+
+    The [parser] engine setting is one of:
+        <tree builder name>: a BeautifulSoup tree builder (html.parser, lxml, ...) building the tree of the entire page
+        targeted[:<tree builder name>]: builds only the parts of the page the extraction methods need
+        streaming: extracts the values in a single tokenizer pass without building any tree
     """
+    TARGETED_ENGINE = 'targeted'
+    STREAMING_ENGINE = 'streaming'
+    DEFAULT_TREE_BUILDER = 'html.parser'
+    NAVIGATION_STRAINER = SoupStrainer('ul', 'pagination')
+    PASTES_STRAINER = SoupStrainer('div', 'col-sm-12')
+
     def __init__(self, context, page):
         super().__init__(context)
         self.page = page
-        self.soup = BeautifulSoup(page, context.config.PARSER_ENGINE)
+        self._engine, _, self._tree_builder = context.config.PARSER_ENGINE.partition(':')
+        if self._engine not in (self.TARGETED_ENGINE, self.STREAMING_ENGINE):
+            self._tree_builder = context.config.PARSER_ENGINE
+        self._tree_builder = self._tree_builder or self.DEFAULT_TREE_BUILDER
+        self._soup = None
+        self._tokenizer = None
 
-    def get_navigation_numbers(self):
-        return sorted(int(anchor.text) for anchor in self.soup.find('ul', 'pagination').find_all('a') if anchor.text.isnumeric())
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.page, self._tree_builder)
+        return self._soup
 
-    def extract_new_paste(self):
-        for paste_canvas in self.soup.find_all('div', 'col-sm-12'):
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = PageTokenizer()
+            self._tokenizer.feed(self.page)
+            self._tokenizer.close()
+        return self._tokenizer
+
+    def _get_soup(self, strainer):
+        if self._engine != self.TARGETED_ENGINE:
+            return self.soup
+        return BeautifulSoup(self.page, self._tree_builder, parse_only=strainer)
+
+    def _get_navigation_texts(self):
+        if self._engine == self.STREAMING_ENGINE:
+            return self.tokenizer.get_navigation_texts()
+        soup = self._get_soup(self.NAVIGATION_STRAINER)
+        return [anchor.text for anchor in soup.find('ul', 'pagination').find_all('a')]
+
+    def _get_raw_pastes(self):
+        """
+        :return: generator of title, content, footer
+        """
+        if self._engine == self.STREAMING_ENGINE:
+            yield from self.tokenizer.get_pastes()
+            return
+        soup = self._get_soup(self.PASTES_STRAINER)
+        for paste_canvas in soup.find_all('div', 'col-sm-12'):
             header = paste_canvas.find('div', 'pre-header')
             if not header:
                 continue
-            title = header.find('h4').text
-            content = paste_canvas.find('ol').text
-            footer = paste_canvas.find('div', 'pre-footer').find('div', 'col-sm-6').text
+            footer = paste_canvas.find('div', 'pre-footer')
+            # a missing element is an empty value, the same as the streaming engine has it
+            elements = [header.find('h4'), paste_canvas.find('ol'), footer.find('div', 'col-sm-6') if footer else None]
+            yield tuple(element.text if element is not None else '' for element in elements)
+
+    def get_navigation_numbers(self):
+        return sorted(int(text) for text in self._get_navigation_texts() if text.isnumeric())
+
+    def extract_new_paste(self):
+        """
+        :return: generator of raw (not yet normalized) paste records
+        """
+        for title, content, footer in self._get_raw_pastes():
             author, date = footer.split("at")
             author = author.replace("Posted by", "")
             date = date.strip()
-            yield Paste(self.context, author=author, title=title, content=content, date=date)
+            yield PasteRecord(author=author, title=title, content=content, date=date)
+
+
+def get_url_source(context, url):
+    """
+    :return: configured source the url belongs to, None if there is none
+    """
+    for source in context.config.WEB_SOURCES:
+        if url == source.main_url or url.startswith(source.page_url_prefix):
+            return source
+    return None
 
 
 class Navigator(Base):
     """
-    Navigates through the Stronghold Paste using its pagination section
+    Navigates through the Stronghold Paste using its pagination section, of the [website] source by default
     """
-    def __init__(self, context):
+    def __init__(self, context, web_request=None, source=None):
         super().__init__(context)
-        self.web_request = WebRequest(context)
+        self.web_request = web_request or WebRequest(context)
+        self.source = source or context.config.WEB_SOURCES[0]
 
-    def navigate(self):
+    def navigate(self, landing_page=None):
         """
-        :return: web page url, web page number
+        :param landing_page: already downloaded landing page content, requested if not passed
+        :return: web page url, web page number, web page content if it is already downloaded or None
         """
-        landing_page = self.web_request.get(self.context.config.WEB_MAIN_URL)
+        if landing_page is None:
+            landing_page = self.web_request.get(self.source.main_url)
         if not landing_page:
-            raise StopIteration
+            return
         parser = Parser(self.context, landing_page)
         navigation_numbers = parser.get_navigation_numbers()
 
-        yield self.context.config.WEB_MAIN_URL, 1
-        for page_number in range(navigation_numbers[0], navigation_numbers[-1] + 1):
-            yield '{}{}'.format(self.context.config.WEB_PAGE_URL_PREFIX, page_number), page_number
+        yield self.source.main_url, 1, landing_page
+        # the landing page is the first page itself
+        for page_number in range(max(navigation_numbers[0], 2), navigation_numbers[-1] + 1):
+            yield '{}{}'.format(self.source.page_url_prefix, page_number), page_number, None
@@ -0,0 +1,221 @@
+import array
+import hashlib
+import random
+import re
+import struct
+import zlib
+
+from modules.common import Base
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures of texts over their lowercase word shingles
+
+    The permutations are multiply-shift hashes ((a * x + b) mod 2^64) >> 32 of the 32-bit shingle hashes,
+    a and b are drawn from a fixed seed, so the signatures computed in different processes and runs are comparable
+    """
+    MASK = (1 << 64) - 1
+    WORD_PATTERN = re.compile(r'\w+')
+
+    def __init__(self, permutations, shingle_size, seed=1):
+        self.permutations = permutations
+        self.shingle_size = shingle_size
+        generator = random.Random(seed)
+        self._coefficients = [(generator.getrandbits(64) | 1, generator.getrandbits(64)) for _ in range(permutations)]
+
+    def get_shingle_hashes(self, text):
+        words = self.WORD_PATTERN.findall((text or '').lower())
+        if len(words) <= self.shingle_size:
+            shingles = [' '.join(words)]
+        else:
+            shingles = (' '.join(words[position:position + self.shingle_size]) for position in range(len(words) - self.shingle_size + 1))
+        return set(zlib.crc32(shingle.encode('utf-8')) for shingle in shingles)
+
+    def get_signature(self, text):
+        """
+        :return: array of the minimal permuted shingle hash per permutation
+        """
+        hashes = list(self.get_shingle_hashes(text))
+        mask = self.MASK
+        # the shift keeps the order, so it is taken once of the minimum, the inner list is quicker to build than a generator
+        return array.array('I', [min([(a * value + b) & mask for value in hashes]) >> 32 for a, b in self._coefficients])
+
+    @staticmethod
+    def to_bytes(signature):
+        return signature.tobytes()
+
+    @staticmethod
+    def from_bytes(data):
+        return array.array('I', bytes(data))
+
+    @staticmethod
+    def get_band_keys(signature, bands):
+        """
+        :return: list of signed 64-bit keys, one per band of len(signature) / bands rows, the band number included
+        """
+        rows = len(signature) // bands
+        return [int.from_bytes(hashlib.blake2b(struct.pack('>H', band) + signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(),
+                               'big', signed=True)
+                for band in range(bands)]
+
+    @staticmethod
+    def estimate_similarity(signature, other_signature):
+        """
+        :return: estimated Jaccard similarity of the shingle sets, the share of the equal signature values
+        """
+        return sum(1 for value, other_value in zip(signature, other_signature) if value == other_value) / len(signature)
+
+
+class SimilarityIndex(Base):
+    """
+    LSH index of the MinHash signatures of a model field, kept in two tables next to the model table:
+        <table>_minhash: signature and cluster id of every indexed row
+        <table>_lsh: a (band key, row id) pair per signature band, rows sharing a band key are candidates of each other
+    With b bands of r rows, two rows with a Jaccard similarity s share a band with a probability of 1 - (1 - s^r)^b,
+    the candidates are then checked against the threshold on their estimated similarity. A lookup reads
+    the b buckets of the signature only, no matter how large the table is, and checks the max_candidates rows
+    sharing the most bands with it.
+
+    A newly indexed row joins the cluster of its most similar indexed row above the threshold, otherwise it starts
+    a cluster identified by its own id. Deleting a row or updating its field drops it from the index,
+    iterate_missing() finds the rows to index again.
+    """
+    def __init__(self, context, model, field_name, connection):
+        super().__init__(context)
+        self.model = model
+        self.field_name = field_name
+        self.connection = connection
+        self.table_name = model.get_table_name()
+        self.minhash_table_name = '{}_minhash'.format(self.table_name)
+        self.lsh_table_name = '{}_lsh'.format(self.table_name)
+        self.min_hasher = MinHasher(context.config.SIMILARITY_PERMUTATIONS, context.config.SIMILARITY_SHINGLE_SIZE)
+
+    def create_tables_if_necessary(self):
+        id_field = self.context.config.DB_ID_FIELD
+        queries = ["CREATE TABLE IF NOT EXISTS {minhash} ({id_field} integer primary key, signature blob, cluster_id integer)",
+                   "CREATE INDEX IF NOT EXISTS idx_{minhash}_cluster_id ON {minhash} (cluster_id)",
+                   "CREATE TABLE IF NOT EXISTS {lsh} (band_key integer, {id_field} integer, PRIMARY KEY (band_key, {id_field})) WITHOUT ROWID",
+                   "CREATE INDEX IF NOT EXISTS idx_{lsh}_{id_field} ON {lsh} ({id_field})",
+                   "CREATE TRIGGER IF NOT EXISTS trg_{minhash}_delete AFTER DELETE ON {table} BEGIN "
+                   "DELETE FROM {minhash} WHERE {id_field} = old.{id_field}; "
+                   "DELETE FROM {lsh} WHERE {id_field} = old.{id_field}; "
+                   "END",
+                   "CREATE TRIGGER IF NOT EXISTS trg_{minhash}_update AFTER UPDATE OF {field} ON {table} BEGIN "
+                   "DELETE FROM {minhash} WHERE {id_field} = old.{id_field}; "
+                   "DELETE FROM {lsh} WHERE {id_field} = old.{id_field}; "
+                   "END"]
+        for query in queries:
+            self.connection.execute(query.format(minhash=self.minhash_table_name, lsh=self.lsh_table_name, table=self.table_name,
+                                                 id_field=id_field, field=self.field_name))
+        self.connection.shared_connection.commit()
+
+    def _get_field_value_expression(self):
+        if self.field_name in self.model.get_compressed_fields():
+            return 'decompress(t.{})'.format(self.field_name)
+        return 't.{}'.format(self.field_name)
+
+    def get_missing(self, after_id=0, limit=-1):
+        """
+        :return: list of (row id, field value) of the rows with a greater id missing from the index, in the id order
+        """
+        id_field = self.context.config.DB_ID_FIELD
+        return self.connection.execute_fetch_all("SELECT t.{id_field}, {value} FROM {table} t "
+                                                 "WHERE t.{id_field} > {placeholder} "
+                                                 "AND NOT EXISTS (SELECT 1 FROM {minhash} m WHERE m.{id_field} = t.{id_field}) "
+                                                 "ORDER BY t.{id_field} LIMIT {placeholder}".format(id_field=id_field,
+                                                                                                   value=self._get_field_value_expression(),
+                                                                                                   table=self.table_name,
+                                                                                                   minhash=self.minhash_table_name,
+                                                                                                   placeholder=self.connection.placeholder),
+                                                 (after_id, limit))
+
+    def iterate_missing(self, chunk_size):
+        """
+        :return: generator of lists of (row id, field value) of the rows missing from the index
+        """
+        after_id = 0
+        while True:
+            rows = self.get_missing(after_id, chunk_size)
+            if not rows:
+                return
+            yield rows
+            after_id = rows[-1][0]
+
+    def get_candidates(self, signature, exclude_id=None):
+        """
+        :return: list of (row id, cluster id, estimated similarity) of the indexed rows similar above the threshold,
+                 the most similar first
+        """
+        config = self.context.config
+        band_keys = self.min_hasher.get_band_keys(signature, config.SIMILARITY_BANDS)
+        id_field = config.DB_ID_FIELD
+        rows = self.connection.execute_fetch_all("SELECT m.{id_field}, m.cluster_id, m.signature FROM {minhash} m "
+                                                 "WHERE m.{id_field} IN (SELECT {id_field} FROM {lsh} WHERE band_key IN ({placeholders}) AND {id_field} IS NOT {placeholder} "
+                                                 # the rows sharing more bands are the likelier to be similar
+                                                 "GROUP BY {id_field} ORDER BY COUNT(*) DESC, {id_field} LIMIT {placeholder})"
+                                                 .format(id_field=id_field, minhash=self.minhash_table_name, lsh=self.lsh_table_name,
+                                                         placeholders=', '.join([self.connection.placeholder] * len(band_keys)),
+                                                         placeholder=self.connection.placeholder),
+                                                 band_keys + [exclude_id, config.SIMILARITY_MAX_CANDIDATES])
+        candidates = list()
+        for row_id, cluster_id, candidate_signature in rows:
+            similarity = self.min_hasher.estimate_similarity(signature, self.min_hasher.from_bytes(candidate_signature))
+            if similarity >= config.SIMILARITY_THRESHOLD:
+                candidates.append((row_id, cluster_id, similarity))
+        candidates.sort(key=lambda candidate: (-candidate[2], candidate[0]))
+        return candidates
+
+    def add(self, signatures):
+        """
+        Indexes the rows one after another, so each of them can join the cluster of the ones before,
+        the caller commits
+        :param signatures: iterable of (row id, signature)
+        :return: number of rows indexed
+        """
+        id_field = self.context.config.DB_ID_FIELD
+        placeholder = self.connection.placeholder
+        indexed_rows = 0
+        for row_id, signature in signatures:
+            candidates = self.get_candidates(signature, exclude_id=row_id)
+            cluster_id = candidates[0][1] if candidates else row_id
+            cursor = self.connection.execute("INSERT OR IGNORE INTO {} ({}, signature, cluster_id) VALUES ({p}, {p}, {p})".format(self.minhash_table_name, id_field, p=placeholder),
+                                             (row_id, self.min_hasher.to_bytes(signature), cluster_id))
+            if cursor.rowcount <= 0:
+                # indexed meanwhile by another writer
+                continue
+            self.connection.execute("INSERT OR IGNORE INTO {} (band_key, {}) VALUES ({p}, {p})".format(self.lsh_table_name, id_field, p=placeholder),
+                                    [(band_key, row_id) for band_key in self.min_hasher.get_band_keys(signature, self.context.config.SIMILARITY_BANDS)],
+                                    many=True)
+            indexed_rows += 1
+        return indexed_rows
+
+    def lookup(self, row_id):
+        """
+        :return: cluster id, list of (row id, cluster id, estimated similarity) of the similar rows;
+                 None, empty list if the row is not indexed
+        """
+        row = self.connection.execute_fetch_one_record("SELECT cluster_id, signature FROM {} WHERE {} = {}".format(self.minhash_table_name,
+                                                                                                                  self.context.config.DB_ID_FIELD,
+                                                                                                                  self.connection.placeholder),
+                                                       (row_id,))
+        if row is None:
+            return None, list()
+        cluster_id, signature = row
+        return cluster_id, self.get_candidates(self.min_hasher.from_bytes(signature), exclude_id=row_id)
+
+    def lookup_text(self, text):
+        """
+        :return: list of (row id, cluster id, estimated similarity) of the indexed rows similar to the text
+        """
+        return self.get_candidates(self.min_hasher.get_signature(text))
+
+    def get_cluster_ids(self, cluster_id):
+        """
+        :return: list of the ids of the rows in the cluster
+        """
+        rows = self.connection.execute_fetch_all("SELECT {id_field} FROM {minhash} WHERE cluster_id = {placeholder} ORDER BY {id_field}".format(id_field=self.context.config.DB_ID_FIELD,
+                                                                                                                                                minhash=self.minhash_table_name,
+                                                                                                                                                placeholder=self.connection.placeholder),
+                                                 (cluster_id,))
+        return [row[0] for row in rows]
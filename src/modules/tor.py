@@ -1,24 +1,478 @@
+import collections
+import concurrent.futures
+import hashlib
+import random
 import requests
+import threading
 import time
 
 from modules.common import Base
+from modules.metrics import Metrics
+
+
+def get_percentile(values, fraction):
+    """
+    :return: nearest-rank percentile of the values
+    """
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class RetryBudget:
+    """
+    Caps the retries and hedged requests at a share of the requests sent since the last reset(),
+    so an unreachable website or a broken TOR is not hammered with a multiple of the usual load
+    """
+    def __init__(self, ratio, minimum):
+        self.ratio = ratio
+        self.minimum = minimum
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests_count = 0
+            self.spent = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests_count += 1
+
+    def spend(self):
+        """
+        :return: whether another retry or hedged request fits in the budget
+        """
+        with self._lock:
+            if self.spent >= self.minimum + self.ratio * self.requests_count:
+                return False
+            self.spent += 1
+            return True
+
+
+class SocksEndpoint:
+    """
+    A single TOR SOCKS proxy, with its own session and health statistics
+    """
+    def __init__(self, name, proxies):
+        self.name = name
+        self.proxies = proxies
+        self.session = None
+        self.last_used = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests_count = 0
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+
+    def is_ejected(self, now):
+        return self.ejected_until is not None and now < self.ejected_until
+
+
+class SocksEndpointPool(Base):
+    """
+    Spreads the requests across the SOCKS endpoints of the [tor] section
+
+    Every request goes to the better of two randomly picked healthy endpoints, scored by the latency average
+    multiplied by the requests in flight, so a slow circuit gets less traffic. A small share of the requests
+    goes to any healthy endpoint, so a slow circuit still gets the requests that would show it got faster. An endpoint failing max_consecutive_failures requests in a row, or more than
+    max_error_rate of its recent requests, is taken out of rotation for ejection_timeout seconds, doubled on every
+    ejection in a row. The first request after that is a probe: a success puts the endpoint back into rotation.
+    """
+    LATENCY_DECAY = 0.3
+    EXPLORATION_RATE = 0.05
+    ERROR_RATE_DECAY = 0.1
+    MIN_REQUESTS = 10
+    MAX_EJECTION_MULTIPLIER = 16
+
+    def __init__(self, context):
+        super().__init__(context)
+        self.endpoints = self._create_endpoints()
+        self.metrics = Metrics.get(context)
+        self._lock = threading.Lock()
+
+    def _create_endpoints(self):
+        config = self.context.config
+        if not config.TOR_ENDPOINTS:
+            proxies = {'http': 'socks5://{}:{}'.format(config.TOR_HOSTNAME, config.TOR_HTTP_PROXY_PORT),
+                       'https': 'socks5://{}:{}'.format(config.TOR_HOSTNAME, config.TOR_HTTPS_PROXY_PORT)}
+            return [SocksEndpoint('{}:{}'.format(config.TOR_HOSTNAME, config.TOR_HTTP_PROXY_PORT), proxies)]
+        endpoints = list()
+        for endpoint in config.TOR_ENDPOINTS:
+            hostname, _, port = endpoint.rpartition(':')
+            name = '{}:{}'.format(hostname or config.TOR_HOSTNAME, port)
+            endpoints.append(SocksEndpoint(name, {'http': 'socks5://{}'.format(name), 'https': 'socks5://{}'.format(name)}))
+        return endpoints
+
+    def _get_score(self, endpoint):
+        # endpoints without a latency sample yet are tried first
+        return (endpoint.latency or 0.0) * (endpoint.in_flight + 1)
+
+    def acquire(self, exclude=None):
+        """
+        :param exclude: endpoint to avoid if there is another one available, e.g. the one the previous attempt failed on
+        :return: endpoint to send the request through, released with release() once the request is done
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if not endpoint.is_ejected(now)]
+            if len(candidates) > 1 and exclude in candidates:
+                candidates.remove(exclude)
+            if not candidates:
+                # everything is out of rotation: the endpoint coming back first is still better than failing
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            if random.random() < self.EXPLORATION_RATE:
+                endpoint = random.choice(candidates)
+            else:
+                endpoint = min(random.sample(candidates, min(len(candidates), 2)), key=self._get_score)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint, elapsed, failed):
+        """
+        :param elapsed: seconds the request took, None if it was never sent, e.g. a cancelled hedge
+        :return: whether the endpoint has just been taken out of rotation
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if elapsed is None:
+                return False
+            endpoint.requests_count += 1
+            endpoint.error_rate += self.ERROR_RATE_DECAY * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            if failed:
+                endpoint.consecutive_failures += 1
+                if self._is_unhealthy(endpoint):
+                    self._eject(endpoint)
+                    return True
+                return False
+            endpoint.latency = elapsed if endpoint.latency is None else endpoint.latency + self.LATENCY_DECAY * (elapsed - endpoint.latency)
+            endpoint.consecutive_failures = 0
+            if endpoint.ejected_until is not None:
+                self.logger.info("SOCKS endpoint %s recovered: back in rotation", endpoint.name)
+                endpoint.ejected_until = None
+                endpoint.ejections = 0
+                endpoint.error_rate = 0.0
+        self.metrics.observe('endpoint_request_seconds', elapsed, endpoint=endpoint.name)
+        return False
+
+    def _is_unhealthy(self, endpoint):
+        config = self.context.config
+        if endpoint.ejected_until is not None:
+            # a failed probe
+            return True
+        return (endpoint.consecutive_failures >= config.TOR_MAX_CONSECUTIVE_FAILURES or
+                (endpoint.requests_count >= self.MIN_REQUESTS and endpoint.error_rate > config.TOR_MAX_ERROR_RATE))
+
+    def _eject(self, endpoint):
+        ejection_timeout = self.context.config.TOR_EJECTION_TIMEOUT * min(2 ** endpoint.ejections, self.MAX_EJECTION_MULTIPLIER)
+        endpoint.ejections += 1
+        endpoint.ejected_until = time.monotonic() + ejection_timeout
+        self.metrics.increment('endpoint_ejections_total', endpoint=endpoint.name)
+        self.logger.warning("SOCKS endpoint %s is unhealthy (%s failures in a row, %.0f%% error rate): out of rotation for %s seconds",
+                            endpoint.name, endpoint.consecutive_failures, endpoint.error_rate * 100, ejection_timeout)
+
+    def get_stats(self):
+        """
+        :return: list of (name, average latency or None, error rate, whether it is in rotation) tuples
+        """
+        with self._lock:
+            now = time.monotonic()
+            return [(endpoint.name, endpoint.latency, endpoint.error_rate, not endpoint.is_ejected(now)) for endpoint in self.endpoints]
 
 
 class WebRequest(Base):
+    """
+    Requests web pages through the TOR proxies
+
+    Keeps a persistent session with a keep-alive connection pool per SOCKS endpoint,
+    so consecutive requests reuse the already established SOCKS connections.
+    A request left without a response for longer than the hedge_percentile of the recent request latencies
+    is hedged: a duplicate goes through another endpoint and whichever response comes first is used.
+    Failed attempts are retried with an exponential backoff, the retries and the hedged requests
+    are limited by the retry budget renewed with start_crawl().
+    """
+    HEADERS = {'Accept-Encoding': 'gzip, deflate',
+               'Connection': 'keep-alive'}
+    LATENCY_WINDOW = 500
+    MIN_LATENCY_SAMPLES = 20
+
     def __init__(self, context):
         super().__init__(context)
-        self._proxies = {'http': 'socks5://{}:{}'.format(self.context.config.TOR_HOSTNAME, self.context.config.TOR_HTTP_PROXY_PORT),
-                         'https': 'socks5://{}:{}'.format(self.context.config.TOR_HOSTNAME, self.context.config.TOR_HTTPS_PROXY_PORT)}
+        self.endpoint_pool = SocksEndpointPool(context)
+        self._session_lock = threading.Lock()
+        self._closed_pools_stats = (0, 0)
+        self._validators = dict()
+        self._executor = None
+        self._latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self._latencies_lock = threading.Lock()
+        self.retry_budget = RetryBudget(self.context.config.WEB_RETRY_BUDGET_RATIO, self.context.config.WEB_RETRY_BUDGET_MIN)
+        self.metrics = Metrics.get(context)
+        self.start_crawl()
 
-    def get(self, url, json=False):
+    def _get_session(self, endpoint):
+        with self._session_lock:
+            if endpoint.session is not None and time.monotonic() - endpoint.last_used > self.context.config.WEB_SESSION_IDLE_TIMEOUT:
+                self.logger.debug("Session of %s has been idle for more than %s seconds: reconnecting", endpoint.name, self.context.config.WEB_SESSION_IDLE_TIMEOUT)
+                self._close_session(endpoint)
+            if endpoint.session is None:
+                endpoint.session = self._create_session(endpoint)
+            endpoint.last_used = time.monotonic()
+            return endpoint.session
+
+    def _create_session(self, endpoint):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.context.config.WEB_POOL_CONNECTIONS,
+                                                pool_maxsize=self.context.config.WEB_POOL_MAXSIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.HEADERS)
+        session.proxies.update(endpoint.proxies)
+        return session
+
+    def _close_session(self, endpoint):
+        connections, requests_count = self._collect_pools_stats(endpoint.session)
+        closed_connections, closed_requests = self._closed_pools_stats
+        self._closed_pools_stats = (closed_connections + connections, closed_requests + requests_count)
+        endpoint.session.close()
+        endpoint.session = None
+
+    @staticmethod
+    def _collect_pools_stats(session):
+        """
+        :return: number of connections opened, number of requests sent through those connections
+        """
+        connections, requests_count = 0, 0
+        if session is None:
+            return connections, requests_count
+        # the pool counters are urllib3 internals, the adapters and urllib3 releases lacking them count nothing
+        for adapter in set(session.adapters.values()):
+            pool_managers = [getattr(adapter, 'poolmanager', None)] + list(getattr(adapter, 'proxy_manager', dict()).values())
+            for pool_manager in pool_managers:
+                pools = getattr(pool_manager, 'pools', None)
+                if pools is None:
+                    continue
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is not None:
+                        connections += getattr(pool, 'num_connections', 0)
+                        requests_count += getattr(pool, 'num_requests', 0)
+        return connections, requests_count
+
+    def get_connection_reuse_stats(self):
+        """
+        :return: number of connections opened, number of requests sent, number of requests sent over reused connections
+        """
+        connections, requests_count = 0, 0
+        with self._session_lock:
+            for endpoint in self.endpoint_pool.endpoints:
+                endpoint_connections, endpoint_requests = self._collect_pools_stats(endpoint.session)
+                connections += endpoint_connections
+                requests_count += endpoint_requests
+        closed_connections, closed_requests = self._closed_pools_stats
+        connections += closed_connections
+        requests_count += closed_requests
+        return connections, requests_count, max(requests_count - connections, 0)
+
+    def _send(self, endpoint, url, headers, sending=None, answered=None):
+        """
+        Sends a single request through the endpoint and releases it
+        :param sending: event set once the request is about to be sent
+        :param answered: event set once a response arrives, a hedge picked up after that is not sent
+        :return: response, None if the request was answered already
+        """
+        if answered is not None and answered.is_set():
+            self.endpoint_pool.release(endpoint, None, failed=False)
+            return None
+        if sending is not None:
+            sending.set()
+        started = time.perf_counter()
+        try:
+            result = self._get_session(endpoint).get(url, headers=headers, timeout=self.context.config.WEB_REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            elapsed = time.perf_counter() - started
+            if self.endpoint_pool.release(endpoint, elapsed, failed=True):
+                # the kept-alive connections of a broken circuit are of no use to the probe
+                with self._session_lock:
+                    if endpoint.session is not None:
+                        self._close_session(endpoint)
+            self.metrics.observe('request_seconds', elapsed)
+            self.metrics.increment('requests_total', status='error')
+            self.logger.error("Error when requesting URL %s through %s: %s", url, endpoint.name, e)
+            raise
+        elapsed = time.perf_counter() - started
+        if answered is not None:
+            answered.set()
+        self.endpoint_pool.release(endpoint, elapsed, failed=False)
+        with self._latencies_lock:
+            self._latencies.append(elapsed)
+        self.metrics.observe('request_seconds', elapsed)
+        self.metrics.increment('requests_total', status=result.status_code)
+        self.metrics.increment('fetched_bytes_total', len(result.content))
+        return result
+
+    def get_hedge_delay(self):
+        """
+        :return: seconds to wait for a response before sending a hedged request, None if hedging is off
+                 or there are not enough latency samples yet
+        """
+        config = self.context.config
+        if not config.WEB_HEDGE_PERCENTILE:
+            return None
+        with self._latencies_lock:
+            if len(self._latencies) < self.MIN_LATENCY_SAMPLES:
+                return None
+            latencies = list(self._latencies)
+        return max(get_percentile(latencies, config.WEB_HEDGE_PERCENTILE / 100), config.WEB_HEDGE_MIN_DELAY)
+
+    def _get_executor(self):
+        with self._session_lock:
+            if self._executor is None:
+                # the requests that lost to their hedges keep a thread until they finish or time out
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=4 * (self.context.config.WEB_MAX_PAGES_IN_FLIGHT + 1),
+                                                                       thread_name_prefix='WebRequest')
+            return self._executor
+
+    def _send_hedged(self, endpoint, url, headers):
+        """
+        Sends the request and, if no response arrives within the hedge delay, a duplicate through another endpoint
+        :return: response of whichever request succeeds first
+        """
+        hedge_delay = self.get_hedge_delay()
+        if hedge_delay is None:
+            return self._send(endpoint, url, headers)
+        executor = self._get_executor()
+        sending, answered = threading.Event(), threading.Event()
+        pending = {executor.submit(self._send, endpoint, url, headers, sending, answered): endpoint}
+        # the delay runs from the moment the request is sent, not while it waits for a free executor thread
+        sending.wait()
+        done, _ = concurrent.futures.wait(pending, timeout=hedge_delay)
+        if not done and self.retry_budget.spend():
+            hedge_endpoint = self.endpoint_pool.acquire(exclude=endpoint)
+            self.logger.debug("No response from %s in %.3f seconds: hedging through %s", endpoint.name, hedge_delay, hedge_endpoint.name)
+            self.metrics.increment('request_hedges_total')
+            with self._latencies_lock:
+                self._crawl_stats['hedged'] += 1
+            pending[executor.submit(self._send, hedge_endpoint, url, headers, answered=answered)] = hedge_endpoint
+        error = None
+        try:
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    try:
+                        response = future.result()
+                    except requests.RequestException as e:
+                        error = e
+                        continue
+                    # None is a hedge left unsent, the response it lost to is still on its way
+                    if response is not None:
+                        return response
+        finally:
+            # the losing request keeps running unless it is still waiting for a thread,
+            # a thread picking it up meanwhile finds the request answered and does not send it
+            for future, future_endpoint in pending.items():
+                if future.cancel():
+                    self.endpoint_pool.release(future_endpoint, None, failed=False)
+        raise error
+
+    def _get_backoff(self, attempt):
+        """
+        :return: seconds to sleep before the retry, exponential with full jitter so the retries of the parallel fetches spread out
+        """
+        config = self.context.config
+        return random.uniform(0, min(config.WEB_RETRY_TIMEOUT * 2 ** (attempt - 1), config.WEB_RETRY_MAX_TIMEOUT))
+
+    def get_response(self, url, headers=None):
+        """
+        :return: response of the first successful attempt
+        """
         self.logger.debug("Requesting %s", url)
+        started = time.perf_counter()
+        self.retry_budget.record_request()
+        failed_endpoint = None
         for attempt in range(self.context.config.WEB_MAX_RETRIES + 1):
+            if attempt:
+                if not self.retry_budget.spend():
+                    self.logger.error("Retry budget of the crawl is exhausted: giving up on %s", url)
+                    break
+                self.metrics.increment('request_retries_total')
+                with self._latencies_lock:
+                    self._crawl_stats['retried'] += 1
+                time.sleep(self._get_backoff(attempt))
+            endpoint = self.endpoint_pool.acquire(exclude=failed_endpoint)
+            self.logger.debug("Attempt #%s through %s", attempt, endpoint.name)
             try:
-                self.logger.debug("Attempt #%s", attempt)
-                result = requests.get(url, proxies=self._proxies, timeout=self.context.config.WEB_REQUEST_TIMEOUT)
-            except requests.RequestException as e:
-                self.logger.error("Error when requesting URL %s: %s", url, e)
-                time.sleep(self.context.config.WEB_RETRY_TIMEOUT)
-            else:
-                return result.json() if json else result.text
+                result = self._send_hedged(endpoint, url, headers)
+            except requests.RequestException:
+                failed_endpoint = endpoint
+                continue
+            elapsed = time.perf_counter() - started
+            self.metrics.observe('page_seconds', elapsed)
+            with self._latencies_lock:
+                self._crawl_stats['page_latencies'].append(elapsed)
+            return result
         raise ConnectionError("Max retries reached when trying to request url {}".format(url))
+
+    def start_crawl(self):
+        """
+        Renews the retry budget and the latency statistics reported by get_crawl_stats()
+        """
+        self.retry_budget.reset()
+        with self._latencies_lock:
+            self._crawl_stats = {'page_latencies': list(), 'hedged': 0, 'retried': 0}
+
+    def get_crawl_stats(self):
+        """
+        :return: number of pages fetched since start_crawl(), p50 and p99 page latency in seconds (None without pages),
+                 number of hedged requests, number of retries
+        """
+        with self._latencies_lock:
+            page_latencies = list(self._crawl_stats['page_latencies'])
+            hedged, retried = self._crawl_stats['hedged'], self._crawl_stats['retried']
+        if not page_latencies:
+            return 0, None, None, hedged, retried
+        return len(page_latencies), get_percentile(page_latencies, 0.5), get_percentile(page_latencies, 0.99), hedged, retried
+
+    def get(self, url, json=False):
+        result = self.get_response(url)
+        return result.json() if json else result.text
+
+    def get_if_changed(self, url):
+        """
+        Sends a conditional request using the ETag and Last-Modified validators of the previous response
+        and compares the content digest in case the server ignores them
+        :return: page content, None if it has not changed since the previous call
+        """
+        etag, last_modified, digest = self._validators.get(url, (None, None, None))
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        result = self.get_response(url, headers=headers)
+        if result.status_code == requests.codes.not_modified:
+            self.logger.debug("%s not modified", url)
+            return None
+
+        content_digest = hashlib.sha1(result.content).hexdigest()
+        self._validators[url] = (result.headers.get('ETag'), result.headers.get('Last-Modified'), content_digest)
+        if content_digest == digest:
+            self.logger.debug("%s content has not changed", url)
+            return None
+        return result.text
+
+    def forget_validators(self, url):
+        """
+        Makes the next get_if_changed() call download the page whether it changed or not
+        """
+        self._validators.pop(url, None)
+
+    def close(self):
+        with self._session_lock:
+            for endpoint in self.endpoint_pool.endpoints:
+                if endpoint.session is not None:
+                    self._close_session(endpoint)
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
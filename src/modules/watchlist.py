@@ -0,0 +1,285 @@
+import collections
+import os
+import re
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton finding every occurrence of a set of literal terms in a single pass over the text,
+    however many terms there are. Terms are matched case-insensitively, the text is lowercased once per search.
+    """
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self._transitions = [dict()]
+        self._failures = [0]
+        self._outputs = [tuple()]
+        for term_index, term in enumerate(self.terms):
+            self._add(term.lower(), term_index)
+        self._link_failures()
+
+    def _add(self, term, term_index):
+        state = 0
+        for char in term:
+            next_state = self._transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append(dict())
+                self._failures.append(0)
+                self._outputs.append(tuple())
+                self._transitions[state][char] = next_state
+            state = next_state
+        self._outputs[state] += (term_index,)
+
+    def _link_failures(self):
+        # breadth first, so the failure state of a state is always linked before the state itself
+        states = collections.deque(self._transitions[0].values())
+        while states:
+            state = states.popleft()
+            for char, next_state in self._transitions[state].items():
+                states.append(next_state)
+                failure = self._failures[state]
+                while failure and char not in self._transitions[failure]:
+                    failure = self._failures[failure]
+                self._failures[next_state] = self._transitions[failure].get(char, 0)
+                # a term ending here ends every term its longest proper suffix state ends too
+                self._outputs[next_state] += self._outputs[self._failures[next_state]]
+
+    def find_all(self, text):
+        """
+        :return: generator of (term index, end position in the lowercased text) of every occurrence
+        """
+        transitions, failures, outputs = self._transitions, self._failures, self._outputs
+        state = 0
+        for position, char in enumerate(text.lower()):
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            for term_index in outputs[state]:
+                yield term_index, position
+
+
+class Watchlist:
+    """
+    Literal terms and regular expressions looked up in the texts at once:
+    the terms by a single AhoCorasick automaton, the regular expressions by a single lookahead pattern
+    alternating them all as named groups, see _combine().
+
+    The watchlist file holds an entry per line, the lines starting with re: are regular expressions,
+    the empty ones and the ones starting with # are skipped, e.g.
+        leaks@example.com
+        re:\\b[13][a-km-zA-HJ-NP-Z1-9]{25,34}\\b
+    Regular expressions are case-sensitive unless they say otherwise with a flag, e.g. (?i) or (?i:...).
+    Every regular expression finds what it would find on its own, the matches of the others notwithstanding:
+    the combined pattern stops at every position some of them match at, where the ones alternated after the first
+    matching one are tried as well. The ones that cannot be alternated, e.g. using numbered back-references
+    or the group names of the others, are searched for one by one.
+    """
+    TERM = 'term'
+    REGEX = 'regex'
+    REGEX_PREFIX = 're:'
+    WORD_BOUNDARY = r'\b'
+    GROUP_NAME = '_{}'
+    GLOBAL_FLAGS_PATTERN = re.compile(r'\(\?([aiLmsux]+)\)')
+    NUMBERED_REFERENCE_PATTERN = re.compile(r'\\[1-9]|\(\?\(\d')
+    MAX_VALUE_LENGTH = 256
+
+    def __init__(self, terms=(), patterns=()):
+        self.terms = sorted(set(term for term in terms if term))
+        self.patterns = list(dict.fromkeys(patterns))
+        self._automaton = AhoCorasick(self.terms) if self.terms else None
+        self._compiled_patterns = list()
+        for pattern in self.patterns:
+            try:
+                self._compiled_patterns.append(re.compile(pattern))
+            except re.error as e:
+                raise ValueError("Invalid regular expression {!r}: {}".format(pattern, e))
+        self._pattern = None
+        self._pattern_order = list()
+        combined_patterns = self._select_combined_patterns()
+        if combined_patterns:
+            pattern, self._pattern_order = self._combine(combined_patterns)
+            try:
+                self._pattern = re.compile(pattern)
+            except re.error:
+                self._pattern, self._pattern_order = None, list()
+                combined_patterns = dict()
+        self._separate_pattern_indexes = [pattern_index for pattern_index in range(len(self.patterns)) if pattern_index not in combined_patterns]
+        self._pattern_ranks = {pattern_index: rank for rank, pattern_index in enumerate(self._pattern_order)}
+
+    @classmethod
+    def _scope_global_flags(cls, pattern):
+        """
+        :return: pattern with its leading global flags, e.g. (?i)secret, turned into a scoped group, e.g. (?i:secret)
+        """
+        flags = ''
+        match = cls.GLOBAL_FLAGS_PATTERN.match(pattern)
+        while match:
+            flags += match.group(1)
+            pattern = pattern[match.end():]
+            match = cls.GLOBAL_FLAGS_PATTERN.match(pattern)
+        if not flags:
+            return pattern
+        # a verbose pattern may end with a comment, which would swallow the closing parenthesis
+        return '(?{}:{}{})'.format(flags, pattern, '\n' if 'x' in flags else '')
+
+    def _select_combined_patterns(self):
+        """
+        :return: dict of the indexes of the patterns that can be alternated to the patterns to alternate
+        """
+        combined_patterns = dict()
+        group_names = set(self.GROUP_NAME.format(pattern_index) for pattern_index in range(len(self.patterns)))
+        for pattern_index, (pattern, compiled_pattern) in enumerate(zip(self.patterns, self._compiled_patterns)):
+            # numbered references would refer to the groups of the others once the patterns are alternated,
+            # the escaped backslashes are left out, so the digit after one is not taken for a reference
+            if set(compiled_pattern.groupindex) & group_names or self.NUMBERED_REFERENCE_PATTERN.search(pattern.replace('\\\\', '')):
+                continue
+            pattern = self._scope_global_flags(pattern)
+            try:
+                re.compile('(?P<{}>{})'.format(self.GROUP_NAME.format(pattern_index), pattern))
+            except re.error:
+                continue
+            group_names.update(compiled_pattern.groupindex)
+            combined_patterns[pattern_index] = pattern
+        return combined_patterns
+
+    @staticmethod
+    def _has_top_level_alternation(pattern):
+        depth, position, in_class = 0, 0, False
+        while position < len(pattern):
+            char = pattern[position]
+            if char == '\\':
+                position += 1
+            elif in_class:
+                in_class = char != ']'
+            elif char == '[':
+                in_class = True
+                # a closing bracket right after the opening one (or its negation) is a member of the class
+                if pattern[position + 1:position + 2] == '^':
+                    position += 1
+                if pattern[position + 1:position + 2] == ']':
+                    position += 1
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == '|' and depth == 0:
+                return True
+            position += 1
+        return False
+
+    @classmethod
+    def _combine(cls, patterns):
+        """
+        :param patterns: dict of the pattern indexes to the patterns
+        :return: lookahead pattern alternating the patterns as named groups, list of the pattern indexes in the alternation order;
+                 the patterns starting with a word boundary share it, so the engine only tries them at the word boundaries
+                 instead of at every position of the text
+        """
+        bounded, unbounded = list(), list()
+        for pattern_index, pattern in patterns.items():
+            if pattern.startswith(cls.WORD_BOUNDARY) and len(pattern) > len(cls.WORD_BOUNDARY) and not cls._has_top_level_alternation(pattern):
+                bounded.append((pattern_index, '(?P<{}>{})'.format(cls.GROUP_NAME.format(pattern_index), pattern[len(cls.WORD_BOUNDARY):])))
+            else:
+                unbounded.append((pattern_index, '(?P<{}>{})'.format(cls.GROUP_NAME.format(pattern_index), pattern)))
+        alternatives = ['{}(?:{})'.format(cls.WORD_BOUNDARY, '|'.join(group for _, group in bounded))] if bounded else list()
+        # the lookahead consumes nothing, so the matches overlapping the previous ones are found too
+        return '(?={})'.format('|'.join(alternatives + [group for _, group in unbounded])), [pattern_index for pattern_index, _ in bounded + unbounded]
+
+    @classmethod
+    def load(cls, filepath):
+        terms, patterns = list(), list()
+        with open(filepath, encoding='utf-8') as watchlist_file:
+            for line in watchlist_file:
+                entry = line.strip()
+                if not entry or entry.startswith('#'):
+                    continue
+                if entry.startswith(cls.REGEX_PREFIX):
+                    patterns.append(entry[len(cls.REGEX_PREFIX):])
+                else:
+                    terms.append(entry)
+        return cls(terms, patterns)
+
+    def __len__(self):
+        return len(self.terms) + len(self.patterns)
+
+    def _match_combined_patterns(self, text):
+        """
+        Gives every pattern the matches its own finditer() would: a pattern is tried at the positions
+        the combined pattern stops at, from the end of its previous match on
+        :return: generator of (pattern index, matched value)
+        """
+        if self._pattern is None:
+            return
+        match_ends = dict()
+        for position_match in self._pattern.finditer(text):
+            position = position_match.start()
+            # the named groups wrap the patterns whole, so the last one closed is the first alternative matching here,
+            # the ones alternated before it do not match here
+            first_pattern_index = int(position_match.lastgroup[len(self.GROUP_NAME.format('')):])
+            for pattern_index in self._pattern_order[self._pattern_ranks[first_pattern_index]:]:
+                if position < match_ends.get(pattern_index, 0):
+                    continue
+                if pattern_index == first_pattern_index:
+                    group_name = self.GROUP_NAME.format(pattern_index)
+                    value, end = position_match.group(group_name), position_match.end(group_name)
+                else:
+                    match = self._compiled_patterns[pattern_index].match(text, position)
+                    if match is None:
+                        continue
+                    value, end = match.group(), match.end()
+                if value:
+                    match_ends[pattern_index] = end
+                    yield pattern_index, value
+
+    def match(self, text):
+        """
+        :return: list of distinct (kind, watchlist entry, matched value) tuples, the terms first
+        """
+        if not text:
+            return list()
+        matches = dict()
+        if self._automaton is not None:
+            for term_index, _ in self._automaton.find_all(text):
+                term = self.terms[term_index]
+                matches.setdefault((self.TERM, term, term), None)
+        for pattern_index, value in self._match_combined_patterns(text):
+            matches.setdefault((self.REGEX, self.patterns[pattern_index], value[:self.MAX_VALUE_LENGTH]), None)
+        for pattern_index in self._separate_pattern_indexes:
+            for match in self._compiled_patterns[pattern_index].finditer(text):
+                if match.group():
+                    matches.setdefault((self.REGEX, self.patterns[pattern_index], match.group()[:self.MAX_VALUE_LENGTH]), None)
+        return list(matches)
+
+    def match_rows(self, rows):
+        """
+        :param rows: iterable of (row id, text)
+        :return: list of (row id, kind, watchlist entry, matched value) tuples
+        """
+        return [(row_id,) + match for row_id, text in rows for match in self.match(text)]
+
+
+class WatchlistFile:
+    """
+    Watchlist file loaded again once it changes, so a running scraper picks the edits up
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.watchlist = None
+        self._modified_at = None
+
+    def is_changed(self):
+        return os.stat(self.filepath).st_mtime_ns != self._modified_at
+
+    def load(self):
+        modified_at = os.stat(self.filepath).st_mtime_ns
+        self.watchlist = Watchlist.load(self.filepath)
+        self._modified_at = modified_at
+        return self.watchlist
+
+    def get(self):
+        """
+        :return: Watchlist of the current file content
+        """
+        if self.is_changed():
+            self.load()
+        return self.watchlist
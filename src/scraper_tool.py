@@ -36,13 +36,41 @@ class Tool:
 
     def _init_modules(self):
         self.modules = {'pastes': (self.pastes, "scrape latest pastes and store those in the database"),
-                        'createdb': (self.create_db, "create database and required tables")}
+                        'createdb': (self.create_db, "create or migrate database and required tables"),
+                        'search': (self.search, "full-text search over the stored pastes"),
+                        'compressdb': (self.compress_db, "compress stored paste content in place and report the trade-off"),
+                        'serve': (self.serve, "serve a read-only HTTP/JSON API over the stored pastes"),
+                        'export': (self.export, "stream the stored pastes into a JSONL, CSV, Arrow or Parquet file"),
+                        'backfill': (self.backfill, "crawl the entire page range, resuming from the stored checkpoints"),
+                        'reparse': (self.reparse, "extract pastes from the archived pages again into a fresh or existing database"),
+                        'similar': (self.similar, "index the stored pastes for near-duplicate lookups or look up the ones similar to a paste"),
+                        'rescan': (self.rescan, "match a watchlist against the stored pastes and store the hits")}
 
     def _init_arguments(self):
         arg_parser = self.arg_parser
         arg_parser.add_argument('module', choices=[mod for mod in sorted(self.modules)], help="cli module to run")
         arg_parser.add_argument('-c', '--config', help="configuration filepath", dest='config_filepath')
         arg_parser.add_argument('-th', '--tor-host', help="tor proxy hostname", dest='tor_host', default='localhost')
+        arg_parser.add_argument('-q', '--query', help="full-text query (search module)", dest='query')
+        arg_parser.add_argument('-p', '--page', help="results page number (search module)", dest='page', type=int, default=1)
+        arg_parser.add_argument('-ps', '--page-size', help="number of results per page (search module)", dest='page_size', type=int, default=20)
+        arg_parser.add_argument('--rebuild-index', help="rebuild the full-text index before searching (search module)", dest='rebuild_index', action='store_true')
+        arg_parser.add_argument('--retrain', help="train a new compression dictionary (compressdb module)", dest='retrain', action='store_true')
+        arg_parser.add_argument('--vacuum', help="reclaim the freed disk space (compressdb module)", dest='vacuum', action='store_true')
+        arg_parser.add_argument('--profile', help="run a single crawl under cProfile and write the profile to the file (pastes module)", dest='profile_filepath')
+        arg_parser.add_argument('-o', '--output', help="output filepath, - for the standard output (export module)", dest='output')
+        arg_parser.add_argument('-f', '--format', help="output format (export module)", dest='format', choices=['jsonl', 'csv', 'arrow', 'parquet'], default='jsonl')
+        arg_parser.add_argument('--since-id', help="export or rescan the rows with a greater id (export and rescan modules)", dest='since_id', type=int)
+        arg_parser.add_argument('--since-date', help="export the pastes posted since the date, YYYY-MM-DD[ HH:MM:SS] (export module)", dest='since_date')
+        arg_parser.add_argument('--watermark', help="file keeping the last exported id between incremental runs (export module)", dest='watermark_filepath')
+        arg_parser.add_argument('--chunk-size', help="number of rows fetched at once (export module)", dest='chunk_size', type=int, default=1000)
+        arg_parser.add_argument('--restart', help="drop the checkpoints and start over (backfill module)", dest='restart', action='store_true')
+        arg_parser.add_argument('-db', '--database', help="database filepath overriding the configured one (reparse module)", dest='database')
+        arg_parser.add_argument('-w', '--workers', help="number of worker processes, one per core by default (reparse, similar and rescan modules)", dest='workers', type=int)
+        arg_parser.add_argument('--since', help="reparse pages fetched since the date, YYYY-MM-DD (reparse module)", dest='since')
+        arg_parser.add_argument('--index', help="index the pastes missing from the similarity index (similar module)", dest='index', action='store_true')
+        arg_parser.add_argument('--id', help="id of the paste to look the similar ones up for (similar module)", dest='paste_id', type=int)
+        arg_parser.add_argument('--watchlist', help="watchlist filepath overriding the configured one (rescan module)", dest='watchlist_filepath')
 
     def _parse_arguments(self):
         self._init_modules()
@@ -61,19 +89,184 @@ class Tool:
     def pastes(self):
         from app.runtime import Runner
 
+        if self.arguments.profile_filepath:
+            Runner(self.context).profile(self.arguments.profile_filepath)
+            return
         Runner(self.context).go()
 
-    @required_arguments(['config_filepath'])
-    def create_db(self):
+    def _migrate_database(self):
         import inspect
         from app import models
+        from app.migrations import MIGRATIONS
+        from modules.migrations import MigrationRunner
         from modules.orm import Model
 
+        model_list = list()
         for attr_tuple in inspect.getmembers(models):
             model = attr_tuple[-1]
             if inspect.isclass(model) and issubclass(model, Model) and model != Model:
-                self.logger.info("Creating table for %s", model)
-                model.create_table_if_necessary(self.context)
+                model_list.append(model)
+        MigrationRunner(self.context, model_list, MIGRATIONS).run()
+
+    @required_arguments(['config_filepath'])
+    def create_db(self):
+        self._migrate_database()
+
+    @required_arguments(['config_filepath', 'query'])
+    def search(self):
+        import sqlite3
+        from app.models import Paste
+        from modules.orm import ModelCollection
+
+        if self.arguments.page < 1 or self.arguments.page_size < 1:
+            self.arg_parser.error("search module needs --page and --page-size of at least 1")
+        if self.arguments.rebuild_index:
+            Paste.rebuild_full_text_index(self.context)
+        try:
+            total, results = ModelCollection(self.context, model=Paste).search(self.arguments.query,
+                                                                               page=self.arguments.page,
+                                                                               page_size=self.arguments.page_size)
+        except sqlite3.OperationalError as e:
+            print("Search failed: {}".format(e))
+            exit(1)
+        pages = (total + self.arguments.page_size - 1) // self.arguments.page_size
+        print("{} result{}, page {} of {}".format(total, '' if total == 1 else 's', self.arguments.page, pages))
+        for result in results:
+            print("")
+            print("#{} {} {}: {}".format(result['pk'], result['date'], result['author'], result['title']))
+            print("    {}".format(result['snippet'].replace('\n', ' ')))
+
+    @required_arguments(['config_filepath'])
+    def compress_db(self):
+        from app.models import Paste
+        from modules.orm import ModelCollection
+
+        def get_database_size():
+            # the WAL file holds the pages not checkpointed yet
+            return sum(os.path.getsize(filepath) for filepath in [self.context.config.DB_FILEPATH, self.context.config.DB_FILEPATH + '-wal'] if os.path.exists(filepath))
+
+        database_size = get_database_size()
+        model_collection = ModelCollection(self.context, model=Paste)
+        if self.arguments.retrain or model_collection.connection.compressor.current_dictionary_id is None:
+            model_collection.train_compression_dictionary()
+        stats = model_collection.compress_stored_values()
+        if self.arguments.vacuum:
+            self.logger.info("Vacuuming the database")
+            model_collection.connection.execute("VACUUM")
+            model_collection.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        decompressed_values, decompressed_bytes, decompression_seconds = model_collection.measure_decompression()
+
+        print("Compressed values:       {}".format(stats['values']))
+        if stats['values']:
+            print("Size before/after:       {} / {} bytes ({:.1%})".format(stats['raw_bytes'], stats['compressed_bytes'], stats['compressed_bytes'] / stats['raw_bytes']))
+            print("Compression CPU time:    {:.3f} s ({:.1f} MB/s)".format(stats['cpu_seconds'], stats['raw_bytes'] / 1e6 / max(stats['cpu_seconds'], 1e-9)))
+        if decompressed_values:
+            print("Decompression CPU time:  {:.3f} s for {} values ({:.1f} MB/s)".format(decompression_seconds, decompressed_values, decompressed_bytes / 1e6 / max(decompression_seconds, 1e-9)))
+        print("Database file size:      {} -> {} bytes{}".format(database_size, get_database_size(), '' if self.arguments.vacuum else " (run with --vacuum to reclaim the freed pages)"))
+
+    @required_arguments(['config_filepath'])
+    def serve(self):
+        from app.api import PasteApi
+
+        PasteApi(self.context).serve_forever()
+
+    @required_arguments(['config_filepath', 'output'])
+    def export(self):
+        from app.models import Paste
+        from modules.export import Exporter
+        from modules.orm import ModelCollection
+
+        after_pk = self.arguments.since_id
+        if self.arguments.watermark_filepath:
+            watermark = Exporter.read_watermark(self.arguments.watermark_filepath)
+            if watermark is not None:
+                after_pk = max(after_pk or 0, watermark)
+        exporter = Exporter(self.context, ModelCollection(self.context, model=Paste))
+        try:
+            exported_rows, last_pk = exporter.export(self.arguments.output, self.arguments.format, after_pk=after_pk,
+                                                     since=self.arguments.since_date, chunk_size=self.arguments.chunk_size)
+        except RuntimeError as e:
+            print(e)
+            exit(1)
+        if self.arguments.watermark_filepath and last_pk is not None:
+            Exporter.write_watermark(self.arguments.watermark_filepath, last_pk)
+
+    @required_arguments(['config_filepath'])
+    def backfill(self):
+        from app.backfill import Backfiller
+
+        self._migrate_database()
+        backfiller = Backfiller(self.context)
+        if self.arguments.restart:
+            backfiller.reset()
+        backfiller.go()
+
+    @required_arguments(['config_filepath'])
+    def reparse(self):
+        import datetime
+        import time
+        from app.reparser import Reparser
+
+        if self.arguments.database:
+            self.context.config.DB_FILEPATH = self.arguments.database
+        since = None
+        if self.arguments.since:
+            since = datetime.datetime.strptime(self.arguments.since, '%Y-%m-%d').timestamp()
+        self._migrate_database()
+
+        started = time.monotonic()
+        pages, extracted_pastes, stored_pastes = Reparser(self.context, workers_count=self.arguments.workers).go(since=since)
+        elapsed = time.monotonic() - started
+        print("Reparsed pages:      {} ({:.1f} pages/s)".format(pages, pages / max(elapsed, 1e-9)))
+        print("Extracted pastes:    {}".format(extracted_pastes))
+        print("New pastes stored:   {}".format(stored_pastes))
+        print("Elapsed time:        {:.1f} s".format(elapsed))
+
+    @required_arguments(['config_filepath'])
+    def similar(self):
+        from app.similarity import SimilarityIndexer
+
+        if not self.arguments.index and self.arguments.paste_id is None:
+            self.arg_parser.error("similar module needs --index or --id")
+        if self.arguments.index:
+            self._migrate_database()
+        if not self.context.config.SIMILARITY_ENABLED:
+            print("Similarity index is disabled in the [similarity] section")
+            exit(1)
+        indexer = SimilarityIndexer(self.context, workers_count=self.arguments.workers)
+        if self.arguments.index:
+            print("Indexed pastes: {}".format(indexer.go()))
+        if self.arguments.paste_id is None:
+            return
+        cluster_id, similar_pastes = indexer.lookup(self.arguments.paste_id)
+        if cluster_id is None:
+            print("Paste #{} is not indexed, run the similar module with --index".format(self.arguments.paste_id))
+            return
+        print("Paste #{} belongs to cluster #{}, {} similar paste{}".format(self.arguments.paste_id, cluster_id, len(similar_pastes),
+                                                                           '' if len(similar_pastes) == 1 else 's'))
+        for record, similarity in similar_pastes:
+            print("    #{} {:.0%} {} {}: {}".format(record.pk, similarity, record.date, record.author, record.title))
+
+    @required_arguments(['config_filepath'])
+    def rescan(self):
+        import time
+        from app.watchlist import Rescanner
+
+        if not self.arguments.watchlist_filepath and not self.context.config.WATCHLIST_FILEPATH:
+            self.arg_parser.error("rescan module needs --watchlist or the filepath of the [watchlist] section")
+        self._migrate_database()
+        try:
+            rescanner = Rescanner(self.context, workers_count=self.arguments.workers, filepath=self.arguments.watchlist_filepath)
+        except (OSError, ValueError) as e:
+            print("Cannot load the watchlist: {}".format(e))
+            exit(1)
+
+        started = time.monotonic()
+        scanned_pastes, stored_hits = rescanner.go(after_pk=self.arguments.since_id)
+        elapsed = time.monotonic() - started
+        print("Scanned pastes:      {} ({:.1f} pastes/s)".format(scanned_pastes, scanned_pastes / max(elapsed, 1e-9)))
+        print("New hits stored:     {}".format(stored_hits))
+        print("Elapsed time:        {:.1f} s".format(elapsed))
 
     def run(self):
         module, _ = self.modules[self.arguments.module]
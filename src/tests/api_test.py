@@ -0,0 +1,104 @@
+"""
+Checks the paste API pagination cursors and the response cache against the database writes
+    python -m pytest tests/api_test.py
+"""
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+from app.api import PasteApi
+from app.models import Paste, PasteRecord
+from modules.api import encode_cursor
+from modules.orm import ModelCollection, SharedConnection
+from tests.bench import create_context
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+
+
+def store_pastes(context, numbers):
+    model_collection = ModelCollection(context, model=Paste)
+    # a few pastes share the date, the primary key breaks the ties
+    model_collection.store(model_collection.normalize([PasteRecord('author {}'.format(number), 'title {}'.format(number), 'content {}'.format(number),
+                                                                   '02 Jan 2017, 10:20:{:02d} UTC'.format(number // 2))
+                                                       for number in numbers]))
+    model_collection.connection.flush()
+
+
+def get(paste_api, url):
+    status, body, etag = paste_api.api.handle(url)
+    return status, json.loads(body.decode('utf-8')), etag
+
+
+def test_cursor_walks_every_page():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        store_pastes(context, range(11))
+        paste_api = PasteApi(context)
+        try:
+            titles, cursor = list(), None
+            while True:
+                status, response, _ = get(paste_api, '/pastes/latest?limit=3' + ('&cursor={}'.format(cursor) if cursor else ''))
+                assert status == 200
+                titles.extend(item['title'] for item in response['items'])
+                cursor = response['next']
+                if cursor is None:
+                    break
+            assert titles == ['title {}'.format(number) for number in reversed(range(11))]
+        finally:
+            paste_api.close()
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_invalid_cursor_is_rejected():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        store_pastes(context, range(3))
+        paste_api = PasteApi(context)
+        try:
+            not_a_list = base64.urlsafe_b64encode(json.dumps({'date': 1}).encode('utf-8')).decode('ascii')
+            for cursor in ['not*base64', not_a_list, encode_cursor(['2017-01-02 10:20:00']), encode_cursor([['2017-01-02 10:20:00'], 1]),
+                           encode_cursor(['2017-01-02 10:20:00', 1, 2]), encode_cursor([True, 1])]:
+                status, response, etag = get(paste_api, '/pastes/latest?cursor={}'.format(cursor))
+                assert (status, response, etag) == (400, {'error': "Invalid cursor"}, None), cursor
+        finally:
+            paste_api.close()
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_cache_is_invalidated_by_the_writes():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        store_pastes(context, range(2))
+        paste_api = PasteApi(context)
+        try:
+            first_entry = paste_api.api.handle('/pastes/latest')
+            assert paste_api.api.handle('/pastes/latest') is first_entry
+
+            store_pastes(context, [2])
+            status, response, etag = get(paste_api, '/pastes/latest')
+            assert status == 200 and etag != first_entry[2]
+            assert [item['title'] for item in response['items']] == ['title 2', 'title 1', 'title 0']
+        finally:
+            paste_api.close()
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    test_cursor_walks_every_page()
+    test_invalid_cursor_is_rejected()
+    test_cache_is_invalidated_by_the_writes()
@@ -0,0 +1,73 @@
+"""
+Checks that an interrupted backfill of the fixture site resumes from its page checkpoints, see tests.fixture_server
+    python -m pytest tests/backfill_test.py
+"""
+import os
+import shutil
+import tempfile
+
+from app.backfill import Backfiller
+from app.models import BackfillPage, Paste
+from modules.orm import ModelCollection, SharedConnection
+from tests.bench import create_context
+from tests.fixture_server import FixtureServer, FixtureSite, SocksServer
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+INTERRUPTED_AFTER_PAGES = 2
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(backfiller, pages):
+    store_checkpoint = backfiller._store_checkpoint
+
+    def interrupting_store_checkpoint(page_number, pastes, stored_pastes):
+        store_checkpoint(page_number, pastes, stored_pastes)
+        if backfiller.checkpoints.query().count() >= pages:
+            raise Interrupted()
+
+    backfiller._store_checkpoint = interrupting_store_checkpoint
+
+
+def test_interrupted_backfill_resumes_from_the_checkpoints():
+    work_directory = tempfile.mkdtemp()
+    site = FixtureSite(total_pastes=50, pastes_per_page=10, content_size=100)
+    server = FixtureServer(site).start()
+    socks_server = SocksServer(upstream=('127.0.0.1', server.port)).start()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory, server, socks_server, overrides={('parser', 'workers'): '1'})
+        Paste.create_table_if_necessary(context)
+        BackfillPage.create_table_if_necessary(context)
+
+        backfiller = Backfiller(context)
+        interrupt_after(backfiller, INTERRUPTED_AFTER_PAGES)
+        try:
+            backfiller.go()
+        except Interrupted:
+            pass
+        else:
+            raise AssertionError("the backfill should have been interrupted")
+        completed_pages = [record.page_number for record in ModelCollection(context, model=BackfillPage).query().order_by('page_number')]
+        assert completed_pages == list(range(1, INTERRUPTED_AFTER_PAGES + 1))
+        backfiller.web_request.close()
+
+        # the pages done before are neither crawled nor stored again
+        backfiller = Backfiller(context)
+        crawled_pages, stored_pastes = backfiller.go()
+        backfiller.web_request.close()
+        assert crawled_pages == site.total_pages - INTERRUPTED_AFTER_PAGES
+        assert stored_pastes == (site.total_pages - INTERRUPTED_AFTER_PAGES) * site.pastes_per_page
+        assert ModelCollection(context, model=Paste).query().count() == site.total_pastes
+        assert ModelCollection(context, model=BackfillPage).query().count() == site.total_pages
+    finally:
+        SharedConnection.close_all()
+        socks_server.stop()
+        server.stop()
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    test_interrupted_backfill_resumes_from_the_checkpoints()
@@ -0,0 +1,307 @@
+"""
+Offline benchmark of the scraper against the local fixture site, see tests.fixture_server
+
+Measures every stage in a process of its own, so the peak RSS figures do not add up:
+    fetch: WebRequest downloading the pages through the SOCKS5 stand-in
+    parse: Parser extracting the raw pastes
+    normalize: ModelCollection normalizing the pastes of a page
+    store: ModelCollection storing the pastes of a page into an empty database
+    crawl: Runner crawling the whole site into an empty database, end to end
+and saves the results as JSON, so the figures of two versions can be compared:
+    python -m tests.bench -c ../conf/settings.ini --pages 100 --compare ../data/bench/bench-previous.json
+"""
+import argparse
+import configparser
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from tests.fixture_server import FixtureServer, FixtureSite, SocksServer
+
+
+STAGES = ['fetch', 'parse', 'normalize', 'store', 'crawl']
+COMPARED_METRICS = [('pages_per_second', True), ('pastes_per_second', True), ('p50_ms', False), ('p99_ms', False), ('peak_rss_mb', False)]
+
+
+def percentile(values, fraction):
+    """
+    :return: nearest-rank percentile of the values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def summarize(latencies, pages, pastes, elapsed):
+    return {'pages': pages,
+            'pastes': pastes,
+            'seconds': round(elapsed, 4),
+            'pages_per_second': round(pages / max(elapsed, 1e-9), 2),
+            'pastes_per_second': round(pastes / max(elapsed, 1e-9), 2),
+            'p50_ms': None if not latencies else round(percentile(latencies, 0.5) * 1000, 3),
+            'p90_ms': None if not latencies else round(percentile(latencies, 0.9) * 1000, 3),
+            'p99_ms': None if not latencies else round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': None if not latencies else round(max(latencies) * 1000, 3)}
+
+
+def timed(function, items):
+    """
+    :return: list of the function results, list of the call latencies, total elapsed time
+    """
+    results, latencies = list(), list()
+    started = time.perf_counter()
+    for item in items:
+        call_started = time.perf_counter()
+        results.append(function(item))
+        latencies.append(time.perf_counter() - call_started)
+    return results, latencies, time.perf_counter() - started
+
+
+def create_context(config_filepath, work_directory, server=None, socks_server=None, overrides=None):
+    """
+    :param overrides: dict of {(section, option): value} applied to the configuration
+    """
+    from modules.common import Context
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(config_filepath)
+    config['general']['debug'] = '0'
+    config['database']['filepath'] = os.path.join(work_directory, 'bench.sqlite')
+    if os.path.exists(config['database']['filepath']):
+        os.remove(config['database']['filepath'])
+    if server is not None:
+        config['website']['main_url'] = server.main_url
+        config['website']['page_url_prefix'] = server.page_url_prefix
+    if socks_server is not None:
+        config['tor']['http_proxy_port'] = str(socks_server.port)
+        config['tor']['https_proxy_port'] = str(socks_server.port)
+        config['tor']['endpoints'] = ''
+    if config.has_section('archive'):
+        config['archive']['enabled'] = '0'
+    for (section, option), value in (overrides or dict()).items():
+        config[section][option] = value
+    benchmark_config_filepath = os.path.join(work_directory, 'settings.ini')
+    with open(benchmark_config_filepath, 'w') as config_file:
+        config.write(config_file)
+    return Context(benchmark_config_filepath, '127.0.0.1')
+
+
+def get_pages(site, pages):
+    return [site.render_page(page_number) for page_number in range(1, pages + 1)]
+
+
+def get_raw_pastes(context, site, pages):
+    from modules.scraper import Parser
+
+    return [list(Parser(context, page).extract_new_paste()) for page in get_pages(site, pages)]
+
+
+def get_normalized_pastes(context, site, pages):
+    from app.models import Paste
+    from modules.orm import ModelCollection
+
+    model_collection = ModelCollection(context, model=Paste)
+    return [model_collection.normalize(raw_pastes) for raw_pastes in get_raw_pastes(context, site, pages)]
+
+
+def bench_fetch(context, site, pages):
+    from modules.tor import WebRequest
+
+    web_request = WebRequest(context)
+    urls = [context.config.WEB_MAIN_URL] + ['{}{}'.format(context.config.WEB_PAGE_URL_PREFIX, page_number) for page_number in range(2, pages + 1)]
+    results, latencies, elapsed = timed(web_request.get, urls)
+    web_request.close()
+    return summarize(latencies, pages, site.pastes_per_page * pages, elapsed)
+
+
+def bench_parse(context, site, pages):
+    from modules.scraper import Parser
+
+    results, latencies, elapsed = timed(lambda page: list(Parser(context, page).extract_new_paste()), get_pages(site, pages))
+    return summarize(latencies, pages, sum(len(pastes) for pastes in results), elapsed)
+
+
+def bench_normalize(context, site, pages):
+    from app.models import Paste
+    from modules.orm import ModelCollection
+
+    model_collection = ModelCollection(context, model=Paste)
+    results, latencies, elapsed = timed(model_collection.normalize, get_raw_pastes(context, site, pages))
+    return summarize(latencies, pages, sum(len(pastes) for pastes in results), elapsed)
+
+
+def bench_store(context, site, pages):
+    from app.models import Paste
+    from modules.orm import ModelCollection
+
+    Paste.create_table_if_necessary(context)
+    model_collection = ModelCollection(context, model=Paste)
+    pages_pastes = get_normalized_pastes(context, site, pages)
+    results, latencies, elapsed = timed(model_collection.store, pages_pastes)
+    flush_started = time.perf_counter()
+    model_collection.connection.flush()
+    elapsed += time.perf_counter() - flush_started
+    return summarize(latencies, pages, sum(results), elapsed)
+
+
+def bench_crawl(context, site, pages):
+    from app.models import Paste
+    from app.runtime import Runner
+
+    Paste.create_table_if_necessary(context)
+    runner = Runner(context)
+    started = time.perf_counter()
+    stored_pastes = runner._crawl()
+    elapsed = time.perf_counter() - started
+    result = summarize([], site.total_pages, stored_pastes, elapsed)
+    result['peak_worker_rss_mb'] = round(get_peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+    return result
+
+
+def run_stage(stage, config_filepath, site_parameters, server_parameters, overrides, pages, connection):
+    """
+    Runs in a process of its own, sending the stage results back over the connection
+    """
+    work_directory = tempfile.mkdtemp(prefix='bench-{}-'.format(stage))
+    site = FixtureSite(**site_parameters)
+    server, socks_server = None, None
+    if stage in ('fetch', 'crawl'):
+        server = FixtureServer(site, **server_parameters).start()
+        socks_server = SocksServer(upstream=('127.0.0.1', server.port)).start()
+    context = create_context(config_filepath, work_directory, server, socks_server, overrides)
+    try:
+        result = globals()['bench_{}'.format(stage)](context, site, pages)
+        result['peak_rss_mb'] = round(get_peak_rss_mb(), 1)
+        connection.send(result)
+    except Exception as e:
+        connection.send({'error': repr(e)})
+    finally:
+        if server is not None:
+            server.stop()
+            socks_server.stop()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def run_suite(config_filepath, stages, pages, pastes_per_page, content_size, server_parameters, overrides):
+    site_parameters = {'total_pastes': pages * pastes_per_page, 'pastes_per_page': pastes_per_page, 'content_size': content_size}
+    results = dict()
+    for stage in stages:
+        print("Running the {} benchmark".format(stage))
+        receiving_connection, sending_connection = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_stage,
+                                          args=(stage, os.path.abspath(config_filepath), site_parameters, server_parameters, overrides, pages, sending_connection))
+        process.start()
+        results[stage] = receiving_connection.recv()
+        process.join()
+    return {'version': get_version(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'parameters': dict(server_parameters, pages=pages, pastes_per_page=pastes_per_page, content_size=content_size,
+                               overrides=['{}.{}={}'.format(section, option, value) for (section, option), value in overrides.items()]),
+            'stages': results}
+
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def format_value(value):
+    return '-' if value is None else '{:g}'.format(value)
+
+
+def print_results(results, previous=None):
+    header = ['stage', 'pages/s', 'pastes/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak RSS MB']
+    print("")
+    parameters = results['parameters']
+    print("Version {}, {} pages of {} pastes, {}s latency, {:.0%} stalled by {}s{}".format(
+        results['version'], parameters['pages'], parameters['pastes_per_page'], parameters['latency'], parameters.get('stall_probability', 0),
+        parameters.get('stall', 0), ''.join(', ' + override for override in parameters.get('overrides', []))))
+    print(''.join('{:>12}'.format(column) for column in header))
+    for stage, result in results['stages'].items():
+        if 'error' in result:
+            print('{:>12}  failed: {}'.format(stage, result['error']))
+            continue
+        values = [result['pages_per_second'], result['pastes_per_second'], result['p50_ms'], result['p90_ms'],
+                  result['p99_ms'], result['max_ms'], result['peak_rss_mb']]
+        print('{:>12}'.format(stage) + ''.join('{:>12}'.format(format_value(value)) for value in values))
+
+    if previous is None:
+        return
+    print("")
+    print("Compared to version {} ({}), positive is better:".format(previous['version'], previous['created']))
+    print(''.join('{:>20}'.format(column) for column in ['stage'] + [metric for metric, _ in COMPARED_METRICS]))
+    for stage, result in results['stages'].items():
+        previous_result = previous['stages'].get(stage)
+        if not previous_result or 'error' in result or 'error' in previous_result:
+            continue
+        changes = list()
+        for metric, higher_is_better in COMPARED_METRICS:
+            value, previous_value = result.get(metric), previous_result.get(metric)
+            if not value or not previous_value:
+                changes.append('-')
+                continue
+            change = (value - previous_value) / previous_value * (1 if higher_is_better else -1)
+            changes.append('{:+.1%}'.format(change))
+        print('{:>20}'.format(stage) + ''.join('{:>20}'.format(change) for change in changes))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Offline scraper benchmark")
+    arg_parser.add_argument('-c', '--config', help="configuration filepath the benchmark settings are derived from", dest='config_filepath', required=True)
+    arg_parser.add_argument('--stages', help="comma separated stages to run", default=','.join(STAGES))
+    arg_parser.add_argument('--pages', help="number of pages", type=int, default=50)
+    arg_parser.add_argument('--pastes-per-page', help="number of pastes per page", type=int, default=10)
+    arg_parser.add_argument('--content-size', help="approximate paste content size in characters", type=int, default=2000)
+    arg_parser.add_argument('--latency', help="seconds every fixture response is delayed by", type=float, default=0.05)
+    arg_parser.add_argument('--stall', help="seconds the stalled fixture responses are delayed by", type=float, default=5.0)
+    arg_parser.add_argument('--stall-probability', help="share of the fixture responses stalled, 0 to 1", type=float, default=0.0)
+    arg_parser.add_argument('--set', help="configuration override, e.g. website.hedge_percentile=0", dest='overrides', action='append', default=[])
+    arg_parser.add_argument('-o', '--output', help="results filepath, ../data/bench/bench-<date>.json by default")
+    arg_parser.add_argument('--compare', help="results filepath of a previous run to compare with")
+    arguments = arg_parser.parse_args()
+
+    stages = [stage.strip() for stage in arguments.stages.split(',') if stage.strip()]
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        arg_parser.error("unknown stages: {}".format(', '.join(sorted(unknown_stages))))
+    overrides = dict()
+    for override in arguments.overrides:
+        option_path, separator, value = override.partition('=')
+        section, _, option = option_path.partition('.')
+        if not separator or not option:
+            arg_parser.error("invalid override {}, expected section.option=value".format(override))
+        overrides[(section, option)] = value
+    server_parameters = {'latency': arguments.latency, 'stall': arguments.stall, 'stall_probability': arguments.stall_probability}
+    results = run_suite(arguments.config_filepath, stages, arguments.pages, arguments.pastes_per_page, arguments.content_size,
+                        server_parameters, overrides)
+
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as previous_file:
+            previous = json.load(previous_file)
+    print_results(results, previous)
+
+    output_filepath = arguments.output or os.path.join('..', 'data', 'bench', 'bench-{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output_filepath)), exist_ok=True)
+    with open(output_filepath, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print("")
+    print("Results saved to {}".format(output_filepath))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Checks that the configuration files written for the earlier releases still load
+    python -m pytest tests/config_test.py
+"""
+import os
+import shutil
+import tempfile
+
+from modules.common import Config
+
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BASELINE_CONFIG_FILEPATH = os.path.join(TESTS_DIRECTORY, 'data', 'baseline_settings.ini')
+CONFIG_FILEPATH = os.path.join(TESTS_DIRECTORY, '..', '..', 'conf', 'settings.ini')
+
+
+def test_baseline_config_loads():
+    config = Config(BASELINE_CONFIG_FILEPATH)
+    assert config.PARSER_ENGINE == 'html.parser'
+    assert config.WEB_SOURCES[0].main_url == config.WEB_MAIN_URL
+    assert config.TOR_ENDPOINTS == []
+    assert not config.ARCHIVE_ENABLED
+    assert not config.SIMILARITY_ENABLED
+    assert config.WATCHLIST_FILEPATH == ''
+
+
+def test_runtime_window_sets_the_scheduler_interval():
+    config = Config(BASELINE_CONFIG_FILEPATH)
+    # runtime_window_in_hours=4
+    assert config.SCHEDULER_MIN_INTERVAL_MINUTES == config.SCHEDULER_MAX_INTERVAL_MINUTES == 240
+
+
+def test_current_config_loads():
+    config = Config(CONFIG_FILEPATH)
+    assert config.SCHEDULER_MIN_INTERVAL_MINUTES < config.SCHEDULER_MAX_INTERVAL_MINUTES
+
+
+def test_incomplete_source_section_is_rejected():
+    work_directory = tempfile.mkdtemp()
+    try:
+        config_filepath = os.path.join(work_directory, 'settings.ini')
+        with open(CONFIG_FILEPATH) as config_file, open(config_filepath, 'w') as mirror_config_file:
+            mirror_config_file.write(config_file.read() + '\n[source:mirror]\nmain_url = http://mirror.onion/all\n')
+        try:
+            Config(config_filepath)
+        except ValueError as e:
+            assert 'source:mirror' in str(e)
+        else:
+            raise AssertionError("the section without page_url_prefix should have been rejected")
+    finally:
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    test_baseline_config_loads()
+    test_runtime_window_sets_the_scheduler_interval()
+    test_current_config_loads()
+    test_incomplete_source_section_is_rejected()
@@ -0,0 +1,114 @@
+"""
+Checks how SocksEndpointPool spreads the requests over two local SOCKS stand-ins, see tests.fixture_server
+    python -m pytest tests/endpoint_pool_test.py
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import requests
+
+from modules.tor import WebRequest
+from tests.bench import create_context
+from tests.fixture_server import FixtureServer, FixtureSite, SocksServer
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+EJECTION_TIMEOUT = 0.2
+
+
+class Endpoints:
+    """
+    A fixture site behind two SOCKS stand-ins, along with a WebRequest spreading the requests over both
+    """
+    def __init__(self, latencies=(0.0, 0.0), overrides=None):
+        self.work_directory = tempfile.mkdtemp()
+        self.server = FixtureServer(FixtureSite(total_pastes=20, pastes_per_page=10, content_size=100)).start()
+        self.socks_servers = [SocksServer(upstream=('127.0.0.1', self.server.port), latency=latency).start() for latency in latencies]
+        endpoints = ','.join('127.0.0.1:{}'.format(socks_server.port) for socks_server in self.socks_servers)
+        # no hedging by default, so every request goes through the endpoint it was sent to
+        config_overrides = {('tor', 'endpoints'): endpoints,
+                            ('tor', 'ejection_timeout'): str(EJECTION_TIMEOUT),
+                            ('website', 'retry_timeout'): '0.01',
+                            ('website', 'hedge_percentile'): '0'}
+        config_overrides.update(overrides or dict())
+        self.context = create_context(CONFIG_FILEPATH, self.work_directory, self.server, overrides=config_overrides)
+        self.web_request = WebRequest(self.context)
+        self.endpoints = self.web_request.endpoint_pool.endpoints
+
+    def get(self, count):
+        for _ in range(count):
+            self.web_request.get(self.context.config.WEB_MAIN_URL)
+
+    def close(self):
+        self.web_request.close()
+        for socks_server in self.socks_servers:
+            socks_server.stop()
+        self.server.stop()
+        shutil.rmtree(self.work_directory)
+
+
+def test_failing_endpoint_is_ejected_and_restored():
+    random.seed(0)
+    endpoints = Endpoints()
+    try:
+        failing_endpoint = endpoints.endpoints[0]
+        endpoints.socks_servers[0].failing = True
+        # the requests failing on the first endpoint are retried through the second one
+        endpoints.get(10)
+        assert failing_endpoint.ejected_until is not None
+        assert failing_endpoint.consecutive_failures == endpoints.context.config.TOR_MAX_CONSECUTIVE_FAILURES
+        requests_count = failing_endpoint.requests_count
+        endpoints.get(5)
+        assert failing_endpoint.requests_count == requests_count
+
+        endpoints.socks_servers[0].failing = False
+        time.sleep(EJECTION_TIMEOUT * 1.5)
+        # nothing is known of the endpoint latency, so the probe goes to it first
+        endpoints.get(1)
+        assert failing_endpoint.requests_count == requests_count + 1
+        assert failing_endpoint.ejected_until is None
+        assert all(in_rotation for _, _, _, in_rotation in endpoints.web_request.endpoint_pool.get_stats())
+    finally:
+        endpoints.close()
+
+
+def test_faster_endpoint_gets_more_requests():
+    random.seed(0)
+    endpoints = Endpoints(latencies=(0.0, 0.03))
+    try:
+        endpoints.get(40)
+        fast_endpoint, slow_endpoint = endpoints.endpoints
+        assert fast_endpoint.requests_count + slow_endpoint.requests_count == 40
+        assert fast_endpoint.requests_count > 3 * slow_endpoint.requests_count
+        assert fast_endpoint.latency < slow_endpoint.latency
+    finally:
+        endpoints.close()
+
+
+def test_connection_reuse_stats():
+    endpoints = Endpoints(latencies=(0.0,))
+    try:
+        web_request = endpoints.web_request
+        endpoints.get(5)
+        assert web_request.get_connection_reuse_stats() == (1, 5, 4)
+
+        # the idle session is closed before the next request, its connections are counted still
+        endpoints.endpoints[0].last_used -= endpoints.context.config.WEB_SESSION_IDLE_TIMEOUT + 1
+        endpoints.get(5)
+        assert web_request.get_connection_reuse_stats() == (2, 10, 8)
+
+        # an adapter with no urllib3 pools counts nothing
+        session = requests.Session()
+        session.mount('http://', requests.adapters.BaseAdapter())
+        assert WebRequest._collect_pools_stats(session) == (0, 0)
+    finally:
+        endpoints.close()
+
+
+if __name__ == '__main__':
+    test_failing_endpoint_is_ejected_and_restored()
+    test_faster_endpoint_gets_more_requests()
+    test_connection_reuse_stats()
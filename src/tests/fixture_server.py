@@ -0,0 +1,314 @@
+"""
+Local stand-in for the Stronghold Paste website, serving synthetic /all?page=N pages with the markup Parser expects,
+and a minimal SOCKS5 proxy standing in for TOR, so the scraper can be run and measured offline
+
+Run it standalone and point [website] and --tor-host at it:
+    python -m tests.fixture_server --port 8080 --socks-port 9050 --latency 0.2
+"""
+import argparse
+import datetime
+import hashlib
+import http.server
+import random
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+import urllib.parse
+
+
+PASTE_TEMPLATE = '''<div class="col-sm-12">
+<div class="pre-info pre-header"><div class="row"><div class="col-sm-12"><h4>
+{title}
+</h4></div></div></div>
+<div class="text"><ol>{lines}</ol></div>
+<div class="pre-info pre-footer"><div class="row"><div class="col-sm-6">Posted by {author} at {date}</div>
+<div class="col-sm-6 text-right"><a href="/paste/{paste_id}">Show paste</a></div></div></div>
+</div>'''
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html><head><title>Stronghold Paste</title></head>
+<body><div class="container"><div class="row">
+{pastes}
+</div>
+<ul class="pagination">{pagination}<li><a href="/all?page={next_page}">Next</a></li></ul>
+</div></body></html>'''
+# Parser splits the footer on "at", so the names must not contain it
+AUTHORS = ['Guest', 'Unknown', 'Anonymous', 'darkside', 'cr4cker', 'admin', 'nakamoto', 'mr_robot']
+WORDS = ['bitcoin', 'wallet', 'password', 'login', 'dump', 'leak', 'email', 'database', 'onion', 'market',
+         'private', 'key', 'address', 'account', 'hash', 'server', 'access', 'free', 'link', 'mirror']
+FIRST_PASTE_DATE = datetime.datetime(2017, 1, 1)
+
+
+class FixtureSite:
+    """
+    Generates the pages of a paste site with total_pastes pastes, the newest one first
+
+    Pages are deterministic for the same parameters, paste N is always rendered the same way,
+    so adding new pastes with add_pastes() shifts the older ones to the next pages like the real website does
+    """
+    def __init__(self, total_pastes=1000, pastes_per_page=10, content_size=2000, seed=0):
+        self.total_pastes = total_pastes
+        self.pastes_per_page = pastes_per_page
+        self.content_size = content_size
+        self.seed = seed
+        self._lock = threading.Lock()
+
+    @property
+    def total_pages(self):
+        return max((self.total_pastes + self.pastes_per_page - 1) // self.pastes_per_page, 1)
+
+    def add_pastes(self, count):
+        with self._lock:
+            self.total_pastes += count
+
+    def render_paste(self, paste_id):
+        randomizer = random.Random(self.seed * 1000003 + paste_id)
+        lines = list()
+        size = 0
+        while size < self.content_size:
+            line = ' '.join(randomizer.choice(WORDS) for _ in range(randomizer.randint(4, 12)))
+            lines.append('<li>{}</li>'.format(line))
+            size += len(line)
+        date = FIRST_PASTE_DATE + datetime.timedelta(minutes=7 * paste_id)
+        return PASTE_TEMPLATE.format(title='Paste #{} {}'.format(paste_id, randomizer.choice(WORDS)),
+                                     lines=''.join(lines),
+                                     author=randomizer.choice(AUTHORS),
+                                     date=date.strftime('%d %b %Y, %H:%M:%S UTC'),
+                                     paste_id=paste_id)
+
+    def render_page(self, page_number):
+        """
+        :return: page markup, empty if there is no such page
+        """
+        with self._lock:
+            total_pastes = self.total_pastes
+        total_pages = self.total_pages
+        if not 1 <= page_number <= total_pages:
+            return ''
+        newest = total_pastes - (page_number - 1) * self.pastes_per_page
+        paste_ids = range(newest, max(newest - self.pastes_per_page, 0), -1)
+        # Navigator reads the page range off the landing page pagination
+        pagination = ''.join('<li><a href="/all?page={0}">{0}</a></li>'.format(number) for number in range(1, total_pages + 1))
+        return PAGE_TEMPLATE.format(pastes='\n'.join(self.render_paste(paste_id) for paste_id in paste_ids),
+                                    pagination=pagination,
+                                    next_page=min(page_number + 1, total_pages))
+
+
+class FixtureRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, delayed ACKs would stall the keep-alive connections otherwise
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/all':
+            self.send_error(404)
+            return
+        try:
+            page_number = int(urllib.parse.parse_qs(url.query).get('page', ['1'])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.stall_probability and random.random() < self.server.stall_probability:
+            time.sleep(self.server.stall)
+        body = self.server.site.render_page(page_number).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.server.count_request()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Serves a FixtureSite at http://127.0.0.1:<port>/all, delaying every response by latency seconds
+    and stall_probability of them by stall more seconds, like a stuck circuit would
+    """
+    daemon_threads = True
+
+    def __init__(self, site, port=0, latency=0.0, stall=0.0, stall_probability=0.0):
+        super().__init__(('127.0.0.1', port), FixtureRequestHandler)
+        self.site = site
+        self.latency = latency
+        self.stall = stall
+        self.stall_probability = stall_probability
+        self.requests_served = 0
+        self._counter_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def main_url(self):
+        return 'http://127.0.0.1:{}/all'.format(self.port)
+
+    @property
+    def page_url_prefix(self):
+        return '{}?page='.format(self.main_url)
+
+    def count_request(self):
+        with self._counter_lock:
+            self.requests_served += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SocksRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a single SOCKS5 CONNECT request without authentication, then relays the data both ways
+    """
+    BUFFER_SIZE = 65536
+
+    def _receive(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("SOCKS client disconnected")
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            version, methods_count = self._receive(2)
+            self._receive(methods_count)
+            self.request.sendall(b'\x05\x00')
+            version, command, _, address_type = self._receive(4)
+            if address_type == 1:
+                host = socket.inet_ntoa(self._receive(4))
+            elif address_type == 3:
+                host = self._receive(self._receive(1)[0]).decode('ascii')
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, self._receive(16))
+            port, = struct.unpack('>H', self._receive(2))
+            if command != 1:
+                self.request.sendall(b'\x05\x07\x00\x01' + bytes(6))
+                return
+            if self.server.failing:
+                self.request.sendall(b'\x05\x01\x00\x01' + bytes(6))
+                return
+            upstream = socket.create_connection(self.server.resolve(host, port))
+        except (ConnectionError, OSError):
+            return
+        self.server.count_connection()
+        for relayed_socket in (self.request, upstream):
+            relayed_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with upstream:
+            self.request.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', port))
+            self._relay(upstream)
+
+    def _relay(self, upstream):
+        sockets = [self.request, upstream]
+        while True:
+            readable, _, _ = select.select(sockets, [], [], 60)
+            if not readable or self.server.failing:
+                return
+            for source in readable:
+                data = source.recv(self.BUFFER_SIZE)
+                if not data:
+                    return
+                if source is upstream and self.server.latency:
+                    time.sleep(self.server.latency)
+                (upstream if source is self.request else self.request).sendall(data)
+
+
+class SocksServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Minimal SOCKS5 proxy on 127.0.0.1:<port> standing in for TOR
+
+    Every hostname (.onion ones included) is routed to the address in hosts or to upstream,
+    setting failing makes it refuse the connections and drop the open ones like an unhealthy circuit,
+    latency delays every relayed response chunk like a slow one
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, upstream=None, hosts=None, latency=0.0):
+        super().__init__(('127.0.0.1', port), SocksRequestHandler)
+        self.upstream = upstream
+        self.hosts = hosts or dict()
+        self.latency = latency
+        self.failing = False
+        self.connections_served = 0
+        self._counter_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def resolve(self, host, port):
+        if host in self.hosts:
+            return self.hosts[host]
+        return self.upstream or (host, port)
+
+    def count_connection(self):
+        with self._counter_lock:
+            self.connections_served += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Local Stronghold Paste stand-in")
+    arg_parser.add_argument('--port', type=int, default=8080, help="HTTP port")
+    arg_parser.add_argument('--socks-port', type=int, help="also run a SOCKS5 stand-in on this port")
+    arg_parser.add_argument('--latency', type=float, default=0.0, help="seconds every response is delayed by")
+    arg_parser.add_argument('--pastes', type=int, default=1000, help="total number of pastes")
+    arg_parser.add_argument('--pastes-per-page', type=int, default=10, help="number of pastes per page")
+    arg_parser.add_argument('--content-size', type=int, default=2000, help="approximate paste content size in characters")
+    arg_parser.add_argument('--new-pastes-per-minute', type=float, default=0.0, help="rate new pastes are published at")
+    arguments = arg_parser.parse_args()
+
+    site = FixtureSite(arguments.pastes, arguments.pastes_per_page, arguments.content_size)
+    server = FixtureServer(site, arguments.port, arguments.latency).start()
+    print("Serving {} pages at {}".format(site.total_pages, server.main_url))
+    if arguments.socks_port is not None:
+        SocksServer(arguments.socks_port, upstream=('127.0.0.1', server.port)).start()
+        print("SOCKS5 stand-in at 127.0.0.1:{}, routing every host to the site".format(arguments.socks_port))
+    pending_pastes = 0.0
+    try:
+        while True:
+            time.sleep(1)
+            pending_pastes += arguments.new_pastes_per_minute / 60
+            if pending_pastes >= 1:
+                site.add_pastes(int(pending_pastes))
+                pending_pastes -= int(pending_pastes)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
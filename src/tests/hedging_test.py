@@ -0,0 +1,77 @@
+"""
+Checks when WebRequest hedges a request, using the two SOCKS stand-ins of tests.endpoint_pool_test
+    python -m pytest tests/hedging_test.py
+"""
+import threading
+import time
+
+from tests.endpoint_pool_test import Endpoints
+
+
+HEDGE_DELAY = 0.1
+
+
+def create_endpoints(latencies):
+    # a single page in flight leaves the executor with 4 threads
+    endpoints = Endpoints(latencies, overrides={('website', 'hedge_percentile'): '50',
+                                                ('website', 'hedge_min_delay'): str(HEDGE_DELAY),
+                                                ('website', 'max_pages_in_flight'): '0'})
+    web_request = endpoints.web_request
+    for _ in range(web_request.MIN_LATENCY_SAMPLES):
+        web_request._latencies.append(0.001)
+    return endpoints
+
+
+def occupy_executor(web_request, threads_count):
+    """
+    :return: event releasing the executor threads taken
+    """
+    release = threading.Event()
+    for _ in range(threads_count):
+        web_request._get_executor().submit(release.wait)
+    return release
+
+
+def send_hedged(endpoints, endpoint):
+    web_request = endpoints.web_request
+    return web_request._send_hedged(endpoint, endpoints.context.config.WEB_MAIN_URL, None)
+
+
+def test_queued_request_is_not_hedged():
+    endpoints = create_endpoints(latencies=(0.0, 0.0))
+    try:
+        web_request = endpoints.web_request
+        release = occupy_executor(web_request, web_request._get_executor()._max_workers)
+        threading.Timer(HEDGE_DELAY * 3, release.set).start()
+        endpoint = web_request.endpoint_pool.acquire()
+        assert send_hedged(endpoints, endpoint).status_code == 200
+        assert web_request.get_crawl_stats()[3] == 0
+    finally:
+        endpoints.close()
+
+
+def test_queued_hedge_is_cancelled_when_the_request_wins():
+    endpoints = create_endpoints(latencies=(HEDGE_DELAY * 3, 0.0))
+    try:
+        web_request = endpoints.web_request
+        slow_endpoint, fast_endpoint = endpoints.endpoints
+        slow_endpoint.in_flight += 1
+        result = dict()
+        thread = threading.Thread(target=lambda: result.update(response=send_hedged(endpoints, slow_endpoint)))
+        thread.start()
+        # the request has a thread by now, the rest of them are taken before the hedge is sent
+        time.sleep(HEDGE_DELAY / 2)
+        release = occupy_executor(web_request, web_request._get_executor()._max_workers - 1)
+        thread.join()
+        release.set()
+        assert result['response'].status_code == 200
+        assert web_request.get_crawl_stats()[3] == 1
+        assert fast_endpoint.requests_count == 0
+        assert slow_endpoint.in_flight == fast_endpoint.in_flight == 0
+    finally:
+        endpoints.close()
+
+
+if __name__ == '__main__':
+    test_queued_request_is_not_hedged()
+    test_queued_hedge_is_cancelled_when_the_request_wins()
@@ -0,0 +1,32 @@
+"""
+Checks that the Paste normalization gives the same values the baseline Paste model gave
+    python -m pytest tests/normalization_test.py
+
+data/normalized_pastes.json holds raw pastes extracted out of the fixture pages plus a few edge cases,
+each with the values the baseline model instance normalized them to.
+"""
+import json
+import os
+
+from app.models import Paste, PasteRecord
+from modules.common import Context
+from modules.orm import ModelCollection
+
+
+TESTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILEPATH = os.path.join(TESTS_DIRECTORY, '..', '..', 'conf', 'settings.ini')
+EXPECTED_FILEPATH = os.path.join(TESTS_DIRECTORY, 'data', 'normalized_pastes.json')
+BASELINE_FIELDS = ['author', 'title', 'content', 'date']
+
+
+def test_normalization_matches_the_baseline():
+    model_collection = ModelCollection(Context(CONFIG_FILEPATH, 'localhost'), model=Paste)
+    with open(EXPECTED_FILEPATH, encoding='utf-8') as expected_file:
+        expected = json.load(expected_file)
+    records = model_collection.normalize(PasteRecord(**dict(zip(BASELINE_FIELDS, paste['raw']))) for paste in expected)
+    for record, paste in zip(records, expected):
+        assert [getattr(record, field_name) for field_name in BASELINE_FIELDS] == paste['normalized'], paste['raw']
+
+
+if __name__ == '__main__':
+    test_normalization_matches_the_baseline()
@@ -0,0 +1,284 @@
+"""
+Checks the ModelCollection transactions against the group commit of the shared connection, the stored value lookups,
+the compressed fields and the full-text index kept next to them
+    python -m pytest tests/orm_test.py
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from app.models import Paste, PasteRecord
+from modules.compression import Compressor
+from modules.orm import ModelCollection, SharedConnection
+from tests.bench import create_context
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+
+
+def create_paste(number):
+    return PasteRecord('author {}'.format(number), 'title {}'.format(number), 'content {}'.format(number), '02 Jan 2017, 10:20:{:02d} UTC'.format(number))
+
+
+def test_failed_update_keeps_the_pending_grouped_rows():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory, overrides={('database', 'group_commit_size'): '100'})
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        model_collection.store(model_collection.normalize([create_paste(1), create_paste(2)]))
+        stored_pastes = list(model_collection.query().order_by('date'))
+
+        # the second paste takes the fingerprint of the first one, the unique index fails the whole update
+        model_collection.store(model_collection.normalize([create_paste(3)]))
+        stored_pastes[1].fingerprint = stored_pastes[0].fingerprint
+        stored_pastes[1].title = 'updated'
+        try:
+            model_collection.update_many(stored_pastes[::-1])
+        except sqlite3.IntegrityError:
+            pass
+        else:
+            raise AssertionError("the update should have failed")
+
+        SharedConnection.close_all()
+        rows = sqlite3.connect(context.config.DB_FILEPATH).execute("SELECT title FROM {} ORDER BY date".format(Paste.get_table_name())).fetchall()
+        assert rows == [('title 1',), ('title 2',), ('title 3',)]
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_stored_values_match_the_lookups():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        pastes = model_collection.normalize([create_paste(number) for number in range(1, 4)])
+        for paste, source in zip(pastes, ['main', 'mirror', 'mirror']):
+            paste.source = source
+        model_collection.store(pastes[:2])
+        last_primary_key = model_collection.get_last_primary_key()
+        model_collection.store(pastes[2:])
+
+        fingerprints = [paste.fingerprint for paste in pastes]
+        assert model_collection.get_stored_values('fingerprint', fingerprints) == set(fingerprints)
+        assert model_collection.get_stored_values('fingerprint', fingerprints, source='mirror') == set(fingerprints[1:])
+        assert model_collection.get_stored_values('fingerprint', fingerprints, source='main', pk__gt=last_primary_key) == set()
+        assert model_collection.get_last_primary_key() == last_primary_key + 1
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_plain_connection_writes_past_the_full_text_triggers():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        model_collection.store(model_collection.normalize([create_paste(number) for number in range(1, 4)]))
+        SharedConnection.close_all()
+
+        # the triggers must not call the functions only the SharedConnection connections define
+        connection = sqlite3.connect(context.config.DB_FILEPATH)
+        connection.execute("DELETE FROM {} WHERE title = 'title 1'".format(Paste.get_table_name()))
+        connection.execute("UPDATE {} SET author = 'someone else' WHERE title = 'title 2'".format(Paste.get_table_name()))
+        connection.commit()
+        connection.close()
+
+        model_collection = ModelCollection(context, model=Paste)
+        assert model_collection.search('content')[0] == 1
+        assert model_collection.search('"title 1"')[0] == 0
+        # the rows written by the other tools are indexed on rebuild
+        Paste.rebuild_full_text_index(context)
+        total, results = model_collection.search('someone')
+        assert total == 1 and results[0]['title'] == 'title 2'
+        assert model_collection.search('content')[0] == 2
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_search_follows_the_writes():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        pastes = model_collection.normalize([create_paste(number) for number in range(1, 4)])
+        pastes[0].content = 'the leaked password list follows'
+        model_collection.store(pastes)
+        # the content is stored compressed and indexed as plain text
+        assert isinstance(model_collection.connection.execute_fetch_single_value("SELECT content FROM {}".format(Paste.get_table_name())), bytes)
+
+        total, results = model_collection.search('password')
+        assert total == 1
+        assert results[0]['title'] == 'title 1'
+        assert results[0]['snippet'] == 'the leaked [password] list follows'
+
+        stored_pastes = list(model_collection.query().order_by('date'))
+        stored_pastes[0].content = 'nothing to see here'
+        stored_pastes[1].title = 'renamed'
+        model_collection.update_many(stored_pastes[:2])
+        assert model_collection.search('password')[0] == 0
+        assert model_collection.search('nothing')[1][0]['pk'] == stored_pastes[0].pk
+        assert model_collection.search('renamed')[1][0]['pk'] == stored_pastes[1].pk
+        assert model_collection.search('title')[0] == 2
+
+        model_collection.delete_where(title='title 3')
+        assert model_collection.search('title')[0] == 1
+
+        paste = Paste(context, pk=stored_pastes[1].pk)
+        paste.content = 'a password again'
+        paste.save()
+        new_paste = Paste(context, author='someone', title='fresh', content='another password', date='02 Jan 2017, 10:21:00 UTC')
+        new_paste.save()
+        assert model_collection.search('password')[0] == 2
+        assert model_collection.search('fresh')[0] == 1
+        paste.delete()
+        assert model_collection.search('password')[1][0]['title'] == 'fresh'
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_search_index_is_recreated_when_the_fields_change():
+    work_directory = tempfile.mkdtemp()
+    full_text_fields = Paste.FULL_TEXT_FIELDS
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        model_collection.store(model_collection.normalize([create_paste(number) for number in range(1, 3)]))
+        assert model_collection.search('content')[0] == 2
+
+        Paste.FULL_TEXT_FIELDS = ['title', 'author']
+        Paste.create_table_if_necessary(context)
+        assert model_collection.search('content')[0] == 0
+        assert model_collection.search('author')[0] == 2
+        # the title and author are indexed by the triggers alone now
+        model_collection.store(model_collection.normalize([create_paste(3)]))
+        assert model_collection.search('title')[0] == 3
+
+        Paste.FULL_TEXT_FIELDS = full_text_fields
+        Paste.create_table_if_necessary(context)
+        assert model_collection.search('content')[0] == 3
+    finally:
+        Paste.FULL_TEXT_FIELDS = full_text_fields
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_compressed_values_round_trip():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory, overrides={('database', 'id_field'): 'row_id'})
+        Paste.create_table_if_necessary(context)
+        contents = ['header line of every paste\nbody {}\nfooter line of every paste'.format(number) for number in range(6)]
+        # the content stored by the releases before the compression
+        connection = sqlite3.connect(context.config.DB_FILEPATH)
+        connection.executemany("INSERT INTO {} (author, title, content, date) VALUES ('author', ?, ?, '2017-01-02 10:20:00')".format(Paste.get_table_name()),
+                               [('title {}'.format(number), content) for number, content in enumerate(contents[:4])])
+        connection.commit()
+        connection.close()
+
+        # what the compressdb module does
+        model_collection = ModelCollection(context, model=Paste)
+        dictionary_id = model_collection.train_compression_dictionary()
+        assert dictionary_id is not None
+        assert model_collection.compress_stored_values()['values'] == 4
+        model_collection.store(model_collection.normalize([PasteRecord('author', 'title {}'.format(number), contents[number], '02 Jan 2017, 10:20:00 UTC')
+                                                           for number in range(4, 6)]))
+        SharedConnection.close_all()
+
+        model_collection = ModelCollection(context, model=Paste)
+        stored_contents = model_collection.connection.execute_fetch_all("SELECT content FROM {} ORDER BY row_id".format(Paste.get_table_name()))
+        assert all(value[:1] == Compressor.DICTIONARY_MARKER for value, in stored_contents)
+        assert [paste.content for paste in model_collection.query().order_by('pk')] == contents
+        assert model_collection.search('footer')[0] == 6
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_duplicates_are_dropped_before_the_unique_index_is_created():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        SharedConnection.close_all()
+        # a table of the releases before the unique index, fingerprinted partly
+        table_name = Paste.get_table_name()
+        connection = sqlite3.connect(context.config.DB_FILEPATH)
+        connection.execute("DROP INDEX {}".format(Paste.get_index_name(['fingerprint'], 'unique')))
+        connection.executemany("INSERT INTO {} (title, fingerprint) VALUES (?, ?)".format(table_name),
+                               [('first', 'a'), ('second', 'b'), ('copy of first', 'a'), ('unfingerprinted', None), ('unfingerprinted', None)])
+        connection.commit()
+        connection.close()
+
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        assert [paste.title for paste in model_collection.query().order_by('pk')] == ['first', 'second', 'unfingerprinted', 'unfingerprinted']
+
+        # the pastes stored already are ignored, the rest of the batch goes in
+        pastes = model_collection.normalize([create_paste(1), create_paste(2)])
+        model_collection.store(pastes[:1])
+        model_collection.store(model_collection.normalize([create_paste(1)]) + pastes[1:])
+        assert model_collection.query().count() == 6
+        assert model_collection.get_stored_values('fingerprint', [paste.fingerprint for paste in pastes]) == set(paste.fingerprint for paste in pastes)
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_keyset_pages_cover_every_row_once():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        model_collection = ModelCollection(context, model=Paste)
+        # a few dates and authors shared by several pastes, some of them missing
+        pastes = model_collection.normalize([PasteRecord(None if number % 5 == 0 else 'author {}'.format(number % 3), 'title {}'.format(number), 'content',
+                                                         None if number % 4 == 0 else '02 Jan 2017, 10:20:{:02d} UTC'.format(number % 6))
+                                             for number in range(40)])
+        model_collection.store(pastes)
+        assert model_collection.query().filter(date__isnull=True).count() == 10
+        id_field = context.config.DB_ID_FIELD
+
+        for ordering in [('date',), ('-date',), ('author', '-date'), ('-author', 'date'), ('-date', '-pk')]:
+            # SQLite sorts the NULL values first, the primary key breaks the ties in its own direction or ascending
+            sql_ordering = ['{} {}'.format(id_field if field_name.lstrip('-') == 'pk' else field_name.lstrip('-'), 'DESC' if field_name.startswith('-') else 'ASC')
+                            for field_name in ordering]
+            if not any(field_name.lstrip('-') == 'pk' for field_name in ordering):
+                sql_ordering.append('{} ASC'.format(id_field))
+            expected_ids = [row[0] for row in model_collection.connection.execute_fetch_all("SELECT {} FROM {} ORDER BY {}".format(id_field, Paste.get_table_name(),
+                                                                                                                                 ', '.join(sql_ordering)))]
+            query = model_collection.query().order_by(*ordering)
+
+            page_ids, keyset = list(), None
+            while True:
+                records, keyset = query.after(keyset).page(7)
+                page_ids.extend(record.pk for record in records)
+                if keyset is None:
+                    break
+            assert page_ids == expected_ids, ordering
+            assert [record.pk for records in query.chunk_size(6).chunks() for record in records] == expected_ids, ordering
+            # a query continued from any row goes on with the rows after it
+            records = list(query)
+            assert [record.pk for record in query.after(query.get_keyset(records[12]))] == expected_ids[13:], ordering
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    test_failed_update_keeps_the_pending_grouped_rows()
+    test_stored_values_match_the_lookups()
+    test_plain_connection_writes_past_the_full_text_triggers()
+    test_search_follows_the_writes()
+    test_search_index_is_recreated_when_the_fields_change()
+    test_compressed_values_round_trip()
+    test_duplicates_are_dropped_before_the_unique_index_is_created()
+    test_keyset_pages_cover_every_row_once()
@@ -0,0 +1,92 @@
+"""
+Checks that every Parser engine extracts the same records out of the fixture pages and the edge cases below
+    python -m pytest tests/parser_engines_test.py
+
+The engines are compared on the default html.parser tree builder, other tree builders (lxml, html5lib)
+repair malformed markup their own way.
+"""
+import os
+
+from modules.common import Context
+from modules.scraper import Parser
+from tests.fixture_server import PAGE_TEMPLATE, FixtureSite
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+ENGINES = ['html.parser', 'targeted', 'streaming']
+EDGE_CASE_TEMPLATE = '''<div class="col-sm-12">
+<div class="pre-info pre-header"><div class="row"><div class="col-sm-12">{header}</div></div></div>
+<div class="text"><ol>{lines}</ol></div>
+<div class="pre-info pre-footer"><div class="row"><div class="col-sm-6">Posted by {author} at 02 Jan 2017, 10:20:30 UTC</div>
+<div class="col-sm-6 text-right"><a href="/paste/1">Show paste</a></div></div></div>
+</div>'''
+EDGE_CASES = {'script': dict(header='<h4>Script</h4>', lines='<li>before</li><script>var x = "<li>not a line</li>";</script><li>after</li>'),
+              'style': dict(header='<h4>Style</h4>', lines='<li>a</li><style>li { color: red }</style><li>b</li>'),
+              'template': dict(header='<h4>Template</h4>', lines='<li>a</li><template><li>hidden <b>line</b></li></template><li>b</li>'),
+              'ruby': dict(header='<h4>Ruby</h4>', lines='<li><ruby>K<rp>(</rp><rt>kan</rt><rp>)</rp></ruby></li>'),
+              'cdata': dict(header='<h4>CDATA</h4>', lines='<li>a<![CDATA[ raw <b>text</b> ]]>b</li>'),
+              'comment': dict(header='<h4>Comment <!-- hidden --></h4>', lines='<li>a<!-- hidden -->b</li><?pi hidden?>'),
+              'entities': dict(header='<h4>Tom &amp; Jerry &lt;3</h4>', lines='<li>&quot;q&quot; &#39;s&#39; &#x41; &nbsp;&copy;</li>'),
+              'malformed entities': dict(header='<h4>AT&T &copy 2017</h4>', lines='<li>&unknown; &#150; &#0; &#x110000; &#xd800; &amp &ltx &#x4g</li>'),
+              'nested title': dict(header='<h4>Title <b>bold</b> <i>italic</i></h4><h4>second</h4>', lines='<li>x</li>'),
+              'unclosed lines': dict(header='<h4>Unclosed</h4>', lines='<li>one<li>two<br>three<p>four'),
+              'missing title': dict(header='<h5>No title</h5>', lines='<li>x</li>'),
+              'empty content': dict(header='<h4>Empty</h4>', lines='')}
+
+
+def create_context():
+    return Context(CONFIG_FILEPATH, 'localhost')
+
+
+def extract(context, engine, page):
+    """
+    :return: navigation numbers, list of the raw paste field tuples
+    """
+    context.config.PARSER_ENGINE = engine
+    parser = Parser(context, page)
+    return parser.get_navigation_numbers(), [tuple(paste) for paste in parser.extract_new_paste()]
+
+
+def render_edge_case_page(header, lines):
+    return PAGE_TEMPLATE.format(pastes=EDGE_CASE_TEMPLATE.format(header=header, lines=lines, author='Guest'),
+                                pagination='<li><a href="/all?page=1">1</a></li><li><a href="/all?page=2">2</a></li>',
+                                next_page=2)
+
+
+def assert_engines_agree(context, page):
+    expected = extract(context, ENGINES[0], page)
+    for engine in ENGINES[1:]:
+        assert extract(context, engine, page) == expected, engine
+    return expected
+
+
+def test_fixture_pages():
+    context = create_context()
+    site = FixtureSite(total_pastes=45, pastes_per_page=10, content_size=300)
+    for page_number in range(1, site.total_pages + 1):
+        navigation_numbers, pastes = assert_engines_agree(context, site.render_page(page_number))
+        assert navigation_numbers == list(range(1, site.total_pages + 1))
+        assert len(pastes) == min(10, 45 - (page_number - 1) * 10)
+
+
+def test_edge_cases():
+    context = create_context()
+    for name, parameters in EDGE_CASES.items():
+        _, pastes = assert_engines_agree(context, render_edge_case_page(**parameters))
+        assert len(pastes) == 1, name
+
+
+def test_hidden_text_is_left_out():
+    context = create_context()
+    _, pastes = extract(context, 'streaming', render_edge_case_page(**EDGE_CASES['script']))
+    assert 'not a line' not in pastes[0][2]
+    _, pastes = extract(context, 'streaming', render_edge_case_page(**EDGE_CASES['cdata']))
+    assert 'raw' in pastes[0][2]
+    _, pastes = extract(context, 'streaming', render_edge_case_page(**EDGE_CASES['missing title']))
+    assert pastes[0][1] == ''
+
+
+if __name__ == '__main__':
+    test_fixture_pages()
+    test_edge_cases()
+    test_hidden_text_is_left_out()
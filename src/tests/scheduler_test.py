@@ -0,0 +1,40 @@
+"""
+Checks the intervals AdaptiveScheduler picks between the crawls
+    python -m pytest tests/scheduler_test.py
+"""
+import os
+
+from modules.common import Context
+from modules.scheduler import AdaptiveScheduler
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+
+
+def create_scheduler():
+    return AdaptiveScheduler(Context(CONFIG_FILEPATH, 'localhost'))
+
+
+def test_first_cycle_waits_the_minimum_interval():
+    scheduler = create_scheduler()
+    assert scheduler.record_cycle(10, None) == scheduler.context.config.SCHEDULER_MIN_INTERVAL_MINUTES * 60
+
+
+def test_quiet_site_waits_the_maximum_interval():
+    scheduler = create_scheduler()
+    scheduler.record_cycle(10, None)
+    assert scheduler.record_cycle(0, 1.0) == scheduler.context.config.SCHEDULER_MAX_INTERVAL_MINUTES * 60
+
+
+def test_interval_follows_the_rate():
+    scheduler = create_scheduler()
+    config = scheduler.context.config
+    # twice the target per hour, the target is expected to be waiting after half an hour
+    interval = scheduler.record_cycle(config.SCHEDULER_TARGET_NEW_PASTES * 2, 1.0)
+    assert interval == min(max(30, config.SCHEDULER_MIN_INTERVAL_MINUTES), config.SCHEDULER_MAX_INTERVAL_MINUTES) * 60
+
+
+if __name__ == '__main__':
+    test_first_cycle_waits_the_minimum_interval()
+    test_quiet_site_waits_the_maximum_interval()
+    test_interval_follows_the_rate()
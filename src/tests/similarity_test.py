@@ -0,0 +1,67 @@
+"""
+Checks the similarity index of the pastes
+    python -m pytest tests/similarity_test.py
+"""
+import array
+import os
+import shutil
+import tempfile
+
+from app import workers
+from app.models import Paste, PasteRecord
+from app.similarity import SimilarityIndexer
+from modules.orm import SharedConnection
+from tests.bench import create_context
+
+
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'conf', 'settings.ini')
+
+
+def test_near_duplicate_joins_the_cluster():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory)
+        Paste.create_table_if_necessary(context)
+        workers.init(context.config_filepath, context.tor_hostname)
+        content = ' '.join('word{}'.format(number) for number in range(200))
+        normalized_pastes, signatures = workers.normalize_pastes([('a', 'first', content, '02 Jan 2017, 10:20:30 UTC'),
+                                                                  ('b', 'copy', content + ' and a tail', '02 Jan 2017, 10:20:31 UTC'),
+                                                                  ('c', 'other', 'nothing alike at all', '02 Jan 2017, 10:20:32 UTC')])
+        pastes = [PasteRecord(*values) for values in normalized_pastes]
+        indexer = SimilarityIndexer(context)
+        last_pk = indexer.model_collection.get_last_primary_key()
+        indexer.model_collection.store(pastes)
+        assert indexer.index_pastes(pastes, signatures, last_pk) == 3
+        # the pastes stored before are indexed already
+        assert indexer.index_pastes(pastes, signatures, last_pk + 3) == 0
+
+        cluster_id, similar_pastes = indexer.lookup(last_pk + 2)
+        assert cluster_id == last_pk + 1
+        assert [record.title for record, _ in similar_pastes] == ['first']
+        assert indexer.lookup(last_pk + 3) == (last_pk + 3, list())
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+def test_candidates_sharing_the_most_bands_come_first():
+    work_directory = tempfile.mkdtemp()
+    try:
+        context = create_context(CONFIG_FILEPATH, work_directory, overrides={('similarity', 'max_candidates'): '1'})
+        Paste.create_table_if_necessary(context)
+        similarity_index = SimilarityIndexer(context).similarity_index
+        rows = context.config.SIMILARITY_PERMUTATIONS // context.config.SIMILARITY_BANDS
+        signature = array.array('I', range(context.config.SIMILARITY_PERMUTATIONS))
+        # the first row shares the first band only, the second one every band but the last
+        one_band = array.array('I', list(signature[:rows]) + [value + 1000 for value in signature[rows:]])
+        most_bands = array.array('I', list(signature[:-rows]) + [value + 1000 for value in signature[-rows:]])
+        similarity_index.add([(1, one_band), (2, most_bands)])
+        assert [candidate[0] for candidate in similarity_index.get_candidates(signature)] == [2]
+    finally:
+        SharedConnection.close_all()
+        shutil.rmtree(work_directory)
+
+
+if __name__ == '__main__':
+    test_near_duplicate_joins_the_cluster()
+    test_candidates_sharing_the_most_bands_come_first()
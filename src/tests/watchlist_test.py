@@ -0,0 +1,99 @@
+"""
+Checks the watchlist matching against plain searches for every entry on its own
+    python -m pytest tests/watchlist_test.py
+"""
+import os
+import random
+import re
+import shutil
+import tempfile
+
+from modules.watchlist import AhoCorasick, Watchlist
+
+
+def find_terms(terms, text):
+    """
+    :return: set of (term index, end position) of every occurrence, found by str.find()
+    """
+    occurrences = set()
+    for term_index, term in enumerate(terms):
+        position = text.lower().find(term.lower())
+        while position != -1:
+            occurrences.add((term_index, position + len(term) - 1))
+            position = text.lower().find(term.lower(), position + 1)
+    return occurrences
+
+
+def search_patterns(patterns, text):
+    """
+    :return: set of the (kind, watchlist entry, matched value) tuples of every pattern searched for on its own
+    """
+    return set((Watchlist.REGEX, pattern, match.group()) for pattern in patterns for match in re.finditer(pattern, text) if match.group())
+
+
+def test_automaton_finds_every_occurrence():
+    generator = random.Random(1)
+    terms = ['he', 'she', 'his', 'hers', 'h', 'ushers', 'Sh']
+    automaton = AhoCorasick(terms)
+    for _ in range(200):
+        text = ''.join(generator.choice('hersuHSx ') for _ in range(generator.randint(0, 40)))
+        assert set(automaton.find_all(text)) == find_terms(terms, text), text
+
+
+def test_overlapping_matches_are_found():
+    patterns = [r'[\w.]+@[\w.]+\.\w+', r'\bexample\.com\b', r'\bbob']
+    watchlist = Watchlist(patterns=patterns)
+    text = 'write to bob@example.com or visit example.com'
+    assert set(watchlist.match(text)) == search_patterns(patterns, text)
+    assert (Watchlist.REGEX, r'\bexample\.com\b', 'example.com') in watchlist.match('bob@example.com')
+
+
+def test_patterns_that_cannot_be_alternated():
+    # global flags, group names repeated by another pattern or a wrapping group, numbered back-references
+    patterns = ['(?i)secret', '(?x) key \\s* = # the value follows', r'(?P<user>\w+)@', r'(?P<user>\w+):', r'(?P<_0>zz)', r'(\w)\1']
+    watchlist = Watchlist(patterns=patterns)
+    text = 'SECRET key = bob@host alice:pw zz aa'
+    assert set(watchlist.match(text)) == search_patterns(patterns, text)
+
+
+def test_random_patterns_match_like_their_own_searches():
+    generator = random.Random(2)
+    patterns = [r'a+b', r'ab', r'b\w', r'\bab\b', r'(?i)AB', r'\d{2}', r'(a)\1', r'\bc|d', r'(?P<x>b)a', r'(?P<x>a)c']
+    for _ in range(300):
+        selected_patterns = generator.sample(patterns, generator.randint(1, len(patterns)))
+        text = ''.join(generator.choice('abcdAB12 ') for _ in range(generator.randint(0, 40)))
+        assert set(Watchlist(patterns=selected_patterns).match(text)) == search_patterns(selected_patterns, text), (selected_patterns, text)
+
+
+def test_load():
+    work_directory = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(work_directory, 'watchlist.txt')
+        with open(filepath, 'w', encoding='utf-8') as watchlist_file:
+            watchlist_file.write('# leaked credentials\n\nLeaks@Example.com\nre:(?i)secret\n  re:\\bkey\\b  \n')
+        watchlist = Watchlist.load(filepath)
+        assert watchlist.terms == ['Leaks@Example.com']
+        assert watchlist.patterns == ['(?i)secret', r'\bkey\b']
+        assert watchlist.match('mail leaks@example.com the Secret key') == [(Watchlist.TERM, 'Leaks@Example.com', 'Leaks@Example.com'),
+                                                                           (Watchlist.REGEX, '(?i)secret', 'Secret'),
+                                                                           (Watchlist.REGEX, r'\bkey\b', 'key')]
+    finally:
+        shutil.rmtree(work_directory)
+
+
+def test_invalid_pattern_is_rejected():
+    try:
+        Watchlist(patterns=['ok', '(unclosed'])
+    except ValueError as e:
+        assert '(unclosed' in str(e)
+    else:
+        raise AssertionError("the invalid pattern should have been rejected")
+
+
+if __name__ == '__main__':
+    test_automaton_finds_every_occurrence()
+    test_overlapping_matches_are_found()
+    test_patterns_that_cannot_be_alternated()
+    test_random_patterns_match_like_their_own_searches()
+    test_load()
+    test_invalid_pattern_is_rejected()